@@ -1,7 +1,8 @@
 from django.conf import settings
+from django.urls import path
 from rest_framework.routers import DefaultRouter, SimpleRouter
 
-from django_spmc.spmc.api.views import GetUserSuperpixels
+from django_spmc.spmc.api.views import GetUserSuperpixels, superpixel_tile
 from django_spmc.users.api.views import UserViewSet
 
 if settings.DEBUG:
@@ -14,4 +15,10 @@ router.register(r"superpixels", GetUserSuperpixels, basename="superpixels")
 
 
 app_name = "api"
-urlpatterns = router.urls
+urlpatterns = router.urls + [
+    path(
+        "superpixels/tiles/<int:scene_id>/<int:algo_id>/<int:z>/<int:x>/<int:y>.mvt",
+        superpixel_tile,
+        name="superpixels-tile",
+    ),
+]
@@ -159,6 +159,9 @@ STATICFILES_FINDERS = [
 MEDIA_ROOT = str(APPS_DIR / "media")
 # https://docs.djangoproject.com/en/dev/ref/settings/#media-url
 MEDIA_URL = "/media/"
+# https://docs.djangoproject.com/en/dev/ref/settings/#file-upload-handlers
+# Rasters are large, spool every upload to disk once, so GDAL could read it directly
+FILE_UPLOAD_HANDLERS = ["django.core.files.uploadhandler.TemporaryFileUploadHandler"]
 
 # TEMPLATES
 # ------------------------------------------------------------------------------
@@ -309,3 +312,27 @@ WEBPACK_LOADER = {
 }
 # Your stuff...
 # ------------------------------------------------------------------------------
+# Number of superpixels written to the database at once during GeoJSON ingestion
+SPMC_INGEST_BATCH_SIZE = env.int("SPMC_INGEST_BATCH_SIZE", default=2000)
+# Uploads waiting to be processed by spmc_worker, should be shared by django and worker containers
+SPMC_STAGING_ROOT = env("SPMC_STAGING_ROOT", default=str(APPS_DIR / "staging"))
+# Number of worker processes started by spmc_worker
+SPMC_WORKERS = env.int("SPMC_WORKERS", default=2)
+# Default number of gdal2tiles processes, could be overridden with TilingSettings of a project or a scene
+SPMC_TILING_PROCESSES = env.int("SPMC_TILING_PROCESSES", default=1)
+# Disk cache of tiles rendered from Cloud-Optimized GeoTIFFs
+SPMC_TILE_CACHE_ROOT = env("SPMC_TILE_CACHE_ROOT", default=str(APPS_DIR / "tile_cache"))
+SPMC_TILE_CACHE_MAX_BYTES = env.int("SPMC_TILE_CACHE_MAX_BYTES", default=2 * 1024**3)
+# Grid sizes (metres) of simplified superpixel geometries precomputed at ingest time
+SPMC_SIMPLIFY_RESOLUTIONS = env.list("SPMC_SIMPLIFY_RESOLUTIONS", cast=float, default=[5, 20, 80])
+# Cache alias and timeout (seconds) of serialized superpixel geometry
+SPMC_GEOMETRY_CACHE = env("SPMC_GEOMETRY_CACHE", default="default")
+SPMC_GEOMETRY_CACHE_TIMEOUT = env.int("SPMC_GEOMETRY_CACHE_TIMEOUT", default=7 * 24 * 3600)
+# TopoJSON of superpixels built by spmc_worker at ingest time, should be shared by django and worker containers
+SPMC_TOPOLOGY_ROOT = env("SPMC_TOPOLOGY_ROOT", default=str(APPS_DIR / "media" / "topology"))
+# Number of processes segmenting a raster when superpixels are generated by spmc_worker
+SPMC_SEGMENTATION_PROCESSES = env.int("SPMC_SEGMENTATION_PROCESSES", default=2)
+# Tiles of deleted scenes are moved here and removed by spmc_worker, should be on the same file system as MEDIA_ROOT
+SPMC_TRASH_ROOT = env("SPMC_TRASH_ROOT", default=str(APPS_DIR / "media" / ".trash"))
+# Red and near infrared bands (1-based) of rasters used for NDVI in zonal statistics of superpixels, e.g. 3,4
+SPMC_STATS_NDVI_BANDS = env.list("SPMC_STATS_NDVI_BANDS", cast=int, default=[])
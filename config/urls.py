@@ -8,7 +8,7 @@ from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
 from rest_framework.authtoken.views import obtain_auth_token
 
 # Import views
-from django_spmc.spmc.views import classification, home, scene, select_proj, select_scene
+from django_spmc.spmc.views import classification, home, scene, select_proj, select_scene, tile
 
 urlpatterns = [
     path("", home, name="home"),
@@ -16,6 +16,7 @@ urlpatterns = [
     path("scene/", scene, name="scene"),
     path("select-scene/", select_scene, name="select_scene"),
     path("classification/", classification, name="classification"),
+    path("tiles/<str:uuid>/<int:z>/<int:x>/<int:y>.<str:ext>", tile, name="tile"),
     path("about/", TemplateView.as_view(template_name="pages/about.html"), name="about"),
     # Django Admin, use {% url 'admin:index' %}
     path(settings.ADMIN_URL, admin.site.urls),
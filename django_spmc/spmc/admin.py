@@ -1,30 +1,40 @@
-import json
-
 from django import forms
+from django.contrib.admin import action
+from django.contrib.auth import get_permission_codename
 from django.contrib.gis import admin
-from django.contrib.gis.geos import GEOSGeometry, Polygon
-from django.core.exceptions import RequestAborted, ValidationError
+from django.core.exceptions import ValidationError
 from django.core.validators import FileExtensionValidator
+from django.db import models
 
+from .jobs import enqueue, stage_upload
 from .models import (
+    Job,
     LandClass,
     LandClassification,
     MiscTile,
     Project,
     ProjectAlgo,
     Scene,
+    SceneAlgo,
     SegmentationEntry,
+    StatsLayer,
     SuperPixel,
     SuperPixelAlgo,
+    TilingSettings,
 )
-from .utils import check_geojson, check_raster, handle_tiles_upload
+from .utils import GEOJSON_EXTENSIONS, OGR_EXTENSIONS, check_raster, check_superpixels, raster_bbox, staged_path
 
-admin.site.register(Project)
 admin.site.register(SuperPixelAlgo)
 admin.site.register(ProjectAlgo)
 admin.site.register(SuperPixel)
 admin.site.register(LandClassification)
 admin.site.register(SegmentationEntry)
+admin.site.register(StatsLayer)
+
+
+@admin.register(SceneAlgo)
+class SceneAlgoAdmin(admin.ModelAdmin):
+    list_display = ["scene_id", "algo_id", "sp_count", "area", "version", "updated_at"]
 
 
 # =====================================================================================================================
@@ -40,6 +50,20 @@ class LandClassAdmin(admin.ModelAdmin):
     form = LandClassFormAdmin
 
 
+# =====================================================================================================================
+# Project
+# =====================================================================================================================
+class TilingSettingsInline(admin.StackedInline):
+    model = TilingSettings
+    fields = ["backend", "min_zoom", "max_zoom", "resampling", "processes", "tile_format"]
+    max_num = 1
+
+
+@admin.register(Project)
+class ProjectAdmin(admin.ModelAdmin):
+    inlines = [TilingSettingsInline]
+
+
 # =====================================================================================================================
 # Processing Scene with base tiles
 # =====================================================================================================================
@@ -49,11 +73,18 @@ class MiscTileInline(admin.TabularInline):
     readonly_fields = ["uuid", "tiles_path", "bbox"]
 
 
+def generated_algos(project):
+    """
+    Algorithms of a project which generate superpixels from the scene raster
+    """
+    return SuperPixelAlgo.objects.filter(projectalgo__proj_id=project).exclude(method="").distinct()
+
+
 class SceneFormAdmin(forms.ModelForm):
     json_file = forms.FileField(
-        label="GeoJSON with superpixel polygons",
+        label="Superpixel polygons (GeoJSON, GeoPackage, FlatGeobuf or zipped Shapefile)",
         required=False,
-        validators=[FileExtensionValidator(["json", "geojson"])],
+        validators=[FileExtensionValidator([ext.lstrip(".") for ext in GEOJSON_EXTENSIONS + OGR_EXTENSIONS])],
     )
     algo_id = forms.ModelChoiceField(queryset=SuperPixelAlgo.objects.all(), required=False)
     image_file = forms.FileField(label="Spatial Raster Image", required=False)
@@ -61,18 +92,13 @@ class SceneFormAdmin(forms.ModelForm):
     def clean(self):
         cleaned_data = super().clean()
         # Check raster
-        im_file = cleaned_data["image_file"]
+        im_file = cleaned_data.get("image_file")
         # Check if it could be processed with gdal2tiles
         if "image_file" in self.changed_data:
             check_raster(im_file)
-        # Check json if needed
-        if not cleaned_data.get("json_file") is None:
-            json_file = cleaned_data["json_file"]
-            scene = self.instance
-            scene_bbox = None
-            if scene.bbox is not None:
-                scene_bbox = scene.bbox
-            check_geojson(json_file, scene_bbox, im_file)
+        # Only cheap checks of the superpixel file here, it is staged on save and polygons are validated by the job
+        if cleaned_data.get("json_file") is not None:
+            check_superpixels(staged_path(cleaned_data["json_file"]))
         return cleaned_data
 
     def clean_algo_id(self):
@@ -95,11 +121,13 @@ class SceneFormAdmin(forms.ModelForm):
         return self.cleaned_data["image_file"]
 
     def clean_json_file(self):
-        # We need to check that the file is geojson, polygon, and could be read with GEOSGeometry
+        # The file itself is checked in clean(), polygons (their validity and position) by the ingest job
         im_file = self.cleaned_data["json_file"]
         if self.instance.pk is None:  # Check if it is a new Scene object
-            if im_file is None:
-                raise ValidationError("To create a new entry, please provide the json file")
+            # Superpixels are not required if the project has algorithms generating them from the raster
+            project = self.cleaned_data.get("proj_id")
+            if im_file is None and not generated_algos(project).exists():
+                raise ValidationError("To create a new entry, please provide the superpixel file")
         return self.cleaned_data["json_file"]
 
     class Meta:
@@ -111,65 +139,92 @@ class SceneFormAdmin(forms.ModelForm):
 class SceneAdmin(admin.ModelAdmin):
     fields = ["proj_id", "name", "description", "image_file", "json_file", "algo_id", "uuid", "tiles_path", "bbox"]
     readonly_fields = ["uuid", "tiles_path", "bbox"]
-    inlines = [MiscTileInline]
+    inlines = [MiscTileInline, TilingSettingsInline]
     form = SceneFormAdmin
+    # Models deleted together with the objects and the foreign key pointing to them
+    cascade = [
+        (MiscTile, "scene_id"),
+        (TilingSettings, "scene_id"),
+        (SuperPixel, "scene_id"),
+        (SceneAlgo, "scene_id"),
+        (StatsLayer, "scene_id"),
+        (SegmentationEntry, "scene_id"),
+        (Job, "scene_id"),
+    ]
 
     def save_model(self, request, obj, form, change):
         if not form.is_valid():
             # If something wrong, just let super method to handle that
             super().save_model(request, obj, form, change)
 
+        # Heavy processing is done by spmc_worker, here we only stage files and schedule jobs
+        jobs = []
         # process image ===============================================================================================
         # Here we want to process image only if it is in changed form data (pass if a new file was not provided)
         if "image_file" in form.changed_data:
             # Generate uuid field if not present
             if obj.uuid is None:
                 obj.gen_uuid()
-                scene_uuid = obj.uuid
-            else:
-                scene_uuid = obj.uuid
-            # Process image
-            output_dir, bbox, srid, err = handle_tiles_upload(request.FILES["image_file"], scene_uuid)
-            # Check output for errors
-            if err is not None:
-                # Can not figure out how to handle this (form.add_error does not prevent for model saving)
-                raise RequestAborted(err)
-
-            obj.tiles_path = output_dir
-            # Add bounding box to model obj, control for srid
-            poly = Polygon.from_bbox(bbox)
-            poly.srid = srid
-            # Reproject bbox polygon to Scene model srid
-            poly.transform(Scene.bbox.field.srid)
-            obj.bbox = poly
-            self.message_user(request, f"Tiles for {obj} have been processed and saved to {output_dir}")
+            raster_path = stage_upload(request.FILES["image_file"])
+            # Bounding box is cheap to get from raster metadata, so the object is usable before tiles are ready
+            obj.bbox = raster_bbox(raster_path, type(obj).bbox.field.srid)
+            jobs.append((Job.TILES, {"path": raster_path}))
+            # Statistics of existing superpixels, for a misc tile only its own layer is computed
+            jobs.append((Job.STATS, {"path": raster_path}))
+            # Superpixels of algorithms with a segmentation method are generated from the same staged raster
+            if isinstance(obj, Scene):
+                for algo in generated_algos(obj.proj_id):
+                    jobs.append((Job.SEGMENTATION, {"path": raster_path, "algo_id": algo.id}))
 
         # Check if Superpixel Geojoson need to be processed
-        if (not form.cleaned_data["json_file"] is None) and ("json_file" in form.changed_data):
-            # First check if our object has pk (or it is new, if so save current)
-            if obj.pk is None:
-                obj.save()
-                change = True  # So the super().save_model will treat subsequent additions as changes
-            else:  # The case of update (delete existent polys only if algo_id is the same)
-                SuperPixel.objects.filter(scene_id=obj).filter(algo_id=form.cleaned_data.get("algo_id")).delete()
-
-            # Read geojson file (do not know why, but I was able to read it only via chunks)
-            json_str = ""
-            for chunk in request.FILES["json_file"].chunks():
-                json_str += chunk.decode("utf-8")
-            geojson_data = json.loads(json_str)
-
-            # Loop over features and save them
-            for feature in geojson_data.get("features", []):
-                feature_str = feature.get("geometry")
-                feature_str.update({"crs": geojson_data.get("crs")})
-                tmp_geom = GEOSGeometry(json.dumps(feature_str))
-                tmp_geom.transform(obj.bbox.srid)
-                # Save to SuperPixel model
-                new_sp_obj = SuperPixel(scene_id=obj, algo_id=form.cleaned_data["algo_id"], sp=tmp_geom)
-                new_sp_obj.save()
+        if (form.cleaned_data.get("json_file") is not None) and ("json_file" in form.changed_data):
+            payload = {"path": stage_upload(request.FILES["json_file"]), "algo_id": form.cleaned_data["algo_id"].id}
+            if "image_file" in form.changed_data:
+                # Statistics of the new superpixels are computed from the new raster once they are saved
+                payload["raster"] = raster_path
+            jobs.append((Job.SUPERPIXELS, payload))
+
         # Call super save
         super().save_model(request, obj, form, change)
+        for kind, payload in jobs:
+            job = enqueue(kind, obj, **payload)
+            self.message_user(request, f"{job} has been scheduled for {obj}")
+
+    def get_deleted_objects(self, objs, request):
+        # The default confirmation page walks the whole cascade (every superpixel and label), show counts instead.
+        # As by default, the delete permission is needed for every admin model with rows in the cascade
+        deleted_objects = [str(obj) for obj in objs]
+        model_count = {self.model._meta.verbose_name_plural: len(deleted_objects)}
+        perms_needed = set()
+        for model, field in self.cascade:
+            count = model.objects.filter(**{f"{field}__in": objs}).count()
+            if not count:
+                continue
+            opts = model._meta
+            model_count[opts.verbose_name_plural] = count
+            codename = get_permission_codename("delete", opts)
+            if model in self.admin_site._registry and not request.user.has_perm(f"{opts.app_label}.{codename}"):
+                perms_needed.add(opts.verbose_name)
+        return deleted_objects, model_count, perms_needed, self.get_protected_objects(objs)
+
+    def get_protected_objects(self, objs):
+        """
+        Objects referencing the deleted ones (or their cascade) with PROTECT or RESTRICT foreign keys, they would
+        prevent the deletion
+        """
+        protected = []
+        for model, field in [(self.model, "pk"), *self.cascade]:
+            deleted = model.objects.filter(**{f"{field}__in": objs})
+            for relation in model._meta.related_objects:
+                if relation.on_delete in (models.PROTECT, models.RESTRICT):
+                    blocking = relation.related_model.objects.filter(**{f"{relation.field.name}__in": deleted})
+                    protected.extend(str(obj) for obj in blocking)
+        return protected
+
+    def delete_queryset(self, request, queryset):
+        # Model delete() is set-based and moves tiles to the trash, queryset.delete() would bypass both
+        for obj in queryset:
+            obj.delete()
 
 
 # =====================================================================================================================
@@ -194,3 +249,47 @@ class MiscTileAdmin(SceneAdmin):
     exclude = ["json_file", "algo_id"]
     inlines = []
     form = MiscTileFormAdmin
+    cascade = [(StatsLayer, "misc_tile_id"), (Job, "misc_tile_id")]
+
+
+# =====================================================================================================================
+# Background jobs
+# =====================================================================================================================
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = [
+        "id",
+        "kind",
+        "state",
+        "progress",
+        "scene_id",
+        "misc_tile_id",
+        "attempts",
+        "created_at",
+        "finished_at",
+    ]
+    list_filter = ["state", "kind"]
+    fields = [
+        "kind",
+        "state",
+        "progress",
+        "scene_id",
+        "misc_tile_id",
+        "attempts",
+        "created_at",
+        "started_at",
+        "finished_at",
+        "payload",
+        "log",
+    ]
+    readonly_fields = fields
+    actions = ["retry"]
+
+    def has_add_permission(self, request):
+        return False
+
+    @action(description="Retry selected jobs")
+    def retry(self, request, queryset):
+        # Running jobs could be retried too, in case the worker was killed in the middle of a job
+        updated = queryset.filter(state__in=[Job.FAILED, Job.RUNNING]).update(state=Job.PENDING, progress=0)
+        self.message_user(request, f"{updated} job(s) have been scheduled again")
@@ -0,0 +1,341 @@
+"""
+Raw SQL used by the superpixels API. These queries are executed directly against PostGIS, so the heavy lifting
+(joining, reprojection and encoding) happens inside the database instead of in Python.
+"""
+import math
+import re
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+
+from django_spmc.spmc.models import SceneAlgo, StatsLayer, SuperPixel
+
+# Superpixels are stored both in EPSG:4326 (sp) and in the display srid (sp_display, filled after ingest). The stored
+# copy is used whenever the requested srid matches, rows which are not filled yet fall back to ST_Transform
+DISPLAY_SRID = SuperPixel.sp_display.field.srid
+WEB_MERCATOR_WIDTH = 40075016.685578488
+METRES_PER_DEGREE = 111320
+# Default precision of ST_AsGeoJSON
+GEOJSON_DIGITS = 9
+
+# Mapbox Vector Tile for a scene/algo pair joined with the labels of a single user. Geometries are clipped to the
+# tile envelope (web mercator) and the superpixel id is used as the MVT feature id. Simplified geometries matching the
+# tile resolution are used when available. Like in the other queries below, colors are only given for land classes of
+# the scene's project (LandClassification).
+SUPERPIXEL_MVT_SQL = """
+WITH bounds AS (
+    SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom_3857,
+           ST_Transform(ST_TileEnvelope(%(z)s, %(x)s, %(y)s), 4326) AS geom_4326
+),
+mvtgeom AS (
+    SELECT sp.id,
+           e.land_class_id_id AS land_class_id,
+           lc.color,
+           ST_AsMVTGeom(
+               COALESCE(s.geom, sp.sp_display, ST_Transform(sp.sp, 3857)),
+               bounds.geom_3857,
+               %(extent)s,
+               %(buffer)s,
+               true
+           ) AS geom
+    FROM spmc_superpixel sp
+    JOIN bounds ON sp.sp && bounds.geom_4326
+    LEFT JOIN spmc_superpixelsimplified s ON s.super_pixel_id_id = sp.id AND s.resolution = %(level)s
+    LEFT JOIN spmc_segmentationentry e
+        ON e.super_pixel_id_id = sp.id AND e.scene_id_id = sp.scene_id_id AND e.user_id_id = %(user_id)s
+    LEFT JOIN spmc_landclass lc ON lc.id = e.land_class_id_id AND lc.id IN (
+        SELECT lcf.land_class_id_id
+        FROM spmc_landclassification lcf
+        JOIN spmc_scene sc ON sc.proj_id_id = lcf.project_id_id
+        WHERE sc.id = %(scene_id)s
+    )
+    WHERE sp.scene_id_id = %(scene_id)s AND sp.algo_id_id = %(algo_id)s
+)
+SELECT ST_AsMVT(mvtgeom, %(layer)s, %(extent)s, 'geom', 'id') FROM mvtgeom
+"""
+
+# GeoJSON FeatureCollection of a scene/algo pair with the labels of a single user. Features only carry the id, labels
+# are added as a "labels" member (PAGE_LABELS_SQL) like in cached and TopoJSON documents. The whole document is built
+# by Postgres, so the response body could be passed to the client as is. Superpixels are optionally restricted to a
+# bbox (GiST index) and paginated by id: a page is selected first and only its rows are joined and encoded.
+# next_cursor is the last id of a full page, i.e. there may be more rows after it. If a resolution is requested,
+# geometries simplified at ingest time are used and coordinates are rounded accordingly.
+SUPERPIXEL_GEOJSON_SQL = """
+WITH page AS (
+    SELECT sp.id, sp.sp, sp.sp_display, sp.scene_id_id
+    FROM spmc_superpixel sp
+    WHERE sp.scene_id_id = %(scene_id)s AND sp.algo_id_id = %(algo_id)s {filters}
+    ORDER BY sp.id
+    LIMIT %(limit)s
+)
+SELECT json_build_object(
+    'type', 'FeatureCollection',
+    'features', COALESCE(
+        json_agg(
+            json_build_object(
+                'type', 'Feature',
+                'id', page.id,
+                'geometry', ST_AsGeoJSON({geometry}, %(digits)s)::json,
+                'properties', json_build_object('id', page.id)
+            )
+            ORDER BY page.id
+        ),
+        '[]'::json
+    ),
+    'next_cursor', CASE WHEN count(*) = %(limit)s THEN max(page.id) END{labels}
+)::text
+FROM page
+LEFT JOIN spmc_superpixelsimplified s ON s.super_pixel_id_id = page.id AND s.resolution = %(level)s
+LEFT JOIN spmc_segmentationentry e
+    ON e.super_pixel_id_id = page.id AND e.scene_id_id = page.scene_id_id AND e.user_id_id = %(user_id)s
+LEFT JOIN spmc_landclass lc ON lc.id = e.land_class_id_id AND lc.id IN (
+    SELECT lcf.land_class_id_id
+    FROM spmc_landclassification lcf
+    JOIN spmc_scene sc ON sc.proj_id_id = lcf.project_id_id
+    WHERE sc.id = %(scene_id)s
+)
+"""
+# Labels of the page in the same shape as SUPERPIXEL_LABELS_SQL
+PAGE_LABELS_SQL = """,
+    'labels', COALESCE(
+        json_object_agg(page.id, json_build_array(e.land_class_id_id, lc.color)) FILTER (WHERE e.id IS NOT NULL),
+        '{}'::json
+    )"""
+BBOX_FILTER_SQL = """
+    AND ST_Intersects(
+        sp.sp, ST_Transform(ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, %(srid)s), 4326)
+    )"""
+CURSOR_FILTER_SQL = " AND sp.id > %(cursor)s"
+DISPLAY_GEOMETRY_SQL = "COALESCE(s.geom, page.sp_display, ST_Transform(page.sp, %(srid)s))"
+TRANSFORM_GEOMETRY_SQL = "COALESCE(ST_Transform(s.geom, %(srid)s), ST_Transform(page.sp, %(srid)s))"
+
+# Labels of a single user for superpixels of a scene/algo pair: {"<superpixel id>": [land_class_id, color]}
+SUPERPIXEL_LABELS_SQL = """
+SELECT COALESCE(json_object_agg(e.super_pixel_id_id, json_build_array(e.land_class_id_id, lc.color)), '{}'::json)::text
+FROM spmc_segmentationentry e
+JOIN spmc_superpixel sp ON sp.id = e.super_pixel_id_id
+LEFT JOIN spmc_landclass lc ON lc.id = e.land_class_id_id AND lc.id IN (
+    SELECT lcf.land_class_id_id
+    FROM spmc_landclassification lcf
+    JOIN spmc_scene sc ON sc.proj_id_id = lcf.project_id_id
+    WHERE sc.id = %(scene_id)s
+)
+WHERE e.scene_id_id = %(scene_id)s AND e.user_id_id = %(user_id)s AND sp.algo_id_id = %(algo_id)s
+"""
+
+# Neighbours of a superpixel from the adjacency graph built at ingest time
+SUPERPIXEL_NEIGHBOURS_SQL = """
+SELECT COALESCE(array_agg(neighbour_id_id ORDER BY neighbour_id_id), '{}')
+FROM spmc_superpixeladjacency
+WHERE super_pixel_id_id = %(sp_id)s
+"""
+# Flood fill over the adjacency graph: neighbours are added while the Euclidean distance between their features and
+# the features of the seed superpixel (columns of a stats layer, 1-based) is within the tolerance. Superpixels without
+# statistics stop the fill. UNION drops rows which were already visited, so the recursion ends on cycles
+SUPERPIXEL_FILL_SQL = """
+WITH RECURSIVE seed AS (
+    SELECT features FROM spmc_superpixelstats WHERE layer_id_id = %(layer_id)s AND super_pixel_id_id = %(sp_id)s
+),
+fill(id) AS (
+    SELECT %(sp_id)s::bigint
+    UNION
+    SELECT adj.neighbour_id_id
+    FROM fill
+    JOIN spmc_superpixeladjacency adj ON adj.super_pixel_id_id = fill.id
+    JOIN spmc_superpixelstats st ON st.layer_id_id = %(layer_id)s AND st.super_pixel_id_id = adj.neighbour_id_id
+    CROSS JOIN seed
+    WHERE (
+        SELECT sqrt(sum((st.features[i] - seed.features[i]) ^ 2)) FROM unnest(%(columns)s::int[]) AS i
+    ) <= %(tolerance)s
+)
+SELECT COALESCE(array_agg(id), '{}') FROM (SELECT id FROM fill LIMIT %(limit)s) filled
+"""
+# Features of a stats layer compared by the flood fill: band means
+FILL_COLUMN_RE = re.compile(r"^b\d+_mean$")
+
+
+def simplified_level(resolution):
+    """
+    The coarsest simplification level (metres of the display srid) which is still not coarser than the resolution
+    :return: level or None if full geometries should be used
+    """
+    if resolution is None:
+        return None
+    levels = [level for level in settings.SPMC_SIMPLIFY_RESOLUTIONS if level <= resolution]
+    return max(levels) if levels else None
+
+
+def decimal_digits(resolution, srid):
+    """
+    Number of decimal digits which is enough to represent coordinates at the given resolution (metres)
+    """
+    if resolution is None:
+        return GEOJSON_DIGITS
+    units = resolution / METRES_PER_DEGREE if srid == 4326 else resolution
+    return min(max(0, math.ceil(-math.log10(units))), GEOJSON_DIGITS)
+
+
+def superpixel_geojson(
+    scene_id, algo_id, user_id, srid, bbox=None, cursor=None, limit=None, resolution=None, labels=True
+):
+    """
+    Build GeoJSON FeatureCollection with superpixels of a scene/algo pair and the user's labels ("labels" member)
+    :param bbox: optional xmin, ymin, xmax, ymax in srid, only intersecting superpixels are returned
+    :param cursor: return superpixels with id greater than the cursor (next_cursor of the previous page)
+    :param limit: page size, all superpixels are returned if not provided
+    :param resolution: target resolution in metres, geometries are simplified and quantized to it
+    :param labels: if False, the document has no "labels" member (geometry to be cached)
+    :return: serialized FeatureCollection as str
+    """
+    params = {
+        "scene_id": scene_id,
+        "algo_id": algo_id,
+        "user_id": user_id,
+        "srid": srid,
+        "limit": limit,
+        "level": simplified_level(resolution),
+        "digits": decimal_digits(resolution, srid),
+    }
+    filters = ""
+    if bbox is not None:
+        filters += BBOX_FILTER_SQL
+        params.update(zip(("xmin", "ymin", "xmax", "ymax"), bbox))
+    if cursor is not None:
+        filters += CURSOR_FILTER_SQL
+        params["cursor"] = cursor
+    with connection.cursor() as db_cursor:
+        geometry = DISPLAY_GEOMETRY_SQL if srid == DISPLAY_SRID else TRANSFORM_GEOMETRY_SQL
+        sql = SUPERPIXEL_GEOJSON_SQL.format(
+            filters=filters, geometry=geometry, labels=PAGE_LABELS_SQL if labels else ""
+        )
+        db_cursor.execute(sql, params)
+        return db_cursor.fetchone()[0]
+
+
+def superpixel_labels(scene_id, algo_id, user_id):
+    """
+    Labels of the user for superpixels of a scene/algo pair
+    :return: serialized JSON object as str
+    """
+    params = {"scene_id": scene_id, "algo_id": algo_id, "user_id": user_id}
+    with connection.cursor() as cursor:
+        cursor.execute(SUPERPIXEL_LABELS_SQL, params)
+        return cursor.fetchone()[0]
+
+
+def with_labels(document, scene_id, algo_id, user_id):
+    """
+    Add the user's labels to a serialized JSON object (geometry document) as a "labels" member
+    """
+    return f'{document[:-1]},"labels":{superpixel_labels(scene_id, algo_id, user_id)}}}'
+
+
+def cached_geometry(scene_id, algo_id, key, build):
+    """
+    Get a serialized geometry document of a scene/algo pair from SPMC_GEOMETRY_CACHE. Keys include the ingest version
+    of the pair, so a new ingest makes previous entries unreachable (they expire by timeout)
+    :param key: parts of the cache key describing the document (format, srid, etc.)
+    :param build: callable building the document on cache miss
+    :return: document as str or None if the pair is not in the catalogue (or the document could not be built)
+    """
+    version = SceneAlgo.objects.filter(scene_id=scene_id, algo_id=algo_id).values_list("version", flat=True).first()
+    if version is None:
+        return None
+    cache = caches[settings.SPMC_GEOMETRY_CACHE]
+    cache_key = ":".join(str(part) for part in ("spmc:geometry", scene_id, algo_id, version, *key))
+    document = cache.get(cache_key)
+    if document is None:
+        document = build()
+        if document is not None:
+            cache.set(cache_key, document, settings.SPMC_GEOMETRY_CACHE_TIMEOUT)
+    return document
+
+
+def superpixel_geojson_cached(scene_id, algo_id, user_id, srid, resolution=None):
+    """
+    GeoJSON FeatureCollection of the whole scene/algo pair. Geometry (without labels) is cached, the user's labels are
+    added as a "labels" member
+    :return: serialized document as str or None if the pair is not in the catalogue
+    """
+    key = ("geojson", srid, simplified_level(resolution), decimal_digits(resolution, srid))
+    document = cached_geometry(
+        scene_id,
+        algo_id,
+        key,
+        lambda: superpixel_geojson(scene_id, algo_id, None, srid, resolution=resolution, labels=False),
+    )
+    return with_labels(document, scene_id, algo_id, user_id) if document is not None else None
+
+
+def superpixel_topojson(scene_id, algo_id, user_id):
+    """
+    TopoJSON of a scene/algo pair built at ingest time (display srid) with the user's labels added as a "labels"
+    member, so the geometry is never touched at request time. The document is read from its file, it is not cached
+    :return: serialized document as str or None if there is no topology for the pair
+    """
+    pair = SceneAlgo.objects.filter(scene_id=scene_id, algo_id=algo_id).first()
+    if pair is None:
+        return None
+    try:
+        with open(pair.topology_path) as f:
+            document = f.read()
+    except FileNotFoundError:
+        # Not built yet or replaced by a newer version in the meantime
+        return None
+    return with_labels(document, scene_id, algo_id, user_id)
+
+
+def superpixel_mvt(scene_id, algo_id, user_id, z, x, y, layer="superpixels", extent=4096, buffer=64):
+    """
+    Render a single Mapbox Vector Tile with superpixels of a scene/algo pair and the user's labels
+    :return: encoded tile as bytes (empty if there is nothing inside the tile)
+    """
+    params = {
+        "scene_id": scene_id,
+        "algo_id": algo_id,
+        "user_id": user_id,
+        "z": z,
+        "x": x,
+        "y": y,
+        "layer": layer,
+        "extent": extent,
+        "buffer": buffer,
+        "level": simplified_level(WEB_MERCATOR_WIDTH / (256 * 2**z)),
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(SUPERPIXEL_MVT_SQL, params)
+        row = cursor.fetchone()
+    return bytes(row[0]) if row and row[0] is not None else b""
+
+
+def superpixel_neighbours(sp_id):
+    """
+    Ids of superpixels sharing a border with the superpixel
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(SUPERPIXEL_NEIGHBOURS_SQL, {"sp_id": sp_id})
+        return cursor.fetchone()[0]
+
+
+def superpixel_fill(sp_id, layer, tolerance, limit):
+    """
+    Flood fill from a superpixel over its neighbours with band means similar to its own
+    :param layer: StatsLayer of the superpixel's scene/algo pair
+    :param tolerance: maximum Euclidean distance between band means (raster values) of a superpixel and the seed
+    :param limit: maximum number of returned superpixels
+    :return: ids of filled superpixels, the seed is always included
+    """
+    columns = [i for i, name in enumerate(layer.columns, 1) if FILL_COLUMN_RE.match(name)]
+    params = {"sp_id": sp_id, "layer_id": layer.pk, "columns": columns, "tolerance": tolerance, "limit": limit}
+    with connection.cursor() as cursor:
+        cursor.execute(SUPERPIXEL_FILL_SQL, params)
+        return cursor.fetchone()[0]
+
+
+def scene_stats_layer(scene_id, algo_id):
+    """
+    Stats layer of a scene/algo pair computed from the scene raster
+    :return: StatsLayer or None if statistics are not computed
+    """
+    return StatsLayer.objects.filter(scene_id=scene_id, algo_id=algo_id, misc_tile_id=None).first()
@@ -1,10 +1,27 @@
-from django.contrib.gis.db.models.functions import AsGeoJSON, Transform
 from django.db.models import OuterRef, Subquery
+from django.http import HttpResponse
 from rest_framework import authentication, viewsets
-from rest_framework.decorators import action
+from rest_framework.decorators import action, api_view, authentication_classes
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.response import Response
 
-from django_spmc.spmc.models import LandClass, LandClassification, Scene, SegmentationEntry, SuperPixel
+from django_spmc.spmc.api.queries import (
+    DISPLAY_SRID,
+    scene_stats_layer,
+    superpixel_fill,
+    superpixel_geojson,
+    superpixel_geojson_cached,
+    superpixel_mvt,
+    superpixel_neighbours,
+    superpixel_topojson,
+)
+from django_spmc.spmc.models import LandClass, Scene, SceneAlgo, SegmentationEntry, SuperPixel
+
+MVT_CONTENT_TYPE = "application/vnd.mapbox-vector-tile"
+MVT_MAX_ZOOM = 24
+GET_SP_MAX_LIMIT = 50000
+FILL_DEFAULT_LIMIT = 500
+FILL_MAX_LIMIT = 5000
 
 
 class GetUserSuperpixels(viewsets.ViewSet):
@@ -13,54 +30,221 @@ class GetUserSuperpixels(viewsets.ViewSet):
     @action(detail=False, methods=["post"])
     def get_sp(self, request):
         # TODO replace most of this with session data, as we store project, scene and algo in session
-        srid = self.request.data.get("srid")
-        user_id = self.request.user.id
-        scene_id = self.request.data.get("scene_id")
-        algo_id = self.request.data.get("algo_id")
-        proj_id = Scene.objects.get(id=scene_id).proj_id
-
-        # Get all Superpixels for given scene
-        entries = SegmentationEntry.objects.filter(
-            super_pixel_id=OuterRef("pk"), scene_id__id=scene_id, user_id__id=user_id
+        srid = _as_int(request.data.get("srid"))
+        scene_id = _as_int(request.data.get("scene_id"))
+        algo_id = _as_int(request.data.get("algo_id"))
+        if srid is None or scene_id is None or algo_id is None:
+            raise ValidationError("srid, scene_id and algo_id are required")
+        if request.data.get("format") == "topojson":
+            # Shared-arc encoding of the whole scene, built at ingest time in the display srid only
+            if srid != DISPLAY_SRID:
+                raise ValidationError(f"topojson is available for srid {DISPLAY_SRID} only")
+            topojson = superpixel_topojson(scene_id, algo_id, request.user.id)
+            if topojson is None:
+                raise NotFound("Topology of the scene is not built")
+            return HttpResponse(topojson, content_type="application/json")
+        # Optional viewport (in srid) and keyset pagination
+        bbox = request.data.get("bbox")
+        if bbox is not None:
+            bbox = [_as_float(v) for v in bbox] if isinstance(bbox, list) else []
+            if len(bbox) != 4 or None in bbox:
+                raise ValidationError("bbox should be a list of xmin, ymin, xmax, ymax")
+        cursor = request.data.get("cursor")
+        limit = request.data.get("limit")
+        if cursor is not None and _as_int(cursor) is None:
+            raise ValidationError("cursor should be an integer")
+        if limit is not None and not 0 < (_as_int(limit) or 0) <= GET_SP_MAX_LIMIT:
+            raise ValidationError(f"limit should be an integer between 1 and {GET_SP_MAX_LIMIT}")
+        # Optional target resolution (metres per pixel) for simplified and quantized geometries
+        resolution = request.data.get("resolution")
+        if resolution is not None and not (_as_float(resolution) or 0) > 0:
+            raise ValidationError("resolution should be a positive number")
+
+        if bbox is None and cursor is None and limit is None:
+            # Geometry of the whole scene is cached, only the user's labels are queried
+            features = superpixel_geojson_cached(
+                scene_id, algo_id, request.user.id, srid, resolution=_as_float(resolution)
+            )
+            if features is not None:
+                return HttpResponse(features, content_type="application/json")
+        # FeatureCollection is serialized by Postgres, so there is nothing left to do but pass it through
+        features = superpixel_geojson(
+            scene_id,
+            algo_id,
+            request.user.id,
+            srid,
+            bbox=bbox,
+            cursor=_as_int(cursor),
+            limit=_as_int(limit),
+            resolution=_as_float(resolution),
+        )
+        return HttpResponse(features, content_type="application/json")
+
+    @action(detail=False, methods=["get"])
+    def catalogue(self, request):
+        """
+        Scene/algo pairs of a project with superpixels count, bounding box (EPSG:4326) and area
+        """
+        proj_id = _as_int(request.query_params.get("proj_id"))
+        if proj_id is None:
+            raise ValidationError("proj_id is required")
+        pairs = SceneAlgo.objects.filter(scene_id__proj_id=proj_id, sp_count__gt=0).order_by("scene_id", "algo_id")
+        return Response(
+            [
+                {
+                    "scene_id": pair.scene_id_id,
+                    "algo_id": pair.algo_id_id,
+                    "sp_count": pair.sp_count,
+                    "bbox": pair.bbox.extent if pair.bbox else None,
+                    "area": pair.area,
+                }
+                for pair in pairs
+            ]
         )
-        colors = LandClass.objects.filter(
-            id__in=LandClassification.objects.filter(project_id=proj_id).values_list("land_class_id")
-        ).filter(id=OuterRef("land_class_id"))
-        sp = (
-            SuperPixel.objects.filter(scene_id__id=scene_id, algo_id__id=algo_id)
-            .annotate(land_class_id=Subquery(entries.values("land_class_id")))
-            .annotate(entry_id=Subquery(entries.values("id")))
-            .annotate(color=Subquery(colors.values("color")))
-            # Here is a fastest version of geojson serialization (need processing on js side)
-            .annotate(features=AsGeoJSON(Transform("sp", srid)))
-        ).values("id", "land_class_id", "color", "features")
-        return Response(sp)
 
     @action(detail=False, methods=["post"], name="save-sp")
     def save_sp(self, request):
-        upd_list = request.data.get("upd")
+        upd_list = request.data.get("upd") or []
+        user_id = request.user.id
+        if not isinstance(upd_list, list):
+            raise ValidationError("upd should be a list")
+
+        # Validate the whole batch with one query per referenced table
+        sp_ids, class_ids = set(), set()
         for entry in upd_list:
-            user_id = request.user.id
-            scene_id = entry.get("scene_id")
-            sp_id = entry.get("superpixel_id")
-            land_class_id = entry.get("class_id")
-
-            # Check if such entry is already in database
-            obj = SegmentationEntry.objects.filter(
-                scene_id__id=scene_id, super_pixel_id__id=sp_id, user_id__id=user_id
-            )
-            if obj.exists():
-                # This is an update case
-                obj = obj.get()
-                obj.land_class_id = LandClass(id=land_class_id)
-                obj.save()
+            if not isinstance(entry, dict):
+                continue
+            sp_ids.add(_as_int(entry.get("superpixel_id")))
+            class_ids.add(_as_int(entry.get("class_id")))
+        sp_scenes = dict(SuperPixel.objects.filter(id__in=sp_ids - {None}).values_list("id", "scene_id"))
+        known_classes = set(LandClass.objects.filter(id__in=class_ids - {None}).values_list("id", flat=True))
+
+        entries, rejected = {}, []
+        for index, entry in enumerate(upd_list):
+            if not isinstance(entry, dict):
+                rejected.append({"index": index, "superpixel_id": None, "error": "Item should be an object"})
+                continue
+            scene_id = _as_int(entry.get("scene_id"))
+            sp_id = _as_int(entry.get("superpixel_id"))
+            land_class_id = _as_int(entry.get("class_id"))
+            if sp_id not in sp_scenes:
+                error = "Unknown superpixel"
+            elif sp_scenes[sp_id] != scene_id:
+                error = "Superpixel does not belong to the scene"
+            elif land_class_id not in known_classes:
+                error = "Unknown land class"
             else:
-                # This is a creation case
-                SegmentationEntry(
-                    user_id=request.user,
-                    super_pixel_id=SuperPixel.objects.get(id=sp_id),
-                    scene_id=Scene.objects.get(id=scene_id),
-                    land_class_id=LandClass.objects.get(id=land_class_id),
-                ).save()
-
-        return Response({"code": "done"})
+                # The last assignment wins if the same superpixel was sent several times
+                entries[(scene_id, sp_id)] = SegmentationEntry(
+                    scene_id_id=scene_id, super_pixel_id_id=sp_id, land_class_id_id=land_class_id, user_id_id=user_id
+                )
+                continue
+            rejected.append({"index": index, "superpixel_id": entry.get("superpixel_id"), "error": error})
+
+        # Every batch gets the next label revision of its scene(s), scenes are locked in id order to avoid deadlocks
+        revisions = {
+            scene_id: Scene(pk=scene_id).next_label_revision() for scene_id in sorted({key[0] for key in entries})
+        }
+        for (scene_id, _), entry in entries.items():
+            entry.revision = revisions[scene_id]
+
+        # Single INSERT ... ON CONFLICT DO UPDATE for all valid entries
+        SegmentationEntry.objects.bulk_create(
+            entries.values(),
+            update_conflicts=True,
+            unique_fields=["scene_id", "user_id", "super_pixel_id"],
+            update_fields=["land_class_id", "updated_at", "revision"],
+        )
+        return Response({"code": "done", "saved": len(entries), "rejected": rejected, "revisions": revisions})
+
+    @action(detail=False, methods=["get"])
+    def changes(self, request):
+        """
+        Labels of the user changed after the given revision of the scene. Without "since" only the current
+        revision is returned, the client should take it before loading the scene
+        """
+        scene_id = _as_int(request.query_params.get("scene_id"))
+        algo_id = _as_int(request.query_params.get("algo_id"))
+        since = request.query_params.get("since")
+        if scene_id is None or algo_id is None:
+            raise ValidationError("scene_id and algo_id are required")
+        if since is not None and _as_int(since) is None:
+            raise ValidationError("since should be an integer")
+        revision = Scene.objects.filter(id=scene_id).values_list("label_revision", flat=True).first()
+        if revision is None:
+            raise NotFound("Unknown scene")
+        changes = []
+        if since is not None:
+            changes = list(
+                SegmentationEntry.objects.filter(
+                    scene_id=scene_id,
+                    user_id=request.user.id,
+                    revision__gt=_as_int(since),
+                    super_pixel_id__algo_id=algo_id,
+                )
+                .annotate(
+                    color=Subquery(
+                        LandClass.objects.filter(
+                            id=OuterRef("land_class_id"), landclassification__project_id__scene=scene_id
+                        ).values("color")[:1]
+                    )
+                )
+                .values_list("super_pixel_id", "land_class_id", "color")
+            )
+        return Response({"revision": revision, "changes": changes})
+
+    @action(detail=False, methods=["get"])
+    def neighbours(self, request):
+        """
+        Superpixels sharing a border with a superpixel or, if a tolerance is given, a flood fill from it over
+        neighbours with similar band means (zonal statistics of the scene raster). The client labels all returned
+        superpixels with a single save_sp call
+        """
+        scene_id = _as_int(request.query_params.get("scene_id"))
+        algo_id = _as_int(request.query_params.get("algo_id"))
+        sp_id = _as_int(request.query_params.get("sp_id"))
+        if scene_id is None or algo_id is None or sp_id is None:
+            raise ValidationError("scene_id, algo_id and sp_id are required")
+        tolerance = request.query_params.get("tolerance")
+        if tolerance is not None:
+            tolerance = _as_float(tolerance)
+            if tolerance is None or not tolerance >= 0:
+                raise ValidationError("tolerance should be a non-negative number")
+        limit = request.query_params.get("limit", FILL_DEFAULT_LIMIT)
+        if not 0 < (_as_int(limit) or 0) <= FILL_MAX_LIMIT:
+            raise ValidationError(f"limit should be an integer between 1 and {FILL_MAX_LIMIT}")
+        if not SuperPixel.objects.filter(id=sp_id, scene_id=scene_id, algo_id=algo_id).exists():
+            raise NotFound("Unknown superpixel")
+        if tolerance is None:
+            return Response({"ids": superpixel_neighbours(sp_id)})
+        layer = scene_stats_layer(scene_id, algo_id)
+        if layer is None:
+            raise NotFound("Statistics of the scene are not computed")
+        return Response({"ids": superpixel_fill(sp_id, layer, tolerance, _as_int(limit))})
+
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+@api_view(["GET"])
+@authentication_classes([authentication.SessionAuthentication])
+def superpixel_tile(request, scene_id, algo_id, z, x, y):
+    """
+    Serve superpixels of a scene/algo pair as a Mapbox Vector Tile, so the client can load them by viewport.
+    Every feature carries the superpixel id, and the user's land_class_id and color (null if not classified yet)
+    """
+    if z > MVT_MAX_ZOOM or x >= 2**z or y >= 2**z:
+        raise NotFound("Tile is out of range")
+    tile = superpixel_mvt(scene_id, algo_id, request.user.id, z, x, y)
+    return HttpResponse(tile, content_type=MVT_CONTENT_TYPE)
@@ -0,0 +1,234 @@
+"""
+DB-backed background jobs. Long-running ingest tasks are stored as Job rows by the admin and executed by the
+spmc_worker management command outside the request/response cycle
+"""
+import logging
+import os
+import shutil
+import time
+import traceback
+
+from django.conf import settings
+from django.contrib.gis.geos import Polygon
+from django.core.exceptions import ValidationError
+from django.core.files.move import file_move_safe
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import COG, MBTILES, Job, MiscTile, SuperPixelAlgo, TilingSettings, remove_tiles
+from .segmentation import segment_raster
+from .stats import compute_stats
+from .tiles import build_cog, pack_mbtiles, tile_cache
+from .utils import handle_tiles_upload, new_staging_dir, raster_bbox, replace_superpixels
+
+logger = logging.getLogger(__name__)
+
+
+def stage_upload(f_obj):
+    """
+    Move an uploaded file to the staging area shared by the web and worker processes. Files spooled to disk by
+    TemporaryFileUploadHandler are moved (renamed on the same file system), others are written once
+    :return: path of the staged file
+    """
+    path = os.path.join(new_staging_dir(), os.path.basename(f_obj.name))
+    if hasattr(f_obj, "temporary_file_path"):
+        file_move_safe(f_obj.temporary_file_path(), path)
+    else:
+        with open(path, "wb") as dst:
+            for chunk in f_obj.chunks():
+                dst.write(chunk)
+    return path
+
+
+def discard_staged(path):
+    # Only remove folders created by stage_upload or new_staging_dir
+    if path and os.path.dirname(os.path.dirname(path)) == os.path.normpath(settings.SPMC_STAGING_ROOT):
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
+def enqueue(kind, target, **payload):
+    """
+    Schedule a job for a Scene or MiscTile object
+    """
+    if isinstance(target, MiscTile):
+        return Job.objects.create(kind=kind, misc_tile_id=target, payload=payload)
+    return Job.objects.create(kind=kind, scene_id=target, payload=payload)
+
+
+# =====================================================================================================================
+# Job handlers
+# =====================================================================================================================
+def process_tiles(job):
+    target = job.target
+    tiling = TilingSettings.for_target(target)
+    started = time.monotonic()
+    if tiling.backend == COG:
+        job.report(message="Converting raster into Cloud-Optimized GeoTIFF")
+        output_dir = build_cog(job.payload["path"], target.uuid, tiling, progress=job.report)
+        poly = raster_bbox(job.payload["path"], type(target).bbox.field.srid)
+        # Drop tiles rendered from the previous raster
+        tile_cache.clear(target.uuid)
+        target.tile_format = "png"
+    else:
+        job.report(message=f"Tiling with gdal2tiles {' '.join(tiling.gdal2tiles_args())}")
+        output_dir, bbox, srid, err = handle_tiles_upload(
+            job.payload["path"], target.uuid, tiling=tiling, progress=job.report
+        )
+        if err is not None:
+            raise RuntimeError(err)
+        poly = Polygon.from_bbox(bbox)
+        poly.srid = srid
+        poly.transform(type(target).bbox.field.srid)
+        target.tile_format = tiling.tile_format.lower()
+        if tiling.backend == MBTILES:
+            job.report(message="Packing tiles into MBTiles archive")
+            bounds = poly.transform(4326, clone=True).extent
+            archive = pack_mbtiles(output_dir, f"{output_dir}.mbtiles", target.tile_format, bounds, name=target.name)
+            shutil.rmtree(output_dir)
+            output_dir = archive
+    job.report(message=f"Tiling took {time.monotonic() - started:.1f} s")
+    if target.tiles_path and target.tiles_path != output_dir:
+        # Backend has changed, drop tiles of the previous one
+        remove_tiles(target.tiles_path)
+    target.tiles_path = output_dir
+    target.tiles_backend = tiling.backend
+    target.bbox = poly
+    target.save(update_fields=["tiles_path", "tile_format", "tiles_backend", "bbox"])
+    job.report(message=f"Tiles for {target} have been processed and saved to {output_dir}")
+
+
+def process_superpixels(job):
+    scene = job.scene_id
+    algo = SuperPixelAlgo.objects.get(id=job.payload["algo_id"])
+    job.report(message="Validating and writing superpixels")
+    created = replace_superpixels(scene, algo, job.payload["path"], progress=job.report)
+    job.report(message=f"{created} superpixels have been saved for {scene}")
+    # Statistics of new superpixels, if the raster was uploaded together with them
+    if job.payload.get("raster"):
+        enqueue(Job.STATS, scene, path=job.payload["raster"], algo_id=algo.id)
+
+
+def process_segmentation(job):
+    scene = job.scene_id
+    algo = SuperPixelAlgo.objects.get(id=job.payload["algo_id"])
+    job.report(message=f"Generating superpixels with {algo.get_method_display()} {algo.params}")
+    work_dir = new_staging_dir()
+    try:
+        polygons_path = segment_raster(
+            job.payload["path"],
+            algo.method,
+            algo.params,
+            work_dir,
+            processes=settings.SPMC_SEGMENTATION_PROCESSES,
+            progress=job.report,
+        )
+        job.report(message="Writing superpixels")
+        created = replace_superpixels(scene, algo, polygons_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    job.report(message=f"{created} superpixels have been generated for {scene}")
+    enqueue(Job.STATS, scene, path=job.payload["path"], algo_id=algo.id)
+
+
+def process_stats(job):
+    target = job.target
+    misc_tile = target if isinstance(target, MiscTile) else None
+    scene = misc_tile.scene_id if misc_tile else target
+    if "algo_id" in job.payload:
+        algos = SuperPixelAlgo.objects.filter(id=job.payload["algo_id"])
+    else:
+        # All algorithms which have superpixels in the scene
+        algos = SuperPixelAlgo.objects.filter(scenealgo__scene_id=scene, scenealgo__sp_count__gt=0)
+    work_dir = new_staging_dir()
+    try:
+        for algo in algos:
+            created = compute_stats(scene, algo, job.payload["path"], work_dir, misc_tile=misc_tile)
+            job.report(message=f"Statistics of {created} superpixels of {algo} have been saved")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def sweep_trash(job):
+    # Everything in the trash belongs to deleted objects, including leftovers of earlier sweeps
+    if not os.path.isdir(settings.SPMC_TRASH_ROOT):
+        return
+    removed = 0
+    for entry in os.scandir(settings.SPMC_TRASH_ROOT):
+        remove_tiles(entry.path)
+        removed += 1
+    job.report(message=f"{removed} deleted tile sets have been removed")
+
+
+def evict_tile_cache(job):
+    removed = tile_cache.evict()
+    job.report(message=f"{removed} cached tiles have been removed")
+
+
+JOB_HANDLERS = {
+    Job.TILES: process_tiles,
+    Job.SUPERPIXELS: process_superpixels,
+    Job.SWEEP_TRASH: sweep_trash,
+    Job.SEGMENTATION: process_segmentation,
+    Job.STATS: process_stats,
+    Job.EVICT_TILE_CACHE: evict_tile_cache,
+}
+
+
+# =====================================================================================================================
+# Worker
+# =====================================================================================================================
+def claim_job():
+    """
+    Take the oldest pending job. Rows locked by other workers are skipped, so several workers could poll the same
+    table without stepping on each other
+    """
+    with transaction.atomic():
+        job = Job.objects.select_for_update(skip_locked=True).filter(state=Job.PENDING).order_by("created_at").first()
+        if job is None:
+            return None
+        job.state = Job.RUNNING
+        job.attempts += 1
+        job.progress = 0
+        job.started_at = timezone.now()
+        job.finished_at = None
+        job.save(update_fields=["state", "attempts", "progress", "started_at", "finished_at"])
+    return job
+
+
+def run_job(job):
+    job.report(message=f"Attempt {job.attempts} started")
+    try:
+        JOB_HANDLERS[job.kind](job)
+    except ValidationError as e:
+        # Invalid input (e.g. superpixels outside of the scene), the message is enough to fix it
+        job.report(message=f"Invalid input: {' '.join(e.messages)}")
+        Job.objects.filter(pk=job.pk).update(state=Job.FAILED, finished_at=timezone.now())
+    except Exception:
+        logger.exception("%s failed", job)
+        job.report(message=traceback.format_exc())
+        Job.objects.filter(pk=job.pk).update(state=Job.FAILED, finished_at=timezone.now())
+    else:
+        Job.objects.filter(pk=job.pk).update(state=Job.DONE, progress=100, finished_at=timezone.now())
+        # Staged files are kept for failed jobs, so they could be retried. A raster is shared by tiling,
+        # segmentation and statistics jobs, it is removed by the last of them
+        path = job.payload.get("path")
+        unfinished = Job.objects.filter(Q(payload__path=path) | Q(payload__raster=path)).exclude(state=Job.DONE)
+        if path and not unfinished.exists():
+            discard_staged(path)
+
+
+def work(poll_interval=2.0, once=False):
+    """
+    Worker loop: run pending jobs one by one, sleep when the queue is empty
+    :param once: exit as soon as there are no pending jobs
+    """
+    while True:
+        close_old_connections()
+        job = claim_job()
+        if job is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+        run_job(job)
@@ -0,0 +1,133 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from django_spmc.spmc.api.queries import SUPERPIXEL_GEOJSON_SQL, SUPERPIXEL_LABELS_SQL, superpixel_geojson
+from django_spmc.spmc.models import LandClass, Project, Scene, SegmentationEntry, SuperPixelAlgo
+
+# Grid of small squares near (37, 55), every superpixel is a 0.0001 degree cell
+SYNTHETIC_SUPERPIXELS_SQL = """
+INSERT INTO spmc_superpixel (scene_id_id, algo_id_id, sp, sp_display)
+SELECT %(scene_id)s, %(algo_id)s, cell, ST_Transform(cell, 3857)
+FROM (
+    SELECT ST_MakeEnvelope(
+        37 + (i %% %(side)s) * 0.0001, 55 + (i / %(side)s) * 0.0001,
+        37 + (i %% %(side)s + 1) * 0.0001, 55 + (i / %(side)s + 1) * 0.0001,
+        4326
+    ) AS cell
+    FROM generate_series(0, %(count)s - 1) AS i
+) cells
+"""
+# Every user labels every superpixel of the scene (up to the requested number of entries)
+SYNTHETIC_ENTRIES_SQL = """
+INSERT INTO spmc_segmentationentry
+    (scene_id_id, super_pixel_id_id, land_class_id_id, user_id_id, created_at, updated_at, revision)
+SELECT sp.scene_id_id, sp.id, (%(classes)s::bigint[])[1 + sp.id %% 2], u.id, now(), now(), 0
+FROM spmc_superpixel sp
+CROSS JOIN unnest(%(users)s::bigint[]) AS u(id)
+WHERE sp.scene_id_id = %(scene_id)s
+LIMIT %(count)s
+"""
+# The same statement as the one generated by bulk_create in save_sp
+SAVE_SP_SQL = """
+INSERT INTO spmc_segmentationentry
+    (scene_id_id, super_pixel_id_id, land_class_id_id, user_id_id, created_at, updated_at, revision)
+SELECT %(scene_id)s, sp_id, %(class_id)s, %(user_id)s, now(), now(), 1
+FROM unnest(%(sp_ids)s::bigint[]) AS sp_id
+ON CONFLICT (scene_id_id, user_id_id, super_pixel_id_id) DO UPDATE
+SET land_class_id_id = EXCLUDED.land_class_id_id, updated_at = EXCLUDED.updated_at, revision = EXCLUDED.revision
+"""
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Show query plans and timings of get_sp and save_sp queries against a synthetic SegmentationEntry table. "
+        "Synthetic data is created in a transaction which is rolled back at the end"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--entries", type=int, default=5_000_000, help="Number of segmentation entries")
+        parser.add_argument("--users", type=int, default=25, help="Number of annotators")
+        parser.add_argument("--page", type=int, default=5000, help="get_sp page size")
+        parser.add_argument("--batch", type=int, default=500, help="save_sp batch size")
+
+    def explain(self, title, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {sql}", params)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        self.stdout.write(self.style.MIGRATE_HEADING(title))
+        self.stdout.write(plan)
+
+    def timed(self, title, func, repeat=5):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+        self.stdout.write(f"{title}: best {min(timings) * 1000:.1f} ms, worst {max(timings) * 1000:.1f} ms")
+
+    def handle(self, *args, **options):
+        users_count = max(options["users"], 1)
+        sp_count = -(-options["entries"] // users_count)
+        try:
+            with transaction.atomic():
+                self.run(sp_count, users_count, options)
+                raise Rollback
+        except Rollback:
+            self.stdout.write("Synthetic data has been rolled back")
+
+    def run(self, sp_count, users_count, options):
+        project = Project.objects.create(name="Benchmark project")
+        scene = Scene.objects.create(proj_id=project, name="Benchmark scene")
+        algo = SuperPixelAlgo.objects.create(name="Benchmark algorithm")
+        classes = [LandClass.objects.create(name=f"Benchmark class {i}", color="#000000").pk for i in range(2)]
+        users = [get_user_model().objects.create(email=f"benchmark-{i}@example.com").pk for i in range(users_count)]
+
+        started = time.perf_counter()
+        with connection.cursor() as cursor:
+            side = int(sp_count**0.5) + 1
+            params = {"scene_id": scene.pk, "algo_id": algo.pk, "side": side, "count": sp_count}
+            cursor.execute(SYNTHETIC_SUPERPIXELS_SQL, params)
+            params = {"scene_id": scene.pk, "classes": classes, "users": users, "count": options["entries"]}
+            cursor.execute(SYNTHETIC_ENTRIES_SQL, params)
+            cursor.execute("ANALYZE spmc_superpixel")
+            cursor.execute("ANALYZE spmc_segmentationentry")
+        entries = SegmentationEntry.objects.filter(scene_id=scene).count()
+        self.stdout.write(
+            f"Created {sp_count} superpixels and {entries} entries in {time.perf_counter() - started:.1f} s"
+        )
+
+        user_id = users[len(users) // 2]
+        params = {
+            "scene_id": scene.pk,
+            "algo_id": algo.pk,
+            "user_id": user_id,
+            "srid": 3857,
+            "limit": options["page"],
+            "level": None,
+            "digits": 9,
+        }
+        sql = SUPERPIXEL_GEOJSON_SQL.format(filters="", geometry="page.sp_display")
+        self.explain("get_sp: first page of superpixels with labels", sql, params)
+        self.explain("get_sp: labels of a user", SUPERPIXEL_LABELS_SQL, params)
+        batch = options["batch"]
+        sp_ids = list(scene.superpixel_set.order_by("?").values_list("id", flat=True)[:batch])
+        save_params = {"scene_id": scene.pk, "class_id": classes[0], "user_id": user_id, "sp_ids": sp_ids}
+        self.explain("save_sp: upsert of a batch", SAVE_SP_SQL, save_params)
+
+        self.timed(
+            "get_sp page",
+            lambda: superpixel_geojson(scene.pk, algo.pk, user_id, 3857, limit=options["page"]),
+        )
+
+        def save_sp():
+            with connection.cursor() as cursor:
+                cursor.execute(SAVE_SP_SQL, save_params)
+
+        self.timed("save_sp batch", save_sp)
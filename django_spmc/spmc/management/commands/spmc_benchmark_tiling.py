@@ -0,0 +1,41 @@
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from django_spmc.spmc.models import TilingSettings
+from django_spmc.spmc.utils import run_gdal_command
+
+
+class Command(BaseCommand):
+    help = "Measure gdal2tiles wall time of a raster for different numbers of worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("raster", help="Path to a raster file")
+        parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4], help="Process counts to try")
+        parser.add_argument("--min-zoom", type=int, default=10)
+        parser.add_argument("--max-zoom", type=int, default=18)
+        parser.add_argument("--resampling", default="bilinear")
+        parser.add_argument("--tile-format", default="PNG")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'processes':>10} {'wall time, s':>14}")
+        for processes in options["processes"]:
+            tiling = TilingSettings(
+                min_zoom=options["min_zoom"],
+                max_zoom=options["max_zoom"],
+                resampling=options["resampling"],
+                processes=processes,
+                tile_format=options["tile_format"],
+            )
+            output_dir = tempfile.mkdtemp()
+            try:
+                started = time.monotonic()
+                run_gdal_command(
+                    ["gdal2tiles.py", *tiling.gdal2tiles_args(), "-w", "none", "--xyz", options["raster"], output_dir]
+                )
+                elapsed = time.monotonic() - started
+            finally:
+                shutil.rmtree(output_dir, ignore_errors=True)
+            self.stdout.write(f"{processes:>10} {elapsed:>14.1f}")
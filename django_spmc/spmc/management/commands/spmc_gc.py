@@ -0,0 +1,125 @@
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from django_spmc.spmc.models import Job, MiscTile, Scene, remove_tiles
+
+
+def _is_uuid(name):
+    try:
+        uuid.UUID(name)
+    except ValueError:
+        return False
+    return True
+
+
+def _entry_uuid(name):
+    # Tiles are stored as <uuid>/, <uuid>.mbtiles or <uuid>.mbtiles.tmp while being packed
+    return name.split(".", 1)[0]
+
+
+def _size(path):
+    if not os.path.isdir(path):
+        try:
+            return os.lstat(path).st_size
+        except FileNotFoundError:
+            return 0
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def _scan(root, min_age):
+    """
+    Top level entries of a folder which have not been modified for min_age seconds
+    """
+    if not os.path.isdir(root):
+        return []
+    deadline = time.time() - min_age
+    entries = []
+    for entry in os.scandir(root):
+        try:
+            if entry.stat(follow_symlinks=False).st_mtime <= deadline:
+                entries.append(entry)
+        except FileNotFoundError:
+            continue
+    return entries
+
+
+def _remove(path):
+    # Entries could disappear in the meantime, e.g. trash emptied by a sweep job
+    try:
+        remove_tiles(path)
+    except OSError as e:
+        return f"{path}: {e}"
+    return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Remove tiles, cached tiles, staged uploads and temporary folders which do not belong to any Scene, MiscTile "
+        "or unfinished Job. Entries modified recently are skipped, so the command is safe to run on a live system"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report what would be removed")
+        parser.add_argument(
+            "--min-age", type=float, default=24, help="Skip entries modified less than this number of hours ago"
+        )
+        parser.add_argument("--workers", type=int, default=8, help="Number of threads removing files")
+        parser.add_argument(
+            "--tmp-root",
+            default=tempfile.gettempdir(),
+            help="Folder with leftovers of raster checks (uuid-named folders) of older versions",
+        )
+
+    def find_orphans(self, min_age, tmp_root):
+        tiles_root = os.path.join(settings.MEDIA_ROOT, "tiles")
+        # The file system is listed before the database is read: anything created after the listing is not a
+        # candidate, and objects created during the listing are already visible to the queries below
+        listing = {
+            "tiles": _scan(tiles_root, min_age),
+            "cache": _scan(settings.SPMC_TILE_CACHE_ROOT, min_age),
+            "staging": _scan(settings.SPMC_STAGING_ROOT, min_age),
+            "trash": _scan(settings.SPMC_TRASH_ROOT, min_age),
+            "tmp": [entry for entry in _scan(tmp_root, min_age) if _is_uuid(entry.name)],
+        }
+        live = set()
+        for model in (Scene, MiscTile):
+            live.update(model.objects.exclude(uuid=None).values_list("uuid", flat=True))
+        # Failed jobs keep their staged files for a retry, a raster uploaded with superpixels is referenced as "raster"
+        unfinished = Job.objects.exclude(state=Job.DONE).values_list("payload__path", "payload__raster")
+        staged = {os.path.normpath(os.path.dirname(path)) for paths in unfinished for path in paths if path}
+
+        orphans = []
+        for source, entries in listing.items():
+            for entry in entries:
+                if source in ("tiles", "cache", "tmp") and _entry_uuid(entry.name) in live:
+                    continue
+                if source == "staging" and os.path.normpath(entry.path) in staged:
+                    continue
+                orphans.append((source, entry.path))
+        return orphans
+
+    def handle(self, *args, **options):
+        orphans = self.find_orphans(options["min_age"] * 3600, options["tmp_root"])
+        with ThreadPoolExecutor(max_workers=max(options["workers"], 1)) as pool:
+            sizes = list(pool.map(_size, [path for _, path in orphans]))
+            for (source, path), size in zip(orphans, sizes):
+                self.stdout.write(f"{source}: {path} ({size / 1024**2:.1f} MiB)")
+            if not options["dry_run"]:
+                for error in pool.map(_remove, [path for _, path in orphans]):
+                    if error:
+                        self.stderr.write(f"Could not remove {error}")
+        verb = "could be reclaimed" if options["dry_run"] else "have been reclaimed"
+        self.stdout.write(self.style.SUCCESS(f"{len(orphans)} entries, {sum(sizes) / 1024**2:.1f} MiB {verb}"))
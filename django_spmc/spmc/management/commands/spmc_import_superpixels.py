@@ -0,0 +1,37 @@
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from django_spmc.spmc.models import Scene, SuperPixelAlgo
+from django_spmc.spmc.utils import replace_superpixels
+
+
+class Command(BaseCommand):
+    help = (
+        "Replace superpixels of a scene and algorithm with polygons of a GeoJSON file or any vector dataset readable "
+        "by OGR (GeoPackage, FlatGeobuf, Shapefile or zipped Shapefile)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("scene", type=int, help="Scene id")
+        parser.add_argument("algo", type=int, help="Superpixel algorithm id")
+        parser.add_argument("path", help="Vector file with superpixel polygons")
+        parser.add_argument("--batch-size", type=int, default=50_000, help="Number of polygons written at once")
+
+    def handle(self, *args, **options):
+        try:
+            scene = Scene.objects.get(pk=options["scene"])
+            algo = SuperPixelAlgo.objects.get(pk=options["algo"])
+        except (Scene.DoesNotExist, SuperPixelAlgo.DoesNotExist) as e:
+            raise CommandError(e)
+        started = time.monotonic()
+        try:
+            created = replace_superpixels(scene, algo, options["path"], batch_size=options["batch_size"])
+        except ValidationError as e:
+            raise CommandError("; ".join(e.messages))
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{created} superpixels have been saved for {scene} in {time.monotonic() - started:.1f} s"
+            )
+        )
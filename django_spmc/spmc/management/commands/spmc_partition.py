@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from django_spmc.spmc import partitioning
+
+
+class Command(BaseCommand):
+    help = (
+        "Convert superpixel and segmentation entry tables into tables partitioned by scene. Tables are rewritten "
+        "in a single transaction, so run it during a maintenance window"
+    )
+
+    def handle(self, *args, **options):
+        if partitioning.is_partitioned():
+            self.stdout.write("Tables are already partitioned")
+            return
+        with transaction.atomic():
+            partitioning.convert_tables()
+        self.stdout.write(self.style.SUCCESS("Superpixels and segmentation entries are partitioned by scene"))
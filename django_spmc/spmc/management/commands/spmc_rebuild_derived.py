@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from django_spmc.spmc.models import SceneAlgo
+from django_spmc.spmc.utils import finalize_superpixel_ingest
+
+
+class Command(BaseCommand):
+    help = "Rebuild data derived from superpixels (display geometry, simplified levels, catalogue, topology)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scene", type=int, help="Only rebuild pairs of this scene id")
+
+    def handle(self, *args, **options):
+        pairs = SceneAlgo.objects.select_related("scene_id", "algo_id").order_by("scene_id", "algo_id")
+        if options["scene"] is not None:
+            pairs = pairs.filter(scene_id=options["scene"])
+        for pair in pairs:
+            finalize_superpixel_ingest(pair.scene_id, pair.algo_id)
+            self.stdout.write(f"Rebuilt {pair}")
@@ -0,0 +1,34 @@
+import multiprocessing
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from django_spmc.spmc.jobs import work
+
+
+class Command(BaseCommand):
+    help = "Run background jobs (raster tiling, superpixel import and generation) with a pool of worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=settings.SPMC_WORKERS, help="Number of worker processes")
+        parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds to wait when queue is empty")
+        parser.add_argument("--once", action="store_true", help="Exit when there are no pending jobs left")
+
+    def handle(self, *args, **options):
+        workers = max(options["workers"], 1)
+        self.stdout.write(f"Starting {workers} worker(s)")
+        if workers == 1:
+            work(options["poll_interval"], options["once"])
+            return
+        # Every process should open its own database connection
+        connections.close_all()
+        # Workers are not daemonic, as daemonic processes could not start process pools (see segmentation.py)
+        processes = [
+            multiprocessing.Process(target=work, args=(options["poll_interval"], options["once"]))
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
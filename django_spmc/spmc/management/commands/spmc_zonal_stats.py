@@ -0,0 +1,36 @@
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_spmc.spmc.models import MiscTile, Scene, SuperPixelAlgo
+from django_spmc.spmc.stats import compute_stats
+
+
+class Command(BaseCommand):
+    help = "Compute zonal statistics of superpixels of a scene from a raster (the scene raster or a misc tile raster)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("scene", type=int, help="Scene id")
+        parser.add_argument("raster", help="Raster file")
+        parser.add_argument(
+            "--algo", type=int, help="Superpixel algorithm id (all algorithms of the scene if omitted)"
+        )
+        parser.add_argument("--misc-tile", type=int, help="Misc tile id, if the raster is a misc tile layer")
+
+    def handle(self, *args, **options):
+        try:
+            scene = Scene.objects.get(pk=options["scene"])
+            misc_tile = None
+            if options["misc_tile"] is not None:
+                misc_tile = MiscTile.objects.get(pk=options["misc_tile"], scene_id=scene)
+        except (Scene.DoesNotExist, MiscTile.DoesNotExist) as e:
+            raise CommandError(e)
+        algos = SuperPixelAlgo.objects.filter(scenealgo__scene_id=scene, scenealgo__sp_count__gt=0)
+        if options["algo"] is not None:
+            algos = algos.filter(pk=options["algo"])
+        with tempfile.TemporaryDirectory() as work_dir:
+            for algo in algos:
+                started = time.monotonic()
+                created = compute_stats(scene, algo, options["raster"], work_dir, misc_tile=misc_tile)
+                self.stdout.write(f"{algo}: {created} superpixels in {time.monotonic() - started:.1f} s")
@@ -0,0 +1,32 @@
+# Generated by Django 4.1.9 on 2026-10-18 10:00
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("spmc", "0007_rename_segementationentry_segmentationentry"),
+    ]
+
+    operations = [
+        # Keep only the latest entry for every (scene, superpixel, user) before adding the constraint
+        migrations.RunSQL(
+            sql="""
+                DELETE FROM spmc_segmentationentry a
+                USING spmc_segmentationentry b
+                WHERE a.scene_id_id = b.scene_id_id
+                  AND a.super_pixel_id_id = b.super_pixel_id_id
+                  AND a.user_id_id = b.user_id_id
+                  AND a.id < b.id
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name="segmentationentry",
+            constraint=models.UniqueConstraint(
+                fields=("scene_id", "super_pixel_id", "user_id"), name="unique_segmentation_entry"
+            ),
+        ),
+    ]
@@ -0,0 +1,90 @@
+# Generated by Django 4.1.9 on 2026-10-18 11:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_spmc.spmc.models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0009_job"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="misctile",
+            name="tile_format",
+            field=models.CharField(default="png", editable=False, max_length=8),
+        ),
+        migrations.AddField(
+            model_name="scene",
+            name="tile_format",
+            field=models.CharField(default="png", editable=False, max_length=8),
+        ),
+        migrations.CreateModel(
+            name="TilingSettings",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("min_zoom", models.PositiveSmallIntegerField(default=10, verbose_name="Min zoom")),
+                ("max_zoom", models.PositiveSmallIntegerField(default=18, verbose_name="Max zoom")),
+                (
+                    "resampling",
+                    models.CharField(
+                        choices=[
+                            ("near", "near"),
+                            ("bilinear", "bilinear"),
+                            ("cubic", "cubic"),
+                            ("cubicspline", "cubicspline"),
+                            ("lanczos", "lanczos"),
+                            ("average", "average"),
+                            ("mode", "mode"),
+                        ],
+                        default="bilinear",
+                        max_length=16,
+                        verbose_name="Resampling",
+                    ),
+                ),
+                (
+                    "processes",
+                    models.PositiveSmallIntegerField(
+                        default=django_spmc.spmc.models.default_tiling_processes, verbose_name="Worker processes"
+                    ),
+                ),
+                (
+                    "tile_format",
+                    models.CharField(
+                        choices=[("PNG", "PNG"), ("WEBP", "WEBP")],
+                        default="PNG",
+                        max_length=8,
+                        verbose_name="Tile format",
+                    ),
+                ),
+                (
+                    "proj_id",
+                    models.OneToOneField(
+                        blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to="spmc.project"
+                    ),
+                ),
+                (
+                    "scene_id",
+                    models.OneToOneField(
+                        blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to="spmc.scene"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "Tiling settings",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="tilingsettings",
+            constraint=models.CheckConstraint(
+                check=models.Q(
+                    models.Q(("proj_id__isnull", False), ("scene_id__isnull", True)),
+                    models.Q(("proj_id__isnull", True), ("scene_id__isnull", False)),
+                    _connector="OR",
+                ),
+                name="tiling_settings_project_or_scene",
+            ),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.1.9 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0010_tilingsettings_misctile_tile_format_scene_tile_format"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="misctile",
+            name="tiles_backend",
+            field=models.CharField(
+                choices=[
+                    ("xyz", "Pre-rendered tile pyramid"),
+                    ("cog", "Cloud-Optimized GeoTIFF, tiles are rendered on demand"),
+                ],
+                default="xyz",
+                editable=False,
+                max_length=8,
+            ),
+        ),
+        migrations.AddField(
+            model_name="scene",
+            name="tiles_backend",
+            field=models.CharField(
+                choices=[
+                    ("xyz", "Pre-rendered tile pyramid"),
+                    ("cog", "Cloud-Optimized GeoTIFF, tiles are rendered on demand"),
+                ],
+                default="xyz",
+                editable=False,
+                max_length=8,
+            ),
+        ),
+        migrations.AddField(
+            model_name="tilingsettings",
+            name="backend",
+            field=models.CharField(
+                choices=[
+                    ("xyz", "Pre-rendered tile pyramid"),
+                    ("cog", "Cloud-Optimized GeoTIFF, tiles are rendered on demand"),
+                ],
+                default="xyz",
+                max_length=8,
+                verbose_name="Tiles backend",
+            ),
+        ),
+    ]
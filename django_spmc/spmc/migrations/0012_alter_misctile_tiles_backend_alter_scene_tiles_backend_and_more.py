@@ -0,0 +1,54 @@
+# Generated by Django 4.1.9 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0011_misctile_tiles_backend_scene_tiles_backend_and_more"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="misctile",
+            name="tiles_backend",
+            field=models.CharField(
+                choices=[
+                    ("xyz", "Pre-rendered tile pyramid"),
+                    ("cog", "Cloud-Optimized GeoTIFF, tiles are rendered on demand"),
+                    ("mbtiles", "Pre-rendered tiles packed into a single MBTiles archive"),
+                ],
+                default="xyz",
+                editable=False,
+                max_length=8,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="scene",
+            name="tiles_backend",
+            field=models.CharField(
+                choices=[
+                    ("xyz", "Pre-rendered tile pyramid"),
+                    ("cog", "Cloud-Optimized GeoTIFF, tiles are rendered on demand"),
+                    ("mbtiles", "Pre-rendered tiles packed into a single MBTiles archive"),
+                ],
+                default="xyz",
+                editable=False,
+                max_length=8,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="tilingsettings",
+            name="backend",
+            field=models.CharField(
+                choices=[
+                    ("xyz", "Pre-rendered tile pyramid"),
+                    ("cog", "Cloud-Optimized GeoTIFF, tiles are rendered on demand"),
+                    ("mbtiles", "Pre-rendered tiles packed into a single MBTiles archive"),
+                ],
+                default="xyz",
+                max_length=8,
+                verbose_name="Tiles backend",
+            ),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.1.9 on 2026-10-18 13:00
+
+from django.db import migrations, models
+import django.contrib.gis.db.models.fields
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0012_alter_misctile_tiles_backend_alter_scene_tiles_backend_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SceneAlgo",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("sp_count", models.PositiveIntegerField(default=0, verbose_name="Number of superpixels")),
+                ("bbox", django.contrib.gis.db.models.fields.PolygonField(blank=True, null=True, srid=4326)),
+                ("area", models.FloatField(default=0, verbose_name="Area of superpixels, m2")),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "algo_id",
+                    models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="spmc.superpixelalgo"),
+                ),
+                ("scene_id", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="spmc.scene")),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="scenealgo",
+            constraint=models.UniqueConstraint(fields=("scene_id", "algo_id"), name="unique_scene_algo"),
+        ),
+        # Fill the catalogue with superpixels which were ingested before it existed
+        migrations.RunSQL(
+            sql="""
+            INSERT INTO spmc_scenealgo (scene_id_id, algo_id_id, sp_count, bbox, area, updated_at)
+            SELECT scene_id_id, algo_id_id, count(*), ST_SetSRID(ST_Envelope(ST_Extent(sp)::geometry), 4326),
+                   COALESCE(sum(ST_Area(sp::geography)), 0), now()
+            FROM spmc_superpixel
+            GROUP BY scene_id_id, algo_id_id
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.9 on 2026-10-18 13:30
+
+from django.db import migrations
+import django.contrib.gis.db.models.fields
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0013_scenealgo"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="superpixel",
+            name="sp_display",
+            field=django.contrib.gis.db.models.fields.PolygonField(blank=True, editable=False, null=True, srid=3857),
+        ),
+        # Project already ingested superpixels
+        migrations.RunSQL(
+            sql="UPDATE spmc_superpixel SET sp_display = ST_Transform(sp, 3857) WHERE sp IS NOT NULL",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
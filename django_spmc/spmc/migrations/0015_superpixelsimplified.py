@@ -0,0 +1,51 @@
+# Generated by Django 4.1.9 on 2026-10-18 14:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.contrib.gis.db.models.fields
+import django.db.models.deletion
+
+
+def build_simplified(apps, schema_editor):
+    # Simplify superpixels which were ingested before the table existed
+    schema_editor.execute(
+        """
+        INSERT INTO spmc_superpixelsimplified (super_pixel_id_id, resolution, geom)
+        SELECT sp.id, r.resolution, simplified.geom
+        FROM spmc_superpixel sp
+        CROSS JOIN unnest(%s::float8[]) AS r(resolution)
+        CROSS JOIN LATERAL (
+            SELECT ST_Simplify(ST_SnapToGrid(COALESCE(sp.sp_display, ST_Transform(sp.sp, 3857)), r.resolution), 0) AS geom
+        ) simplified
+        WHERE GeometryType(simplified.geom) = 'POLYGON' AND NOT ST_IsEmpty(simplified.geom)
+        """,
+        [list(settings.SPMC_SIMPLIFY_RESOLUTIONS)],
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0014_superpixel_sp_display"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SuperPixelSimplified",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("resolution", models.FloatField()),
+                ("geom", django.contrib.gis.db.models.fields.PolygonField(srid=3857)),
+                (
+                    "super_pixel_id",
+                    models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="spmc.superpixel"),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="superpixelsimplified",
+            constraint=models.UniqueConstraint(
+                fields=("super_pixel_id", "resolution"), name="unique_superpixel_simplified"
+            ),
+        ),
+        migrations.RunPython(build_simplified, migrations.RunPython.noop),
+    ]
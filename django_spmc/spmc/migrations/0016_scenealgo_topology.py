@@ -0,0 +1,17 @@
+# Generated by Django 4.1.9 on 2026-10-18 14:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0015_superpixelsimplified"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scenealgo",
+            name="topology",
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+    ]
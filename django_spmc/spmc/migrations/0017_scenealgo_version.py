@@ -0,0 +1,17 @@
+# Generated by Django 4.1.9 on 2026-10-18 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0016_scenealgo_topology"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scenealgo",
+            name="version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
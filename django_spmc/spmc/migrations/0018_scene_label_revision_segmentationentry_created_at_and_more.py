@@ -0,0 +1,38 @@
+# Generated by Django 4.1.9 on 2026-10-18 15:30
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0017_scenealgo_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scene",
+            name="label_revision",
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="segmentationentry",
+            name="created_at",
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="segmentationentry",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name="segmentationentry",
+            name="revision",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name="segmentationentry",
+            index=models.Index(fields=["scene_id", "user_id", "revision"], name="segmentation_entry_revision"),
+        ),
+    ]
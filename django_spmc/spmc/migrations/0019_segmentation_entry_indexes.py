@@ -0,0 +1,34 @@
+# Generated by Django 4.1.9 on 2026-10-18 16:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0018_scene_label_revision_segmentationentry_created_at_and_more"),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name="segmentationentry",
+            name="unique_segmentation_entry",
+        ),
+        migrations.AddConstraint(
+            model_name="segmentationentry",
+            constraint=models.UniqueConstraint(
+                fields=("scene_id", "user_id", "super_pixel_id"),
+                include=("land_class_id",),
+                name="unique_segmentation_entry",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="segmentationentry",
+            name="scene_id",
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to="spmc.scene"),
+        ),
+        migrations.AddIndex(
+            model_name="superpixel",
+            index=models.Index(fields=["scene_id", "algo_id", "id"], name="superpixel_scene_algo"),
+        ),
+    ]
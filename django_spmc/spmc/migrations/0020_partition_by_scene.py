@@ -0,0 +1,12 @@
+# Generated by Django 4.1.9 on 2026-10-18 16:30
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0019_segmentation_entry_indexes"),
+    ]
+
+    # Tables are not converted by migrations, partitioning is optional and applied with the spmc_partition command
+    operations = []
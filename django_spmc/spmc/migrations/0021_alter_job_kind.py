@@ -0,0 +1,25 @@
+# Generated by Django 4.1.9 on 2026-10-18 19:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0020_partition_by_scene"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="job",
+            name="kind",
+            field=models.CharField(
+                choices=[
+                    ("tiles", "Raster tiling"),
+                    ("superpixels", "Superpixel import"),
+                    ("sweep_trash", "Removal of deleted tiles"),
+                ],
+                max_length=32,
+                verbose_name="Job kind",
+            ),
+        ),
+    ]
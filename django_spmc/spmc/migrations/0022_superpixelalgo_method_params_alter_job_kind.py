@@ -0,0 +1,41 @@
+# Generated by Django 4.1.9 on 2026-10-18 20:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0021_alter_job_kind"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="superpixelalgo",
+            name="method",
+            field=models.CharField(
+                blank=True,
+                choices=[("slic", "SLIC"), ("felzenszwalb", "Felzenszwalb")],
+                max_length=32,
+                verbose_name="Segmentation method",
+            ),
+        ),
+        migrations.AddField(
+            model_name="superpixelalgo",
+            name="params",
+            field=models.JSONField(blank=True, default=dict, verbose_name="Segmentation parameters"),
+        ),
+        migrations.AlterField(
+            model_name="job",
+            name="kind",
+            field=models.CharField(
+                choices=[
+                    ("tiles", "Raster tiling"),
+                    ("superpixels", "Superpixel import"),
+                    ("sweep_trash", "Removal of deleted tiles"),
+                    ("segmentation", "Superpixel generation"),
+                ],
+                max_length=32,
+                verbose_name="Job kind",
+            ),
+        ),
+    ]
@@ -0,0 +1,95 @@
+# Generated by Django 4.1.9 on 2026-10-18 21:30
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0022_superpixelalgo_method_params_alter_job_kind"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StatsLayer",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "columns",
+                    django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=64), size=None),
+                ),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "algo_id",
+                    models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="spmc.superpixelalgo"),
+                ),
+                (
+                    "misc_tile_id",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="spmc.misctile",
+                    ),
+                ),
+                ("scene_id", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="spmc.scene")),
+            ],
+        ),
+        migrations.CreateModel(
+            name="SuperPixelStats",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("pixel_count", models.PositiveIntegerField()),
+                (
+                    "features",
+                    django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), size=None),
+                ),
+                (
+                    "layer_id",
+                    models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="spmc.statslayer"),
+                ),
+                (
+                    "super_pixel_id",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="spmc.superpixel",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="statslayer",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("misc_tile_id", None)),
+                fields=("scene_id", "algo_id"),
+                name="unique_scene_stats_layer",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="statslayer",
+            constraint=models.UniqueConstraint(
+                fields=("scene_id", "algo_id", "misc_tile_id"), name="unique_misc_stats_layer"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="superpixelstats",
+            constraint=models.UniqueConstraint(fields=("layer_id", "super_pixel_id"), name="unique_superpixel_stats"),
+        ),
+        migrations.AlterField(
+            model_name="job",
+            name="kind",
+            field=models.CharField(
+                choices=[
+                    ("tiles", "Raster tiling"),
+                    ("superpixels", "Superpixel import"),
+                    ("sweep_trash", "Removal of deleted tiles"),
+                    ("segmentation", "Superpixel generation"),
+                    ("stats", "Zonal statistics of superpixels"),
+                ],
+                max_length=32,
+                verbose_name="Job kind",
+            ),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.1.9 on 2026-10-18 22:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0023_statslayer_superpixelstats_alter_job_kind"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SuperPixelAdjacency",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "algo_id",
+                    models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="spmc.superpixelalgo"),
+                ),
+                (
+                    "neighbour_id",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="spmc.superpixel",
+                    ),
+                ),
+                ("scene_id", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="spmc.scene")),
+                (
+                    "super_pixel_id",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="spmc.superpixel",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="superpixeladjacency",
+            constraint=models.UniqueConstraint(
+                fields=("super_pixel_id", "neighbour_id"), name="unique_superpixel_adjacency"
+            ),
+        ),
+    ]
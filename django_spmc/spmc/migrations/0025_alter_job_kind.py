@@ -0,0 +1,28 @@
+# Generated by Django 4.1.9 on 2026-10-18 22:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0024_superpixeladjacency"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="job",
+            name="kind",
+            field=models.CharField(
+                choices=[
+                    ("tiles", "Raster tiling"),
+                    ("superpixels", "Superpixel import"),
+                    ("sweep_trash", "Removal of deleted tiles"),
+                    ("segmentation", "Superpixel generation"),
+                    ("stats", "Zonal statistics of superpixels"),
+                    ("evict_tile_cache", "Eviction of cached tiles"),
+                ],
+                max_length=32,
+                verbose_name="Job kind",
+            ),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.9 on 2026-10-18 23:10
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0025_alter_job_kind"),
+    ]
+
+    operations = [
+        # Topology is written to SPMC_TOPOLOGY_ROOT, run spmc_rebuild_derived to build files of existing pairs
+        migrations.RemoveField(
+            model_name="scenealgo",
+            name="topology",
+        ),
+    ]
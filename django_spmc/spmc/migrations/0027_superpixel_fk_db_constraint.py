@@ -0,0 +1,36 @@
+# Generated by Django 4.1.9 on 2026-10-18 23:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("spmc", "0026_remove_scenealgo_topology"),
+    ]
+
+    operations = [
+        # Constraints are kept in the database until tables are partitioned by spmc_partition, which drops them
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name="segmentationentry",
+                    name="super_pixel_id",
+                    field=models.ForeignKey(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="spmc.superpixel",
+                    ),
+                ),
+                migrations.AlterField(
+                    model_name="superpixelsimplified",
+                    name="super_pixel_id",
+                    field=models.ForeignKey(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="spmc.superpixel",
+                    ),
+                ),
+            ],
+        ),
+    ]
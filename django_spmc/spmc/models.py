@@ -4,8 +4,17 @@ import uuid
 
 from django.conf import settings
 from django.contrib.gis.db import models
+from django.contrib.postgres.fields import ArrayField
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Concat
+from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from . import partitioning
+
 
 class Project(models.Model):
     """
@@ -22,11 +31,22 @@ class Project(models.Model):
 
 class SuperPixelAlgo(models.Model):
     """
-    SuperPixelType model for Django_SPMC
+    SuperPixelType model for Django_SPMC. Superpixels of an algorithm with a method are generated from the scene
+    raster by spmc_worker (see segmentation.py), others are uploaded
     """
 
+    SLIC = "slic"
+    FELZENSZWALB = "felzenszwalb"
+    METHODS = [
+        (SLIC, _("SLIC")),
+        (FELZENSZWALB, _("Felzenszwalb")),
+    ]
+
     name = models.CharField(_("SuperPixelType name"), max_length=255, unique=True, blank=False)
     description = models.TextField(_("SuperPixelType description"), blank=True)
+    method = models.CharField(_("Segmentation method"), max_length=32, choices=METHODS, blank=True)
+    # Keyword arguments of the scikit-image function, plus block_size and overlap (pixels) of the processing windows
+    params = models.JSONField(_("Segmentation parameters"), default=dict, blank=True)
 
     def __str__(self):
         return f"SP algorithm: {self.name}"
@@ -44,7 +64,109 @@ class ProjectAlgo(models.Model):
         return f"Proj-Algo pair: {self.proj_id} - {self.algo_id}"
 
 
-class Scene(models.Model):
+XYZ = "xyz"
+COG = "cog"
+MBTILES = "mbtiles"
+TILE_BACKENDS = [
+    (XYZ, _("Pre-rendered tile pyramid")),
+    (COG, _("Cloud-Optimized GeoTIFF, tiles are rendered on demand")),
+    (MBTILES, _("Pre-rendered tiles packed into a single MBTiles archive")),
+]
+
+
+def remove_tiles(path):
+    """
+    Remove tiles of a scene or misc tile, either a folder or a single archive file
+    """
+    if not path or not os.path.exists(path):
+        return
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def trash_tiles(path):
+    """
+    Move tiles into the trash folder, where they are removed later by a sweep job. A rename takes constant time
+    regardless of the number of tiles
+    """
+    if not path or not os.path.exists(path):
+        return
+    os.makedirs(settings.SPMC_TRASH_ROOT, exist_ok=True)
+    try:
+        os.rename(path, os.path.join(settings.SPMC_TRASH_ROOT, f"{uuid.uuid4()}-{os.path.basename(path)}"))
+    except OSError:
+        # Trash is on another file system
+        remove_tiles(path)
+
+
+def discard_tiles(paths):
+    """
+    Move tiles to the trash once the current transaction is committed (tiles stay in place if it is rolled back)
+    and schedule their removal
+    """
+    paths = [path for path in paths if path]
+    if not paths:
+        return
+
+    def move():
+        for path in paths:
+            trash_tiles(path)
+        if not Job.objects.filter(kind=Job.SWEEP_TRASH, state=Job.PENDING).exists():
+            Job.objects.create(kind=Job.SWEEP_TRASH)
+
+    transaction.on_commit(move)
+
+
+class TileSourceMixin:
+    """
+    Common helpers of models with raster tiles (Scene and MiscTile)
+    """
+
+    @property
+    def tile_url(self):
+        """
+        URL template of XYZ tiles for OpenLayers
+        """
+        if self.tiles_backend in (COG, MBTILES):
+            url = reverse("tile", kwargs={"uuid": self.uuid, "z": 0, "x": 0, "y": 0, "ext": self.tile_format})
+            url = url.replace(f"/0/0/0.{self.tile_format}", f"/{{z}}/{{x}}/{{y}}.{self.tile_format}")
+            if self.tiles_backend == MBTILES and self.tiles_path and os.path.exists(self.tiles_path):
+                # Archive tiles are cached by browsers forever, so the URL changes whenever the archive is rebuilt
+                url += f"?v={int(os.path.getmtime(self.tiles_path))}"
+            return url
+        return f"{settings.MEDIA_URL}tiles/{self.uuid}/{{z}}/{{x}}/{{y}}.{self.tile_format}"
+
+
+# Rows of a scene in dependency order, labels and superpixels are skipped for partitioned tables
+SCENE_DATA_DELETE_SQL = [
+    "DELETE FROM spmc_segmentationentry WHERE scene_id_id = %(scene_id)s",
+    """
+    DELETE FROM spmc_superpixelsimplified s USING spmc_superpixel sp
+    WHERE s.super_pixel_id_id = sp.id AND sp.scene_id_id = %(scene_id)s
+    """,
+    "DELETE FROM spmc_superpixel WHERE scene_id_id = %(scene_id)s",
+]
+SCENE_DELETE_SQL = [
+    """
+    DELETE FROM spmc_superpixelstats st USING spmc_statslayer l
+    WHERE st.layer_id_id = l.id AND l.scene_id_id = %(scene_id)s
+    """,
+    "DELETE FROM spmc_statslayer WHERE scene_id_id = %(scene_id)s",
+    "DELETE FROM spmc_superpixeladjacency WHERE scene_id_id = %(scene_id)s",
+    "DELETE FROM spmc_scenealgo WHERE scene_id_id = %(scene_id)s",
+    """
+    DELETE FROM spmc_job
+    WHERE scene_id_id = %(scene_id)s
+       OR misc_tile_id_id IN (SELECT id FROM spmc_misctile WHERE scene_id_id = %(scene_id)s)
+    """,
+    "DELETE FROM spmc_tilingsettings WHERE scene_id_id = %(scene_id)s",
+    "DELETE FROM spmc_misctile WHERE scene_id_id = %(scene_id)s",
+]
+
+
+class Scene(TileSourceMixin, models.Model):
     """
     Scene model for Django_SPMC
     """
@@ -54,17 +176,56 @@ class Scene(models.Model):
     description = models.TextField(_("Scene description"), blank=True, null=True)
     uuid = models.TextField(blank=True, null=True, editable=False, unique=True)
     tiles_path = models.FilePathField(blank=True, null=True, editable=False)
+    tile_format = models.CharField(max_length=8, default="png", editable=False)  # Extension of generated tiles
+    tiles_backend = models.CharField(max_length=8, choices=TILE_BACKENDS, default=XYZ, editable=False)
     bbox = models.PolygonField(blank=True, null=True, srid=4326, editable=False)
+    # Incremented by every batch of saved labels, see SegmentationEntry.revision
+    label_revision = models.BigIntegerField(default=0, editable=False)
 
     def __str__(self):
         return f"Scene: {self.name}"
 
+    def next_label_revision(self):
+        """
+        Take the next label revision of the scene. The scene row stays locked until the transaction ends, so
+        revisions are committed in increasing order and pollers never skip changes
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE spmc_scene SET label_revision = label_revision + 1 WHERE id = %s RETURNING label_revision",
+                [self.pk],
+            )
+            self.label_revision = cursor.fetchone()[0]
+        return self.label_revision
+
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        super().save(*args, **kwargs)
+        if created:
+            partitioning.create_scene_partitions(self.pk)
+
     def delete(self, *args, **kwargs):
-        # Delete the folder associated with this object
-        if self.tiles_path:
-            if os.path.exists(self.tiles_path):
-                shutil.rmtree(self.tiles_path)
-        super().delete(*args, **kwargs)
+        """
+        Delete the scene with set-based statements in dependency order instead of the collector cascade, which loads
+        every superpixel and label into memory. Tiles of the scene and its misc tiles (and superpixel topologies) are
+        moved to the trash
+        """
+        paths = [
+            self.tiles_path,
+            *self.misctile_set.values_list("tiles_path", flat=True),
+            os.path.join(settings.SPMC_TOPOLOGY_ROOT, str(self.pk)),
+        ]
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                # Superpixels and labels of a partitioned scene are dropped with its partitions
+                statements = SCENE_DELETE_SQL
+                if not partitioning.drop_scene_partitions(self.pk):
+                    statements = SCENE_DATA_DELETE_SQL + statements
+                for sql in statements:
+                    cursor.execute(sql, {"scene_id": self.pk})
+            discard_tiles(paths)
+            # Nothing is left to cascade, only the scene row itself is deleted
+            return super().delete(*args, **kwargs)
 
     def get_center(self, srid):
         center = self.bbox.centroid
@@ -75,7 +236,7 @@ class Scene(models.Model):
         self.uuid = str(uuid.uuid4())
 
 
-class MiscTile(models.Model):
+class MiscTile(TileSourceMixin, models.Model):
     """
     MiscTiles model for Django_SPMC for storing paths and meta info about additional layers
     """
@@ -85,21 +246,89 @@ class MiscTile(models.Model):
     description = models.TextField(_("MiscTiles description"), blank=True)
     uuid = models.TextField(blank=True, null=True, editable=False, unique=True)
     tiles_path = models.FilePathField(blank=True)
+    tile_format = models.CharField(max_length=8, default="png", editable=False)  # Extension of generated tiles
+    tiles_backend = models.CharField(max_length=8, choices=TILE_BACKENDS, default=XYZ, editable=False)
     bbox = models.PolygonField(blank=True, null=True, srid=4326)
 
     def __str__(self):
         return f"MiscTiles: {self.name}"
 
     def delete(self, *args, **kwargs):
-        # Delete the folder associated with this object
-        if os.path.exists(self.tiles_path):
-            shutil.rmtree(self.tiles_path)
-        super().delete(*args, **kwargs)
+        # Tiles (a folder or an archive) are moved to the trash once the row is deleted
+        discard_tiles([self.tiles_path])
+        return super().delete(*args, **kwargs)
 
     def gen_uuid(self):
         self.uuid = str(uuid.uuid4())
 
 
+def default_tiling_processes():
+    return settings.SPMC_TILING_PROCESSES
+
+
+class TilingSettings(models.Model):
+    """
+    gdal2tiles parameters for all scenes of a Project or for a single Scene (Scene settings take precedence)
+    """
+
+    RESAMPLING = [
+        ("near", "near"),
+        ("bilinear", "bilinear"),
+        ("cubic", "cubic"),
+        ("cubicspline", "cubicspline"),
+        ("lanczos", "lanczos"),
+        ("average", "average"),
+        ("mode", "mode"),
+    ]
+    TILE_FORMATS = [("PNG", "PNG"), ("WEBP", "WEBP")]
+
+    proj_id = models.OneToOneField(Project, on_delete=models.CASCADE, blank=True, null=True)
+    scene_id = models.OneToOneField(Scene, on_delete=models.CASCADE, blank=True, null=True)
+    min_zoom = models.PositiveSmallIntegerField(_("Min zoom"), default=10)
+    max_zoom = models.PositiveSmallIntegerField(_("Max zoom"), default=18)
+    resampling = models.CharField(_("Resampling"), max_length=16, choices=RESAMPLING, default="bilinear")
+    processes = models.PositiveSmallIntegerField(_("Worker processes"), default=default_tiling_processes)
+    tile_format = models.CharField(_("Tile format"), max_length=8, choices=TILE_FORMATS, default="PNG")
+    backend = models.CharField(_("Tiles backend"), max_length=8, choices=TILE_BACKENDS, default=XYZ)
+
+    class Meta:
+        verbose_name_plural = "Tiling settings"
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q(proj_id__isnull=False, scene_id__isnull=True)
+                | models.Q(proj_id__isnull=True, scene_id__isnull=False),
+                name="tiling_settings_project_or_scene",
+            ),
+        ]
+
+    def __str__(self):
+        return f"Tiling settings: {self.scene_id or self.proj_id}"
+
+    def clean(self):
+        if self.min_zoom > self.max_zoom:
+            raise ValidationError(_("Min zoom should not be greater than max zoom"))
+
+    @classmethod
+    def for_target(cls, target):
+        """
+        Resolve settings for a Scene or MiscTile: scene settings, then project settings, then defaults
+        """
+        scene = getattr(target, "scene_id", None) if isinstance(target, MiscTile) else target
+        if scene is not None:
+            tiling = cls.objects.filter(models.Q(scene_id=scene) | models.Q(proj_id=scene.proj_id_id))
+            tiling = sorted(tiling, key=lambda t: t.scene_id_id is None)
+            if tiling:
+                return tiling[0]
+        return cls()
+
+    def gdal2tiles_args(self):
+        args = ["-z", f"{self.min_zoom}-{self.max_zoom}", "-r", self.resampling, f"--processes={self.processes}"]
+        # Custom tile driver is supported since GDAL 3.6, so pass it only when it is not a default one
+        if self.tile_format != "PNG":
+            args += ["--tiledriver", self.tile_format]
+        return args
+
+
 class LandClass(models.Model):
     """
     The model to store possible land classes for Django_SPMC
@@ -120,12 +349,129 @@ class SuperPixel(models.Model):
 
     scene_id = models.ForeignKey(Scene, on_delete=models.CASCADE, blank=False, null=False)
     sp = models.PolygonField(blank=True, null=True, srid=4326)
+    # Copy of sp in the web mercator used by the client map, filled after ingest
+    sp_display = models.PolygonField(blank=True, null=True, srid=3857, editable=False)
     algo_id = models.ForeignKey(SuperPixelAlgo, on_delete=models.CASCADE, blank=False, null=False)
 
+    class Meta:
+        # Superpixels are always read by scene/algo pair, ordered by id (keyset pagination)
+        indexes = [models.Index(fields=["scene_id", "algo_id", "id"], name="superpixel_scene_algo")]
+
     def __str__(self):
         return f"SuperPixel: {self.id}, scene: {self.scene_id}"
 
 
+class SuperPixelSimplified(models.Model):
+    """
+    Superpixel geometry in the display srid snapped to a grid of the given resolution (metres). Neighbouring
+    superpixels share their vertices, so they are snapped identically and stay gap-free
+    """
+
+    # No database constraint, as superpixels could be partitioned by scene (see partitioning.py)
+    super_pixel_id = models.ForeignKey(SuperPixel, on_delete=models.CASCADE, db_constraint=False)
+    resolution = models.FloatField()
+    geom = models.PolygonField(srid=3857)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["super_pixel_id", "resolution"], name="unique_superpixel_simplified")
+        ]
+
+
+class SceneAlgo(models.Model):
+    """
+    Catalogue of scene/algorithm pairs which have superpixels. It is maintained at ingest time, so listing scenes
+    does not touch the superpixel table. Entries of pairs which have lost their superpixels are kept with sp_count 0
+    """
+
+    scene_id = models.ForeignKey(Scene, on_delete=models.CASCADE)
+    algo_id = models.ForeignKey(SuperPixelAlgo, on_delete=models.CASCADE)
+    sp_count = models.PositiveIntegerField(_("Number of superpixels"), default=0)
+    bbox = models.PolygonField(blank=True, null=True, srid=4326)
+    area = models.FloatField(_("Area of superpixels, m2"), default=0)
+    # Incremented after every ingest, used to invalidate cached geometry
+    version = models.PositiveIntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["scene_id", "algo_id"], name="unique_scene_algo")]
+
+    def __str__(self):
+        return f"Scene-Algo pair: {self.scene_id} - {self.algo_id}"
+
+    @property
+    def topology_path(self):
+        """
+        Serialized TopoJSON of superpixels in the display srid (see topology.py), written at ingest time for the
+        current version. Files of a scene share a folder, which is removed with the scene
+        """
+        return os.path.join(
+            settings.SPMC_TOPOLOGY_ROOT, str(self.scene_id_id), f"{self.algo_id_id}.{self.version}.topojson"
+        )
+
+
+class StatsLayer(models.Model):
+    """
+    Zonal statistics of superpixels of a scene/algo pair computed from the scene raster (misc_tile_id is empty) or
+    from a misc tile raster, see stats.py. Every layer is computed separately, so adding a misc tile only computes
+    its own layer
+    """
+
+    scene_id = models.ForeignKey(Scene, on_delete=models.CASCADE)
+    algo_id = models.ForeignKey(SuperPixelAlgo, on_delete=models.CASCADE)
+    misc_tile_id = models.ForeignKey(MiscTile, on_delete=models.CASCADE, blank=True, null=True)
+    # Names of features of SuperPixelStats rows, e.g. b1_mean, b1_std, ndvi_mean, texture_mean
+    columns = ArrayField(models.CharField(max_length=64))
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["scene_id", "algo_id"], condition=Q(misc_tile_id=None), name="unique_scene_stats_layer"
+            ),
+            models.UniqueConstraint(fields=["scene_id", "algo_id", "misc_tile_id"], name="unique_misc_stats_layer"),
+        ]
+
+    def __str__(self):
+        return f"Stats layer: {self.scene_id} - {self.algo_id} - {self.misc_tile_id or 'scene raster'}"
+
+
+class SuperPixelStats(models.Model):
+    """
+    Statistics of a superpixel in a stats layer, features are ordered as StatsLayer.columns
+    """
+
+    layer_id = models.ForeignKey(StatsLayer, on_delete=models.CASCADE)
+    # No database constraint, as superpixels could be partitioned by scene (see partitioning.py)
+    super_pixel_id = models.ForeignKey(SuperPixel, on_delete=models.CASCADE, db_constraint=False)
+    pixel_count = models.PositiveIntegerField()
+    features = ArrayField(models.FloatField())
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["layer_id", "super_pixel_id"], name="unique_superpixel_stats")]
+
+
+class SuperPixelAdjacency(models.Model):
+    """
+    Superpixels of a scene/algo pair sharing a border, every pair is stored in both directions. The graph is built
+    at ingest time (see build_adjacency), so neighbour queries are index lookups instead of spatial joins
+    """
+
+    scene_id = models.ForeignKey(Scene, on_delete=models.CASCADE)
+    algo_id = models.ForeignKey(SuperPixelAlgo, on_delete=models.CASCADE)
+    # No database constraints, as superpixels could be partitioned by scene (see partitioning.py). super_pixel_id is
+    # the leading column of the unique constraint, a separate index is not needed
+    super_pixel_id = models.ForeignKey(SuperPixel, on_delete=models.CASCADE, db_constraint=False, db_index=False)
+    neighbour_id = models.ForeignKey(
+        SuperPixel, on_delete=models.CASCADE, db_constraint=False, db_index=False, related_name="+"
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["super_pixel_id", "neighbour_id"], name="unique_superpixel_adjacency")
+        ]
+
+
 class LandClassification(models.Model):
     """
     The model to store possible land classification schemas for Django_SPMC
@@ -143,7 +489,94 @@ class SegmentationEntry(models.Model):
     Store actual classifications
     """
 
-    scene_id = models.ForeignKey(Scene, on_delete=models.CASCADE)
-    super_pixel_id = models.ForeignKey(SuperPixel, on_delete=models.CASCADE)
+    # scene_id is the leading column of the composite indexes below, a separate index is not needed
+    scene_id = models.ForeignKey(Scene, on_delete=models.CASCADE, db_index=False)
+    # No database constraint, as superpixels could be partitioned by scene (see partitioning.py)
+    super_pixel_id = models.ForeignKey(SuperPixel, on_delete=models.CASCADE, db_constraint=False)
     land_class_id = models.ForeignKey(LandClass, on_delete=models.CASCADE)
     user_id = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    revision = models.BigIntegerField(default=0)  # Scene.label_revision of the last change
+
+    class Meta:
+        constraints = [
+            # A user could assign only one class to a superpixel, this also backs upserts in the API. Labels of a
+            # user in a scene are read with an index-only scan, as land_class_id is included
+            models.UniqueConstraint(
+                fields=["scene_id", "user_id", "super_pixel_id"],
+                include=["land_class_id"],
+                name="unique_segmentation_entry",
+            ),
+        ]
+        indexes = [models.Index(fields=["scene_id", "user_id", "revision"], name="segmentation_entry_revision")]
+
+
+class Job(models.Model):
+    """
+    Background job for long-running ingest tasks (raster tiling, superpixel import), executed by spmc_worker
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATES = [
+        (PENDING, _("Pending")),
+        (RUNNING, _("Running")),
+        (DONE, _("Done")),
+        (FAILED, _("Failed")),
+    ]
+
+    TILES = "tiles"
+    SUPERPIXELS = "superpixels"
+    SWEEP_TRASH = "sweep_trash"
+    SEGMENTATION = "segmentation"
+    STATS = "stats"
+    EVICT_TILE_CACHE = "evict_tile_cache"
+    KINDS = [
+        (TILES, _("Raster tiling")),
+        (SUPERPIXELS, _("Superpixel import")),
+        (SWEEP_TRASH, _("Removal of deleted tiles")),
+        (SEGMENTATION, _("Superpixel generation")),
+        (STATS, _("Zonal statistics of superpixels")),
+        (EVICT_TILE_CACHE, _("Eviction of cached tiles")),
+    ]
+
+    kind = models.CharField(_("Job kind"), max_length=32, choices=KINDS)
+    state = models.CharField(_("Job state"), max_length=16, choices=STATES, default=PENDING, db_index=True)
+    progress = models.FloatField(_("Progress, %"), default=0)
+    log = models.TextField(_("Job log"), blank=True)
+    payload = models.JSONField(default=dict, blank=True)
+    scene_id = models.ForeignKey(Scene, on_delete=models.CASCADE, blank=True, null=True)
+    misc_tile_id = models.ForeignKey(MiscTile, on_delete=models.CASCADE, blank=True, null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"Job: {self.id}, {self.kind} ({self.state})"
+
+    @property
+    def target(self):
+        return self.misc_tile_id or self.scene_id
+
+    def report(self, progress=None, message=None):
+        """
+        Store job progress and append a message to the log. Uses update() so it is safe to call while a worker
+        holds a stale copy of the object
+        """
+        fields = {}
+        if progress is not None:
+            self.progress = round(min(max(progress, 0), 100), 1)
+            fields["progress"] = self.progress
+        if message:
+            line = f"[{timezone.now():%Y-%m-%d %H:%M:%S}] {message}\n"
+            self.log += line
+            fields["log"] = Concat(F("log"), Value(line))
+        if fields:
+            Job.objects.filter(pk=self.pk).update(**fields)
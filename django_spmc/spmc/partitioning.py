@@ -0,0 +1,147 @@
+"""
+Optional declarative partitioning of superpixels and segmentation entries by scene (LIST on scene_id_id). Every scene
+gets its own partition of both tables, so per-scene queries are pruned to a single partition and dropping a scene is
+a partition drop instead of a row by row delete. Rows of scenes without a partition go to the DEFAULT partition.
+
+Partitioned tables could not have primary keys or unique constraints without the partition key, therefore:
+- primary keys become (id, scene_id_id), ids stay unique as they are still generated by a single sequence
+- foreign keys referencing spmc_superpixel are dropped, dependent rows are deleted by the application. Models
+  declare them with db_constraint=False, so the migration state matches both layouts
+
+Tables are converted by the spmc_partition command only.
+"""
+from django.db import connection
+
+# Partitioned tables in conversion order: superpixels are referenced by segmentation entries
+PARTITIONED_TABLES = ["spmc_superpixel", "spmc_segmentationentry"]
+PARTITION_KEY = "scene_id_id"
+
+
+def _partition_name(table, scene_id):
+    return f"{table}_s{int(scene_id)}"
+
+
+def is_partitioned(table="spmc_superpixel", using=None):
+    using = using or connection
+    with using.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [table])
+        return cursor.fetchone() is not None
+
+
+def _convert_table(cursor, table):
+    # Foreign keys pointing to the table could not reference a partitioned table without the partition key
+    cursor.execute(
+        "SELECT conrelid::regclass::text, conname FROM pg_constraint WHERE contype = 'f' AND confrelid = %s::regclass",
+        [table],
+    )
+    for referencing, name in cursor.fetchall():
+        cursor.execute(f'ALTER TABLE {referencing} DROP CONSTRAINT "{name}"')
+
+    # Constraints (except the primary key) and standalone indexes are recreated on the partitioned table
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = %s::regclass AND contype <> 'p'",
+        [table],
+    )
+    constraints = cursor.fetchall()
+    cursor.execute(
+        """
+        SELECT pg_get_indexdef(i.indexrelid)
+        FROM pg_index i
+        WHERE i.indrelid = %s::regclass
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)
+        """,
+        [table],
+    )
+    indexes = [row[0] for row in cursor.fetchall()]
+    cursor.execute(f"SELECT DISTINCT {PARTITION_KEY} FROM {table}")
+    scene_ids = [row[0] for row in cursor.fetchall()]
+
+    old_table = f"{table}_unpartitioned"
+    cursor.execute(f"ALTER TABLE {table} RENAME TO {old_table}")
+    cursor.execute(
+        f"CREATE TABLE {table} (LIKE {old_table} INCLUDING DEFAULTS INCLUDING IDENTITY) "
+        f"PARTITION BY LIST ({PARTITION_KEY})"
+    )
+    cursor.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+    for scene_id in scene_ids:
+        partition = _partition_name(table, scene_id)
+        cursor.execute(f"CREATE TABLE {partition} PARTITION OF {table} FOR VALUES IN (%s)", [scene_id])
+    cursor.execute(f"INSERT INTO {table} SELECT * FROM {old_table}")
+    # A serial id default is copied as is, its sequence has to be owned by the new table to survive the drop
+    cursor.execute(
+        "SELECT pg_get_serial_sequence(%s, 'id'), attidentity = '' FROM pg_attribute "
+        "WHERE attrelid = %s::regclass AND attname = 'id'",
+        [old_table, old_table],
+    )
+    sequence, is_serial = cursor.fetchone()
+    if sequence is not None and is_serial:
+        cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id")
+    else:
+        # An identity sequence of the new table starts from 1
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence(%s, 'id'), COALESCE(max(id), 0) + 1, false) FROM {table}", [table]
+        )
+    cursor.execute(f"DROP TABLE {old_table}")
+
+    cursor.execute(f"ALTER TABLE {table} ADD PRIMARY KEY (id, {PARTITION_KEY})")
+    for name, definition in constraints:
+        cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}')
+    for definition in indexes:
+        cursor.execute(definition)
+
+
+def convert_tables(using=None):
+    """
+    Convert superpixel and segmentation entry tables into partitioned ones, with a partition for every scene which
+    has rows. Tables which are already partitioned are skipped
+    """
+    using = using or connection
+    with using.cursor() as cursor:
+        for table in PARTITIONED_TABLES:
+            if not is_partitioned(table, using):
+                _convert_table(cursor, table)
+
+
+def create_scene_partitions(scene_id, using=None):
+    """
+    Create partitions of a new scene (no-op if tables are not partitioned)
+    """
+    using = using or connection
+    if not is_partitioned(using=using):
+        return
+    with using.cursor() as cursor:
+        for table in PARTITIONED_TABLES:
+            partition = _partition_name(table, scene_id)
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table} FOR VALUES IN (%s)", [scene_id]
+            )
+
+
+def drop_scene_partitions(scene_id, using=None):
+    """
+    Drop partitions of a scene together with its rows
+    :return: True if tables are partitioned, i.e. rows of the scene have been removed
+    """
+    using = using or connection
+    if not is_partitioned(using=using):
+        return False
+    with using.cursor() as cursor:
+        # Rows referencing superpixels of the scene have no foreign keys to cascade on
+        cursor.execute(
+            """
+            DELETE FROM spmc_superpixelsimplified s USING spmc_superpixel sp
+            WHERE s.super_pixel_id_id = sp.id AND sp.scene_id_id = %s
+            """,
+            [scene_id],
+        )
+        for table in reversed(PARTITIONED_TABLES):
+            partition = _partition_name(table, scene_id)
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [partition])
+            if cursor.fetchone()[0]:
+                cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {partition}")
+                cursor.execute(f"DROP TABLE {partition}")
+            else:
+                # Rows of the scene are in the default partition
+                cursor.execute(f"DELETE FROM {table} WHERE {PARTITION_KEY} = %s", [scene_id])
+    return True
@@ -0,0 +1,171 @@
+"""
+Server-side superpixel generation. The raster is segmented in square windows by a pool of processes; every window is
+read with an overlap and keeps the segments whose centroid lies in its core, with all their pixels (the overlap
+included). So segments crossing window borders are taken whole from a single window instead of being cut along the
+border. Pixels claimed by segments of two windows go to the first one, pixels claimed by none (the segmentations of
+neighbouring windows differ slightly) join the nearest segment. Labels of all windows are written into a single Int32
+GeoTIFF and polygonized with gdal_polygonize.py. Segments larger than the overlap could still be cut
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from django.contrib.gis.gdal import GDALRaster
+from scipy import ndimage
+from skimage.segmentation import felzenszwalb, slic
+
+from .models import SuperPixelAlgo
+from .utils import run_gdal_command
+
+DEFAULT_BLOCK_SIZE = 2048
+DEFAULT_OVERLAP = 64
+# Approximate side (pixels) of SLIC superpixels, SLIC itself expects the number of segments
+DEFAULT_REGION_SIZE = 20
+# GDAL data type code of Int32 bands
+GDAL_INT32 = 5
+LABELS_NAME = "labels.tif"
+POLYGONS_NAME = "superpixels.gpkg"
+
+
+def _windows(width, height, block_size):
+    for y in range(0, height, block_size):
+        for x in range(0, width, block_size):
+            yield x, y, min(block_size, width - x), min(block_size, height - y)
+
+
+def _extended(window, overlap, width, height):
+    """
+    Window grown by the overlap and clipped to the raster: x0, y0, x1, y1
+    """
+    x, y, w, h = window
+    return max(x - overlap, 0), max(y - overlap, 0), min(x + w + overlap, width), min(y + h + overlap, height)
+
+
+def _image_and_mask(bands):
+    # As in rendered tiles, the 4th band is alpha, otherwise pixels with zeros in all bands are outside of the raster
+    if len(bands) >= 4:
+        return np.dstack(bands[:3]), bands[3] > 0
+    image = np.dstack(bands)
+    return image, np.any(image != 0, axis=-1)
+
+
+def _segment(image, mask, method, params):
+    if method == SuperPixelAlgo.SLIC:
+        params = dict(params)
+        region_size = params.pop("region_size", DEFAULT_REGION_SIZE)
+        n_segments = max(int(mask.sum() / region_size**2), 1)
+        return slic(image, n_segments=n_segments, mask=mask, start_label=1, channel_axis=-1, **params)
+    if method == SuperPixelAlgo.FELZENSZWALB:
+        return felzenszwalb(image, channel_axis=-1, **params) + 1
+    raise ValueError(f"Unknown segmentation method: {method}")
+
+
+def _segment_window(args):
+    """
+    Segment a window of the raster with its overlap (runs in a pool process)
+    :return: x0, y0 of the extended window, its labels numbered from 1 (0 for pixels of segments owned by other
+        windows and outside of the raster), number of labels
+    """
+    path, method, params, window, overlap = args
+    x, y, width, height = window
+    raster = GDALRaster(path)
+    x0, y0, x1, y1 = _extended(window, overlap, raster.width, raster.height)
+    bands = [band.data(offset=(x0, y0), size=(x1 - x0, y1 - y0)) for band in raster.bands]
+    image, mask = _image_and_mask(bands)
+    if not mask.any():
+        return (x0, y0), np.zeros(mask.shape, dtype=np.int32), 0
+    labels = _segment(image, mask, method, params)
+    labels[~mask] = 0
+
+    # Centroids of segments in pixels of the extended window
+    flat = labels.ravel()
+    rows, cols = np.indices(labels.shape)
+    sizes = np.bincount(flat, minlength=flat.max() + 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cy = np.bincount(flat, weights=rows.ravel(), minlength=sizes.size) / sizes
+        cx = np.bincount(flat, weights=cols.ravel(), minlength=sizes.size) / sizes
+    top, left = y - y0, x - x0
+    owned = (sizes > 0) & (cy >= top) & (cy < top + height) & (cx >= left) & (cx < left + width)
+    owned[0] = False
+    numbering = np.zeros(sizes.size, dtype=np.int32)
+    numbering[owned] = np.arange(1, np.count_nonzero(owned) + 1, dtype=np.int32)
+    return (x0, y0), numbering[labels], int(np.count_nonzero(owned))
+
+
+def _fill_gaps(source, band, windows, overlap):
+    """
+    Assign pixels of the raster which were not claimed by any window to the nearest segment
+    """
+    for window in windows:
+        x, y, width, height = window
+        x0, y0, x1, y1 = _extended(window, overlap, source.width, source.height)
+        size = (x1 - x0, y1 - y0)
+        labels = band.data(offset=(x0, y0), size=size)
+        top, left = y - y0, x - x0
+        bottom, right = top + height, left + width
+        gaps = np.zeros(labels.shape, dtype=bool)
+        gaps[top:bottom, left:right] = labels[top:bottom, left:right] == 0
+        if not gaps.any() or not labels.any():
+            continue
+        _, mask = _image_and_mask([b.data(offset=(x0, y0), size=size) for b in source.bands])
+        gaps &= mask
+        if not gaps.any():
+            continue
+        _, (iy, ix) = ndimage.distance_transform_edt(labels == 0, return_indices=True)
+        labels[gaps] = labels[iy[gaps], ix[gaps]]
+        band.data(labels[top:bottom, left:right], offset=(x, y), size=(width, height))
+
+
+def segment_raster(raster_path, method, params, work_dir, processes=1, progress=None):
+    """
+    Generate superpixels of a raster
+    :param params: keyword arguments of the scikit-image function, plus block_size and overlap of windows (pixels)
+    :param progress: optional callable receiving percent of the raster processed
+    :return: path of a GeoPackage with superpixel polygons
+    """
+    params = dict(params)
+    block_size = params.pop("block_size", DEFAULT_BLOCK_SIZE)
+    overlap = params.pop("overlap", DEFAULT_OVERLAP)
+    source = GDALRaster(raster_path)
+    labels_path = os.path.join(work_dir, LABELS_NAME)
+    labels = GDALRaster(
+        {
+            "driver": "GTiff",
+            "name": labels_path,
+            "width": source.width,
+            "height": source.height,
+            "origin": list(source.origin),
+            "scale": list(source.scale),
+            "skew": list(source.skew),
+            "datatype": GDAL_INT32,
+            "nr_of_bands": 1,
+            "bands": [{"nodata_value": 0}],
+            "papsz_options": {"compress": "deflate", "tiled": "yes", "bigtiff": "if_safer"},
+        }
+    )
+    labels.srs = source.srs
+    band = labels.bands[0]
+
+    windows = list(_windows(source.width, source.height, block_size))
+    tasks = ((raster_path, method, params, window, overlap) for window in windows)
+    offset = 0
+    with ProcessPoolExecutor(max_workers=max(processes, 1)) as pool:
+        for done, ((x0, y0), block, count) in enumerate(pool.map(_segment_window, tasks), 1):
+            # Labels of every window are shifted to be unique across the raster
+            block[block > 0] += offset
+            offset += count
+            size = (block.shape[1], block.shape[0])
+            # Pixels already claimed by a segment of a previous window are kept
+            current = band.data(offset=(x0, y0), size=size)
+            band.data(np.where(current > 0, current, block), offset=(x0, y0), size=size)
+            if progress is not None:
+                progress(80 * done / len(windows))
+    _fill_gaps(source, band, windows, overlap)
+    if progress is not None:
+        progress(90)
+    # The dataset is flushed and closed once the last reference is gone
+    del band, labels
+
+    polygons_path = os.path.join(work_dir, POLYGONS_NAME)
+    run_gdal_command(["gdal_polygonize.py", "-q", labels_path, "-f", "GPKG", polygons_path, "superpixels", "label"])
+    return polygons_path
@@ -0,0 +1,194 @@
+"""
+Zonal statistics of superpixels. Superpixels of a scene/algo pair are rasterized once onto the grid of a raster (the
+pixel value is the zone number of the superpixel, 0 outside of superpixels), then every block of the raster is
+reduced with numpy.bincount. The cost is a few vectorized passes over the pixels regardless of the number of
+superpixels
+"""
+import io
+import os
+
+import numpy as np
+from django.conf import settings
+from django.contrib.gis.gdal import GDALRaster
+from django.db import connection, transaction
+
+from .models import StatsLayer
+from .utils import run_gdal_command
+
+BLOCK_SIZE = 2048
+ZONES_GEOJSON_NAME = "zones.geojson"
+ZONES_RASTER_NAME = "zones.tif"
+# Superpixels of a scene/algo pair in the raster srid, zone numbers follow the order of ids
+ZONES_SQL = """
+SELECT id, ST_AsGeoJSON(ST_Transform(sp, %(srid)s))
+FROM spmc_superpixel
+WHERE scene_id_id = %(scene_id)s AND algo_id_id = %(algo_id)s AND sp IS NOT NULL
+ORDER BY id
+"""
+STATS_COPY_SQL = "COPY spmc_superpixelstats (layer_id_id, super_pixel_id_id, pixel_count, features) FROM STDIN"
+# Rows sent to the database with a single COPY
+COPY_BATCH_SIZE = 100_000
+
+
+def _windows(width, height, block_size):
+    for y in range(0, height, block_size):
+        for x in range(0, width, block_size):
+            yield x, y, min(block_size, width - x), min(block_size, height - y)
+
+
+def write_zones(scene, algo, srid, path):
+    """
+    Write superpixels of a scene/algo pair into a GeoJSON with the zone number "n" of every polygon. Rows are
+    streamed with a server-side cursor
+    :return: superpixel ids, the superpixel of zone n is ids[n - 1]
+    """
+    ids = []
+    with connection.chunked_cursor() as cursor, open(path, "w") as f:
+        cursor.execute(ZONES_SQL, {"scene_id": scene.pk, "algo_id": algo.pk, "srid": srid})
+        f.write(f'{{"type":"FeatureCollection","crs":{{"type":"name","properties":{{"name":"EPSG:{srid}"}}}},')
+        f.write('"features":[')
+        for n, (sp_id, geometry) in enumerate(cursor, 1):
+            ids.append(sp_id)
+            separator = "," if n > 1 else ""
+            f.write(f'{separator}{{"type":"Feature","properties":{{"n":{n}}},"geometry":{geometry}}}')
+        f.write("]}")
+    return ids
+
+
+def rasterize_zones(zones_path, raster, path):
+    """
+    Burn zone numbers onto the grid of the raster (north-up rasters only)
+    """
+    xmin, ymin, xmax, ymax = raster.extent
+    run_gdal_command(
+        [
+            "gdal_rasterize",
+            "-q",
+            "-a",
+            "n",
+            "-ot",
+            "Int32",
+            "-init",
+            "0",
+            "-te",
+            *(str(v) for v in (xmin, ymin, xmax, ymax)),
+            "-ts",
+            str(raster.width),
+            str(raster.height),
+            "-co",
+            "COMPRESS=DEFLATE",
+            "-co",
+            "TILED=YES",
+            "-co",
+            "BIGTIFF=IF_SAFER",
+            zones_path,
+            path,
+        ]
+    )
+
+
+def stats_columns(band_count, ndvi):
+    columns = [f"b{i}_{stat}" for i in range(1, band_count + 1) for stat in ("mean", "std")]
+    if ndvi:
+        columns.append("ndvi_mean")
+    columns.append("texture_mean")
+    return columns
+
+
+def zonal_stats(raster_path, zones_path, zones_count, block_size=BLOCK_SIZE):
+    """
+    Band means and standard deviations, mean NDVI (see SPMC_STATS_NDVI_BANDS) and mean gradient magnitude of the
+    band average (texture) of every zone
+    :return: pixel counts (zones_count + 1,), features (zones_count + 1, len(columns)) and names of columns, row 0
+        is outside of zones
+    """
+    raster = GDALRaster(raster_path)
+    zones_band = GDALRaster(zones_path).bands[0]
+    bands = raster.bands
+    band_count = len(bands)
+    ndvi_bands = settings.SPMC_STATS_NDVI_BANDS
+    ndvi = len(ndvi_bands) == 2 and max(ndvi_bands) <= band_count
+    n = zones_count + 1
+    # Zones of band b are shifted by b * n, so all bands are reduced with a single bincount
+    shifts = (np.arange(band_count) * n)[:, None]
+
+    counts = np.zeros(n)
+    sums = np.zeros(band_count * n)
+    squares = np.zeros(band_count * n)
+    ndvi_sums = np.zeros(n)
+    texture_sums = np.zeros(n)
+    for x, y, width, height in _windows(raster.width, raster.height, block_size):
+        zones = zones_band.data(offset=(x, y), size=(width, height)).ravel()
+        values = np.stack([band.data(offset=(x, y), size=(width, height)) for band in bands]).astype(np.float64)
+        if min(width, height) > 1:
+            gy, gx = np.gradient(values.mean(axis=0))
+            texture = np.hypot(gx, gy).ravel()
+        else:
+            texture = np.zeros(zones.size)
+        values = values.reshape(band_count, -1)
+        band_zones = (zones[None, :] + shifts).ravel()
+
+        counts += np.bincount(zones, minlength=n)
+        sums += np.bincount(band_zones, weights=values.ravel(), minlength=band_count * n)
+        squares += np.bincount(band_zones, weights=np.square(values).ravel(), minlength=band_count * n)
+        texture_sums += np.bincount(zones, weights=texture, minlength=n)
+        if ndvi:
+            red, nir = values[ndvi_bands[0] - 1], values[ndvi_bands[1] - 1]
+            total = red + nir
+            index = np.divide(nir - red, total, out=np.zeros_like(total), where=total != 0)
+            ndvi_sums += np.bincount(zones, weights=index, minlength=n)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums.reshape(band_count, n) / counts
+        stds = np.sqrt(np.maximum(squares.reshape(band_count, n) / counts - np.square(means), 0))
+        features = [feature for pair in zip(means, stds) for feature in pair]
+        if ndvi:
+            features.append(ndvi_sums / counts)
+        features.append(texture_sums / counts)
+    return counts, np.stack(features, axis=1), stats_columns(band_count, ndvi)
+
+
+def _copy_stats(rows):
+    with connection.cursor() as cursor:
+        cursor.copy_expert(STATS_COPY_SQL, io.StringIO("".join(rows)))
+
+
+def compute_stats(scene, algo, raster_path, work_dir, misc_tile=None):
+    """
+    Compute the stats layer of a scene/algo pair from a raster (the scene raster or a misc tile raster). The layer
+    is replaced as a whole, other layers of the scene are not touched
+    :return: number of superpixels with statistics
+    """
+    raster = GDALRaster(raster_path)
+    srid = raster.srs.srid if raster.srs is not None else None
+    if not srid:
+        raise ValueError("Raster should have a spatial reference system with an EPSG code")
+    zones_path = os.path.join(work_dir, ZONES_GEOJSON_NAME)
+    ids = write_zones(scene, algo, srid, zones_path)
+    if not ids:
+        return 0
+    zones_raster_path = os.path.join(work_dir, ZONES_RASTER_NAME)
+    rasterize_zones(zones_path, raster, zones_raster_path)
+    counts, features, columns = zonal_stats(raster_path, zones_raster_path, len(ids))
+
+    created = 0
+    with transaction.atomic():
+        layer, _ = StatsLayer.objects.update_or_create(
+            scene_id=scene, algo_id=algo, misc_tile_id=misc_tile, defaults={"columns": columns}
+        )
+        layer.superpixelstats_set.all().delete()
+        rows = []
+        for n, sp_id in enumerate(ids, 1):
+            # Superpixels smaller than a pixel have no statistics
+            if not counts[n]:
+                continue
+            values = ",".join(repr(float(v)) for v in features[n])
+            rows.append(f"{layer.pk}\t{sp_id}\t{int(counts[n])}\t{{{values}}}\n")
+            if len(rows) >= COPY_BATCH_SIZE:
+                _copy_stats(rows)
+                created += len(rows)
+                rows = []
+        if rows:
+            _copy_stats(rows)
+            created += len(rows)
+    return created
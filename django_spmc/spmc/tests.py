@@ -1,8 +1,57 @@
-from django.test import Client, TestCase
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import zipfile
+
+from django.contrib.admin import site
+from django.contrib.auth.models import Permission
+from django.contrib.gis.gdal import GDALRaster
+from django.contrib.gis.geos import Polygon
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, RequestFactory, TestCase, override_settings
 from django.urls import reverse
 
 from ..users.models import User
-from .models import Project, Scene
+from .admin import SceneFormAdmin
+from .jobs import claim_job, enqueue, run_job, stage_upload
+from .models import (
+    Job,
+    LandClass,
+    LandClassification,
+    MiscTile,
+    Project,
+    Scene,
+    SceneAlgo,
+    SegmentationEntry,
+    StatsLayer,
+    SuperPixel,
+    SuperPixelAlgo,
+    SuperPixelSimplified,
+    SuperPixelStats,
+    TilingSettings,
+)
+from .partitioning import convert_tables, is_partitioned
+from .segmentation import segment_raster
+from .stats import compute_stats
+from .tiles import TileCache, mbtiles_reader, pack_mbtiles, tile_bounds
+from .topology import build_topology, decode_topology
+from .utils import (
+    GeoJSONFeatureReader,
+    check_raster,
+    check_superpixels,
+    finalize_superpixel_ingest,
+    ingest_superpixels,
+    raster_bbox,
+    replace_superpixels,
+    run_gdal_command,
+    staged_path,
+)
 
 
 class HomeViewTest(TestCase):
@@ -156,3 +205,965 @@ class SelectSceneViewTestCase(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response.url, reverse("home"))
         self.assertNotIn("scene_id", self.client.session)
+
+
+def read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return result, pos
+
+
+def read_fields(data):
+    """
+    Minimal protobuf reader: yields (field number, value) pairs, length-delimited values are returned as bytes
+    """
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 2:
+            size, pos = read_varint(data, pos)
+            end = pos + size
+            value, pos = data[pos:end], end
+        elif wire_type == 1:
+            end = pos + 8
+            value, pos = data[pos:end], end
+        elif wire_type == 5:
+            end = pos + 4
+            value, pos = data[pos:end], end
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type}")
+        yield field, value
+
+
+def decode_mvt(data):
+    """
+    Decode feature ids and attributes of a Mapbox Vector Tile: {layer name: {feature id: {key: value}}}
+    """
+    layers = {}
+    for field, layer_data in read_fields(data):
+        if field != 3:
+            continue
+        name, keys, values, features = None, [], [], []
+        for layer_field, value in read_fields(layer_data):
+            if layer_field == 1:
+                name = value.decode()
+            elif layer_field == 2:
+                features.append(value)
+            elif layer_field == 3:
+                keys.append(value.decode())
+            elif layer_field == 4:
+                # Only string and integer values are used by the superpixel tiles
+                for value_field, item in read_fields(value):
+                    if value_field == 1:
+                        values.append(item.decode())
+                    elif value_field == 6:
+                        values.append((item >> 1) ^ -(item & 1))
+                    else:
+                        values.append(item)
+        decoded = {}
+        for feature_data in features:
+            feature_id, tags = None, []
+            for feature_field, value in read_fields(feature_data):
+                if feature_field == 1:
+                    feature_id = value
+                elif feature_field == 2:
+                    pos = 0
+                    while pos < len(value):
+                        tag, pos = read_varint(value, pos)
+                        tags.append(tag)
+            decoded[feature_id] = {keys[tags[i]]: values[tags[i + 1]] for i in range(0, len(tags), 2)}
+        layers[name] = decoded
+    return layers
+
+
+class SuperpixelTileViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(name="testuser", email="testuser@example.com", password="testpass")
+        self.project = Project.objects.create(name="Test Project")
+        self.scene = Scene.objects.create(proj_id=self.project, name="Test Scene")
+        self.algo = SuperPixelAlgo.objects.create(name="Test Algo")
+        SuperPixel.objects.create(
+            scene_id=self.scene, algo_id=self.algo, sp=Polygon.from_bbox((37.0, 55.0, 37.001, 55.001))
+        )
+
+    def tile_url(self, z, x, y):
+        return reverse(
+            "api:superpixels-tile",
+            kwargs={"scene_id": self.scene.id, "algo_id": self.algo.id, "z": z, "x": x, "y": y},
+        )
+
+    def test_tile_requires_authentication(self):
+        response = self.client.get(self.tile_url(0, 0, 0))
+        self.assertEqual(response.status_code, 403)
+
+    def test_tile_out_of_range(self):
+        self.client.login(email="testuser@example.com", password="testpass")
+        response = self.client.get(self.tile_url(1, 2, 0))
+        self.assertEqual(response.status_code, 404)
+
+    def test_tile_with_superpixel(self):
+        self.client.login(email="testuser@example.com", password="testpass")
+        response = self.client.get(self.tile_url(0, 0, 0))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/vnd.mapbox-vector-tile")
+        self.assertGreater(len(response.content), 0)
+
+    def test_tile_features_carry_user_labels(self):
+        labelled = SuperPixel.objects.create(
+            scene_id=self.scene, algo_id=self.algo, sp=Polygon.from_bbox((37.002, 55.0, 37.003, 55.001))
+        )
+        unlabelled = SuperPixel.objects.exclude(id=labelled.id).get()
+        forest = LandClass.objects.create(name="Forest", color="#00ff00")
+        water = LandClass.objects.create(name="Water", color="#0000ff")
+        LandClassification.objects.create(project_id=self.project, land_class_id=forest)
+        LandClassification.objects.create(project_id=self.project, land_class_id=water)
+        other = User.objects.create_user(name="other", email="other@example.com", password="testpass")
+        SegmentationEntry.objects.create(
+            scene_id=self.scene, super_pixel_id=labelled, land_class_id=forest, user_id=self.user
+        )
+        # Labels of other users must not leak into the tile
+        SegmentationEntry.objects.create(
+            scene_id=self.scene, super_pixel_id=unlabelled, land_class_id=water, user_id=other
+        )
+        self.client.login(email="testuser@example.com", password="testpass")
+        response = self.client.get(self.tile_url(0, 0, 0))
+        features = decode_mvt(response.content)["superpixels"]
+        self.assertEqual(set(features), {labelled.id, unlabelled.id})
+        self.assertEqual(features[labelled.id], {"land_class_id": forest.id, "color": "#00ff00"})
+        self.assertNotIn("land_class_id", features[unlabelled.id])
+
+
+class SuperpixelsApiTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(name="testuser", email="testuser@example.com", password="testpass")
+        self.project = Project.objects.create(name="Test Project")
+        self.scene = Scene.objects.create(proj_id=self.project, name="Test Scene")
+        self.algo = SuperPixelAlgo.objects.create(name="Test Algo")
+        self.sp = SuperPixel.objects.create(
+            scene_id=self.scene, algo_id=self.algo, sp=Polygon.from_bbox((37.0, 55.0, 37.001, 55.001))
+        )
+        self.forest = LandClass.objects.create(name="Forest", color="#00ff00")
+        self.water = LandClass.objects.create(name="Water", color="#0000ff")
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        topology_root = override_settings(SPMC_TOPOLOGY_ROOT=self.tmp_dir.name)
+        topology_root.enable()
+        self.addCleanup(topology_root.disable)
+        LandClassification.objects.create(project_id=self.project, land_class_id=self.forest)
+        LandClassification.objects.create(project_id=self.project, land_class_id=self.water)
+        self.client.login(email="testuser@example.com", password="testpass")
+
+    def save(self, upd):
+        return self.client.post(reverse("api:superpixels-save-sp"), {"upd": upd}, content_type="application/json")
+
+    def test_save_sp_upserts_entry(self):
+        self.save([{"superpixel_id": self.sp.id, "class_id": self.forest.id, "scene_id": self.scene.id}])
+        response = self.save([{"superpixel_id": self.sp.id, "class_id": self.water.id, "scene_id": self.scene.id}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["saved"], 1)
+        entry = SegmentationEntry.objects.get(super_pixel_id=self.sp, user_id=self.user)
+        self.assertEqual(entry.land_class_id, self.water)
+
+    def test_save_sp_rejects_non_object_items(self):
+        response = self.save(
+            [1, "x", {"superpixel_id": self.sp.id, "class_id": self.forest.id, "scene_id": self.scene.id}]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["saved"], 1)
+        self.assertEqual([item["index"] for item in response.json()["rejected"]], [0, 1])
+        self.assertEqual(self.save({"superpixel_id": self.sp.id}).status_code, 400)
+
+    def test_save_sp_reports_rejected_items(self):
+        response = self.save(
+            [
+                {"superpixel_id": self.sp.id, "class_id": self.forest.id, "scene_id": self.scene.id},
+                {"superpixel_id": self.sp.id + 1, "class_id": self.forest.id, "scene_id": self.scene.id},
+                {"superpixel_id": self.sp.id, "class_id": self.water.id + 1, "scene_id": self.scene.id},
+            ]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["saved"], 1)
+        self.assertEqual([item["index"] for item in response.json()["rejected"]], [1, 2])
+        self.assertEqual(SegmentationEntry.objects.count(), 1)
+
+    def test_get_sp_returns_labelled_feature_collection(self):
+        self.save([{"superpixel_id": self.sp.id, "class_id": self.forest.id, "scene_id": self.scene.id}])
+        response = self.client.post(
+            reverse("api:superpixels-get-sp"),
+            {"srid": 3857, "scene_id": self.scene.id, "algo_id": self.algo.id},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["type"], "FeatureCollection")
+        self.assertEqual(len(data["features"]), 1)
+        self.assertEqual(data["labels"], {str(self.sp.id): [self.forest.id, "#00ff00"]})
+        # Labels of a page have the same shape
+        data = self.client.post(
+            reverse("api:superpixels-get-sp"),
+            {"srid": 3857, "scene_id": self.scene.id, "algo_id": self.algo.id, "limit": 10},
+            content_type="application/json",
+        ).json()
+        self.assertEqual(data["labels"], {str(self.sp.id): [self.forest.id, "#00ff00"]})
+        self.assertEqual(data["features"][0]["properties"], {"id": self.sp.id})
+
+    def test_get_sp_colors_only_classes_of_the_project(self):
+        other = LandClass.objects.create(name="Urban", color="#ff0000")
+        self.save([{"superpixel_id": self.sp.id, "class_id": other.id, "scene_id": self.scene.id}])
+        response = self.client.post(
+            reverse("api:superpixels-get-sp"),
+            {"srid": 3857, "scene_id": self.scene.id, "algo_id": self.algo.id},
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["labels"], {str(self.sp.id): [other.id, None]})
+
+    def test_get_sp_bbox_and_pagination(self):
+        second = SuperPixel.objects.create(
+            scene_id=self.scene, algo_id=self.algo, sp=Polygon.from_bbox((37.002, 55.0, 37.003, 55.001))
+        )
+
+        def get_sp(**params):
+            data = {"srid": 4326, "scene_id": self.scene.id, "algo_id": self.algo.id, **params}
+            return self.client.post(reverse("api:superpixels-get-sp"), data, content_type="application/json").json()
+
+        page = get_sp(limit=1)
+        self.assertEqual([f["id"] for f in page["features"]], [self.sp.id])
+        page = get_sp(limit=1, cursor=page["next_cursor"])
+        self.assertEqual([f["id"] for f in page["features"]], [second.id])
+        self.assertIsNone(get_sp(limit=1, cursor=page["next_cursor"])["next_cursor"])
+        page = get_sp(bbox=[37.0015, 54.9, 37.01, 55.1])
+        self.assertEqual([f["id"] for f in page["features"]], [second.id])
+
+    def test_display_geometry_is_filled_at_ingest(self):
+        finalize_superpixel_ingest(self.scene, self.algo)
+        self.sp.refresh_from_db()
+        self.assertEqual(self.sp.sp_display.srid, 3857)
+        self.assertAlmostEqual(self.sp.sp_display.extent[0], self.sp.sp.transform(3857, clone=True).extent[0], 3)
+
+    def test_get_sp_simplified_resolution(self):
+        finalize_superpixel_ingest(self.scene, self.algo)
+        self.assertEqual(SuperPixelSimplified.objects.filter(super_pixel_id=self.sp).count(), 3)
+        response = self.client.post(
+            reverse("api:superpixels-get-sp"),
+            {"srid": 3857, "scene_id": self.scene.id, "algo_id": self.algo.id, "resolution": 6},
+            content_type="application/json",
+        )
+        [ring] = response.json()["features"][0]["geometry"]["coordinates"]
+        self.assertTrue(all(x % 5 == 0 and y % 5 == 0 for x, y in ring))
+
+    def test_get_sp_topojson_with_labels(self):
+        finalize_superpixel_ingest(self.scene, self.algo)
+        self.save([{"superpixel_id": self.sp.id, "class_id": self.forest.id, "scene_id": self.scene.id}])
+        response = self.client.post(
+            reverse("api:superpixels-get-sp"),
+            {"srid": 3857, "scene_id": self.scene.id, "algo_id": self.algo.id, "format": "topojson"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["type"], "Topology")
+        self.assertEqual(data["labels"], {str(self.sp.id): [self.forest.id, "#00ff00"]})
+        self.assertEqual(decode_topology(data).keys(), {self.sp.id})
+
+    def test_get_sp_geometry_cache_is_invalidated_by_ingest(self):
+        finalize_superpixel_ingest(self.scene, self.algo)
+
+        def get_sp():
+            data = {"srid": 3857, "scene_id": self.scene.id, "algo_id": self.algo.id}
+            return self.client.post(reverse("api:superpixels-get-sp"), data, content_type="application/json").json()
+
+        self.assertEqual(len(get_sp()["features"]), 1)
+        self.save([{"superpixel_id": self.sp.id, "class_id": self.forest.id, "scene_id": self.scene.id}])
+        # Labels are not cached, cached documents have the shape of pages
+        data = get_sp()
+        self.assertEqual(data["labels"], {str(self.sp.id): [self.forest.id, "#00ff00"]})
+        self.assertEqual(data["features"][0]["properties"], {"id": self.sp.id})
+        self.assertIsNone(data["next_cursor"])
+        SuperPixel.objects.create(
+            scene_id=self.scene, algo_id=self.algo, sp=Polygon.from_bbox((37.002, 55.0, 37.003, 55.001))
+        )
+        self.assertEqual(len(get_sp()["features"]), 1)
+        finalize_superpixel_ingest(self.scene, self.algo)
+        self.assertEqual(len(get_sp()["features"]), 2)
+
+    def test_ingest_into_new_pair(self):
+        algo = SuperPixelAlgo.objects.create(name="New Algo")
+        SuperPixel.objects.create(
+            scene_id=self.scene, algo_id=algo, sp=Polygon.from_bbox((37.0, 55.0, 37.001, 55.001))
+        )
+        finalize_superpixel_ingest(self.scene, algo)
+        pair = SceneAlgo.objects.get(scene_id=self.scene, algo_id=algo)
+        self.assertEqual((pair.sp_count, pair.version), (1, 1))
+
+    def test_emptied_pair_keeps_its_version(self):
+        finalize_superpixel_ingest(self.scene, self.algo)
+        SuperPixel.objects.all().delete()
+        finalize_superpixel_ingest(self.scene, self.algo)
+        pair = SceneAlgo.objects.get(scene_id=self.scene, algo_id=self.algo)
+        self.assertEqual((pair.sp_count, pair.version), (0, 2))
+        # Cache keys of a later ingest never match the ones of the first version
+        SuperPixel.objects.create(scene_id=self.scene, algo_id=self.algo, sp=self.sp.sp)
+        finalize_superpixel_ingest(self.scene, self.algo)
+        self.assertEqual(SceneAlgo.objects.get(pk=pair.pk).version, 3)
+
+    def test_changes_since_revision(self):
+        url = reverse("api:superpixels-changes")
+        params = {"scene_id": self.scene.id, "algo_id": self.algo.id}
+        revision = self.client.get(url, params).json()["revision"]
+        self.save([{"superpixel_id": self.sp.id, "class_id": self.forest.id, "scene_id": self.scene.id}])
+        response = self.client.get(url, {**params, "since": revision}).json()
+        self.assertEqual(response["revision"], revision + 1)
+        self.assertEqual(response["changes"], [[self.sp.id, self.forest.id, "#00ff00"]])
+        self.assertEqual(self.client.get(url, {**params, "since": response["revision"]}).json()["changes"], [])
+
+    def test_catalogue_is_refreshed_at_ingest(self):
+        finalize_superpixel_ingest(self.scene, self.algo)
+        response = self.client.get(reverse("api:superpixels-catalogue"), {"proj_id": self.project.id})
+        self.assertEqual(response.status_code, 200)
+        [pair] = response.json()
+        self.assertEqual((pair["scene_id"], pair["algo_id"], pair["sp_count"]), (self.scene.id, self.algo.id, 1))
+        self.assertGreater(pair["area"], 0)
+        SuperPixel.objects.all().delete()
+        finalize_superpixel_ingest(self.scene, self.algo)
+        self.assertEqual(
+            self.client.get(reverse("api:superpixels-catalogue"), {"proj_id": self.project.id}).json(), []
+        )
+
+    def test_topology_file_of_the_current_version(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            finalize_superpixel_ingest(self.scene, self.algo)
+        first = SceneAlgo.objects.get(scene_id=self.scene).topology_path
+        self.assertTrue(os.path.exists(first))
+        with self.captureOnCommitCallbacks(execute=True):
+            finalize_superpixel_ingest(self.scene, self.algo)
+        # Only the topology of the new version is kept
+        second = SceneAlgo.objects.get(scene_id=self.scene).topology_path
+        self.assertNotEqual(first, second)
+        self.assertEqual(os.listdir(os.path.dirname(second)), [os.path.basename(second)])
+
+
+class GeoJSONFeatureReaderTests(TestCase):
+    def test_reads_features_across_chunk_boundaries(self):
+        collection = {
+            "type": "FeatureCollection",
+            "crs": {"type": "name", "properties": {"name": "urn:ogc:def:crs:EPSG::32637"}},
+            "features": [
+                {"type": "Feature", "properties": {"id": i}, "geometry": {"type": "Polygon", "coordinates": []}}
+                for i in range(3)
+            ],
+        }
+        json_file = SimpleUploadedFile("sp.geojson", json.dumps(collection, indent=2).encode("utf-8"))
+        reader = GeoJSONFeatureReader(json_file, chunk_size=7)
+        self.assertEqual([feature["properties"]["id"] for feature in reader], [0, 1, 2])
+        self.assertEqual(reader.srid, 32637)
+
+    def test_crs_after_features_is_rejected(self):
+        collection = {
+            "type": "FeatureCollection",
+            "features": [{"type": "Feature", "properties": {}, "geometry": {"type": "Polygon", "coordinates": []}}],
+            "crs": {"type": "name", "properties": {"name": "urn:ogc:def:crs:EPSG::32637"}},
+        }
+        json_file = SimpleUploadedFile("sp.geojson", json.dumps(collection).encode("utf-8"))
+        with self.assertRaisesMessage(ValidationError, "crs must precede features"):
+            list(GeoJSONFeatureReader(json_file, chunk_size=7))
+
+
+class GeoJSONValidationTests(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.project = Project.objects.create(name="Test Project")
+        self.bbox = Polygon.from_bbox((37.0, 55.0, 37.01, 55.01))
+        self.bbox.srid = 4326
+        self.scene = Scene.objects.create(proj_id=self.project, name="Test Scene", bbox=self.bbox)
+        self.algo = SuperPixelAlgo.objects.create(name="Test Algo")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def upload(self, *polygons):
+        features = [
+            {"type": "Feature", "properties": {}, "geometry": {"type": "Polygon", "coordinates": [list(ring)]}}
+            for ring in polygons
+        ]
+        collection = {"type": "FeatureCollection", "features": features}
+        return SimpleUploadedFile("sp.geojson", json.dumps(collection).encode("utf-8"))
+
+    def test_superpixels_are_checked_and_staged_for_ingest(self):
+        inside = Polygon.from_bbox((37.001, 55.001, 37.002, 55.002))
+        with override_settings(SPMC_STAGING_ROOT=self.tmp_dir.name):
+            path = stage_upload(self.upload(inside.coords[0], inside.coords[0]))
+        check_superpixels(path)
+        self.assertEqual(ingest_superpixels(self.scene, self.algo, path), 2)
+        self.assertTrue(SuperPixel.objects.first().sp.equals(inside))
+
+    def test_cheap_checks_reject_unreadable_files(self):
+        path = os.path.join(self.tmp_dir.name, "sp.geojson")
+        for content, message in (
+            (b"[]", "Could not read GeoJSON file"),
+            (b'{"type": "FeatureCollection", "features": []}', "does not contain any polygons"),
+            (
+                b'{"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {}, '
+                b'"geometry": {"type": "Point", "coordinates": [37, 55]}}]}',
+                "only Polygon features",
+            ),
+        ):
+            with open(path, "wb") as f:
+                f.write(content)
+            with self.assertRaisesMessage(ValidationError, message):
+                check_superpixels(path)
+
+    def test_invalid_polygons_fail_the_ingest_job(self):
+        outside = Polygon.from_bbox((38, 56, 38.001, 56.001))
+        bowtie = ((37.001, 55.001), (37.002, 55.002), (37.002, 55.001), (37.001, 55.002), (37.001, 55.001))
+        for ring, message in ((outside.coords[0], "outside the scene bounding box"), (bowtie, "Invalid polygon")):
+            with override_settings(SPMC_STAGING_ROOT=self.tmp_dir.name):
+                path = stage_upload(self.upload(ring))
+            # Polygons are not read by the cheap checks of the admin form
+            check_superpixels(path)
+            job = enqueue(Job.SUPERPIXELS, self.scene, path=path, algo_id=self.algo.id)
+            run_job(job)
+            job.refresh_from_db()
+            self.assertEqual(job.state, Job.FAILED)
+            self.assertIn(message, job.log)
+            self.assertNotIn("Traceback", job.log)
+        self.assertFalse(SuperPixel.objects.exists())
+
+    def test_import_command_reads_ogr_datasets(self):
+        inside = Polygon.from_bbox((37.001, 55.001, 37.002, 55.002))
+        geojson = os.path.join(self.tmp_dir.name, "sp.geojson")
+        with open(geojson, "wb") as f:
+            f.write(self.upload(inside.coords[0]).read())
+        gpkg = os.path.join(self.tmp_dir.name, "sp.gpkg")
+        run_gdal_command(["ogr2ogr", "-f", "GPKG", "-t_srs", "EPSG:32637", gpkg, geojson])
+        call_command("spmc_import_superpixels", self.scene.pk, self.algo.pk, gpkg, stdout=io.StringIO())
+        sp = SuperPixel.objects.get(scene_id=self.scene)
+        self.assertTrue(sp.sp.equals_exact(inside, tolerance=1e-7))
+        self.assertEqual(SceneAlgo.objects.get(scene_id=self.scene).sp_count, 1)
+
+    def test_zipped_shapefile_upload(self):
+        inside = Polygon.from_bbox((37.001, 55.001, 37.002, 55.002))
+        geojson = os.path.join(self.tmp_dir.name, "sp.geojson")
+        with open(geojson, "wb") as f:
+            f.write(self.upload(inside.coords[0]).read())
+        shp_dir = os.path.join(self.tmp_dir.name, "shp")
+        run_gdal_command(["ogr2ogr", "-f", "ESRI Shapefile", shp_dir, geojson, "-nln", "sp"])
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w") as zf:
+            for name in os.listdir(shp_dir):
+                zf.write(os.path.join(shp_dir, name), name)
+        with override_settings(SPMC_STAGING_ROOT=self.tmp_dir.name):
+            path = stage_upload(SimpleUploadedFile("sp.zip", archive.getvalue()))
+        check_superpixels(path)
+        self.assertEqual(ingest_superpixels(self.scene, self.algo, path), 1)
+        # A bare .shp could not be read without its siblings
+        with self.assertRaises(ValidationError):
+            SceneFormAdmin.base_fields["json_file"].run_validators(SimpleUploadedFile("sp.shp", b""))
+
+    def test_failed_replace_keeps_previous_superpixels(self):
+        inside = Polygon.from_bbox((37.001, 55.001, 37.002, 55.002))
+        outside = Polygon.from_bbox((38, 56, 38.001, 56.001))
+        paths = []
+        for name, rings in (("valid.geojson", [inside]), ("invalid.geojson", [inside, outside])):
+            paths.append(os.path.join(self.tmp_dir.name, name))
+            with open(paths[-1], "wb") as f:
+                f.write(self.upload(*(ring.coords[0] for ring in rings)).read())
+        replace_superpixels(self.scene, self.algo, paths[0])
+        sp = SuperPixel.objects.get(scene_id=self.scene)
+        user = User.objects.create_user(name="testuser", email="testuser@example.com", password="testpass")
+        land_class = LandClass.objects.create(name="Forest", color="#00ff00")
+        SegmentationEntry.objects.create(
+            scene_id=self.scene, super_pixel_id=sp, land_class_id=land_class, user_id=user
+        )
+        with self.assertRaises(ValidationError):
+            replace_superpixels(self.scene, self.algo, paths[1])
+        self.assertEqual(list(SuperPixel.objects.filter(scene_id=self.scene)), [sp])
+        self.assertEqual(SegmentationEntry.objects.filter(super_pixel_id=sp).count(), 1)
+        self.assertEqual(SceneAlgo.objects.get(scene_id=self.scene).sp_count, 1)
+        # A successful replace drops labels of the previous superpixels
+        replace_superpixels(self.scene, self.algo, paths[0])
+        self.assertFalse(SuperPixel.objects.filter(id=sp.id).exists())
+        self.assertFalse(SegmentationEntry.objects.exists())
+
+
+class UploadCheckTests(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def raster_upload(self, datatype=1, srs=True):
+        path = os.path.join(self.tmp_dir.name, "raster.tif")
+        GDALRaster(
+            {
+                "driver": "GTiff",
+                "name": path,
+                "srid": 32637,
+                "width": 4,
+                "height": 4,
+                "origin": [500000, 6100000],
+                "scale": [10, -10],
+                "datatype": datatype,
+                "bands": [{"data": list(range(16))}],
+            }
+        )
+        if not srs:
+            run_gdal_command(["gdal_edit.py", "-unsetsrs", path])
+        with open(path, "rb") as f:
+            return SimpleUploadedFile("raster.tif", f.read())
+
+    def test_staged_path_of_temporary_upload(self):
+        upload = TemporaryUploadedFile("raster.tif", "image/tiff", 3, None)
+        upload.write(b"abc")
+        upload.flush()
+        self.assertEqual(staged_path(upload), upload.temporary_file_path())
+        upload.close()
+
+    def test_staged_path_of_in_memory_upload(self):
+        upload = SimpleUploadedFile("raster.tif", b"abc")
+        path = staged_path(upload)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"abc")
+        # The file is written once and reused, its extension is kept for GDAL drivers
+        self.assertEqual(staged_path(upload), path)
+        self.assertTrue(path.endswith(".tif"))
+
+    def test_invalid_form_does_not_stage_superpixels(self):
+        collection = {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "properties": {},
+                    "geometry": {
+                        "type": "Polygon",
+                        "coordinates": [Polygon.from_bbox((37, 55, 37.1, 55.1)).coords[0]],
+                    },
+                }
+            ],
+        }
+        upload = SimpleUploadedFile("sp.geojson", json.dumps(collection).encode("utf-8"))
+        with override_settings(SPMC_STAGING_ROOT=self.tmp_dir.name):
+            # A new scene without raster is rejected, the superpixel file is checked but not staged
+            form = SceneFormAdmin(data={}, files={"json_file": upload})
+            self.assertFalse(form.is_valid())
+        self.assertIn("image_file", form.errors)
+        self.assertNotIn("json_file", form.errors)
+        self.assertEqual(os.listdir(self.tmp_dir.name), [])
+
+    def test_check_raster(self):
+        check_raster(self.raster_upload())
+        for upload, message in (
+            (SimpleUploadedFile("raster.tif", b"not a raster"), "Could not read raster"),
+            (self.raster_upload(srs=False), "no spatial reference system"),
+            (self.raster_upload(datatype=6), "should be of a Bytes type"),
+        ):
+            with self.assertRaisesMessage(ValidationError, message):
+                check_raster(upload)
+
+
+class JobTests(TestCase):
+    def setUp(self):
+        self.project = Project.objects.create(name="Test Project")
+        self.scene = Scene.objects.create(proj_id=self.project, name="Test Scene")
+        self.algo = SuperPixelAlgo.objects.create(name="Test Algo")
+
+    def test_claim_job_takes_oldest_pending_job(self):
+        first = enqueue(Job.SUPERPIXELS, self.scene, path="/nonexistent/first.geojson", algo_id=self.algo.id)
+        enqueue(Job.SUPERPIXELS, self.scene, path="/nonexistent/second.geojson", algo_id=self.algo.id)
+        job = claim_job()
+        self.assertEqual(job.pk, first.pk)
+        self.assertEqual(job.state, Job.RUNNING)
+        self.assertEqual(job.attempts, 1)
+
+    def test_failed_job_keeps_log(self):
+        enqueue(Job.SUPERPIXELS, self.scene, path="/nonexistent/sp.geojson", algo_id=self.algo.id)
+        run_job(claim_job())
+        job = Job.objects.get()
+        self.assertEqual(job.state, Job.FAILED)
+        self.assertIn("FileNotFoundError", job.log)
+        self.assertIsNone(claim_job())
+
+
+class TilingSettingsTests(TestCase):
+    def setUp(self):
+        self.project = Project.objects.create(name="Test Project")
+        self.scene = Scene.objects.create(proj_id=self.project, name="Test Scene")
+
+    def test_scene_settings_take_precedence(self):
+        TilingSettings.objects.create(proj_id=self.project, max_zoom=16, processes=2)
+        self.assertEqual(TilingSettings.for_target(self.scene).max_zoom, 16)
+        TilingSettings.objects.create(scene_id=self.scene, max_zoom=14, processes=8)
+        tiling = TilingSettings.for_target(self.scene)
+        self.assertEqual(tiling.gdal2tiles_args(), ["-z", "10-14", "-r", "bilinear", "--processes=8"])
+
+    def test_defaults_without_settings(self):
+        tiling = TilingSettings.for_target(self.scene)
+        self.assertIsNone(tiling.pk)
+        self.assertEqual(tiling.min_zoom, 10)
+        self.assertEqual(tiling.max_zoom, 18)
+
+
+class CogTilesTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(name="testuser", email="testuser@example.com", password="testpass")
+        self.project = Project.objects.create(name="Test Project")
+        self.scene = Scene.objects.create(proj_id=self.project, name="Test Scene", uuid="scene-uuid")
+
+    def test_tile_bounds(self):
+        minx, miny, maxx, maxy = tile_bounds(0, 0, 0)
+        self.assertAlmostEqual(minx, -20037508.342789244)
+        self.assertAlmostEqual(maxy, 20037508.342789244)
+        self.assertAlmostEqual(tile_bounds(1, 1, 1)[0], 0)
+        self.assertAlmostEqual(tile_bounds(1, 1, 1)[3], 0)
+
+    def test_tile_url(self):
+        self.assertEqual(self.scene.tile_url, "/media/tiles/scene-uuid/{z}/{x}/{y}.png")
+        self.scene.tiles_backend = "cog"
+        self.assertEqual(self.scene.tile_url, "/tiles/scene-uuid/{z}/{x}/{y}.png")
+
+    def test_tile_cache_evicts_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache = TileCache(root, max_bytes=25)
+            # Every write of 5% of max_bytes makes an eviction due, it is not run by put() itself
+            self.assertTrue(cache.put("a", 0, 0, 0, b"0" * 10))
+            cache.put("a", 1, 0, 0, b"1" * 10)
+            os.utime(cache._path("a", 0, 0, 0), (0, 0))
+            cache.put("a", 1, 1, 0, b"2" * 10)
+            self.assertEqual(cache.evict(), 1)
+            self.assertIsNone(cache.get("a", 0, 0, 0))
+            self.assertEqual(cache.get("a", 1, 1, 0), b"2" * 10)
+
+    def test_tile_view_requires_cog_backend(self):
+        self.client.login(email="testuser@example.com", password="testpass")
+        url = reverse("tile", kwargs={"uuid": "scene-uuid", "z": 0, "x": 0, "y": 0, "ext": "png"})
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class MBTilesTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(name="testuser", email="testuser@example.com", password="testpass")
+        self.project = Project.objects.create(name="Test Project")
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        tiles_dir = os.path.join(self.tmp_dir.name, "tiles")
+        for z, x, y in [(1, 0, 0), (1, 1, 0), (1, 1, 1)]:
+            os.makedirs(os.path.join(tiles_dir, str(z), str(x)), exist_ok=True)
+            with open(os.path.join(tiles_dir, str(z), str(x), f"{y}.png"), "wb") as f:
+                f.write(f"{z}/{x}/{y}".encode() if y else b"empty")
+        self.archive = pack_mbtiles(tiles_dir, f"{tiles_dir}.mbtiles", "png", (-180, -85, 180, 85))
+        self.scene = Scene.objects.create(
+            proj_id=self.project,
+            name="Test Scene",
+            uuid="scene-uuid",
+            tiles_path=self.archive,
+            tiles_backend="mbtiles",
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_reader_flips_rows_and_deduplicates(self):
+        self.assertEqual(mbtiles_reader.get(self.archive, 1, 1, 1)[0], b"1/1/1")
+        self.assertEqual(mbtiles_reader.get(self.archive, 1, 0, 0)[1], mbtiles_reader.get(self.archive, 1, 1, 0)[1])
+        self.assertIsNone(mbtiles_reader.get(self.archive, 1, 0, 1))
+
+    def test_reader_connection_per_thread(self):
+        connections = [mbtiles_reader._connection(self.archive)]
+        thread = threading.Thread(target=lambda: connections.append(mbtiles_reader._connection(self.archive)))
+        thread.start()
+        thread.join()
+        self.assertIs(mbtiles_reader._connection(self.archive), connections[0])
+        self.assertIsNot(connections[1], connections[0])
+
+    def test_tile_view_etag(self):
+        self.client.login(email="testuser@example.com", password="testpass")
+        self.assertIn("/tiles/scene-uuid/{z}/{x}/{y}.png?v=", self.scene.tile_url)
+        url = reverse("tile", kwargs={"uuid": "scene-uuid", "z": 1, "x": 1, "y": 1, "ext": "png"})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"1/1/1")
+        # Tiles are served to authenticated users only, shared caches must not keep them
+        self.assertTrue(response["Cache-Control"].startswith("private,"))
+        self.assertIn("immutable", response["Cache-Control"])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        missing = reverse("tile", kwargs={"uuid": "scene-uuid", "z": 1, "x": 0, "y": 1, "ext": "png"})
+        self.assertEqual(self.client.get(missing).status_code, 404)
+
+
+class TopologyTests(TestCase):
+    def test_shared_edges_are_stored_once(self):
+        left = [(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]
+        right = [(1, 0), (2, 0), (2, 1), (1, 1), (1, 0)]
+        topology = build_topology([(1, [left]), (2, [right])], quantization=3)
+        # Two outer arcs and the shared edge
+        self.assertEqual(len(topology["arcs"]), 3)
+        shared = set(topology["objects"]["superpixels"]["geometries"][0]["arcs"][0]) & {
+            ~index for index in topology["objects"]["superpixels"]["geometries"][1]["arcs"][0]
+        }
+        self.assertEqual(len(shared), 1)
+        decoded = decode_topology(topology)
+        self.assertEqual(set(decoded[1][0]), set(left))
+        self.assertEqual(set(decoded[2][0]), set(right))
+        # Polygons could be streamed when the extent is known
+        streamed = build_topology(iter([(1, [left]), (2, [right])]), quantization=3, extent=(0, 0, 2, 1))
+        self.assertEqual(streamed, topology)
+
+
+class PartitioningTests(TestCase):
+    def setUp(self):
+        self.project = Project.objects.create(name="Test Project")
+        self.algo = SuperPixelAlgo.objects.create(name="Test Algo")
+        self.scene = Scene.objects.create(proj_id=self.project, name="Test Scene")
+        SuperPixel.objects.create(
+            scene_id=self.scene, algo_id=self.algo, sp=Polygon.from_bbox((37, 55, 37.001, 55.001))
+        )
+
+    def partitions(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = 'spmc_superpixel'::regclass"
+            )
+            return {row[0] for row in cursor.fetchall()}
+
+    def test_scene_partitions_lifecycle(self):
+        convert_tables()
+        self.assertTrue(is_partitioned())
+        self.assertIn(f"spmc_superpixel_s{self.scene.pk}", self.partitions())
+        self.assertEqual(SuperPixel.objects.filter(scene_id=self.scene).count(), 1)
+        # Ids keep being generated by a sequence owned by the new table
+        with connection.cursor() as cursor:
+            for table in ("spmc_superpixel", "spmc_segmentationentry"):
+                cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+                self.assertIsNotNone(cursor.fetchone()[0])
+        scene = Scene.objects.create(proj_id=self.project, name="Another Scene")
+        self.assertIn(f"spmc_superpixel_s{scene.pk}", self.partitions())
+        SuperPixel.objects.create(scene_id=scene, algo_id=self.algo, sp=Polygon.from_bbox((37, 55, 37.001, 55.001)))
+        scene.delete()
+        self.assertNotIn(f"spmc_superpixel_s{scene.pk}", self.partitions())
+        self.assertEqual(SuperPixel.objects.count(), 1)
+
+
+class SceneDeletionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(name="testuser", email="testuser@example.com", password="testpass")
+        self.project = Project.objects.create(name="Test Project")
+        self.algo = SuperPixelAlgo.objects.create(name="Test Algo")
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tiles_path = os.path.join(self.tmp_dir.name, "tiles", "scene-uuid")
+        os.makedirs(os.path.join(self.tiles_path, "10", "1"))
+        topology_root = override_settings(SPMC_TOPOLOGY_ROOT=os.path.join(self.tmp_dir.name, "topology"))
+        topology_root.enable()
+        self.addCleanup(topology_root.disable)
+        self.scene = Scene.objects.create(proj_id=self.project, name="Test Scene", tiles_path=self.tiles_path)
+        MiscTile.objects.create(scene_id=self.scene, name="Test Misc", tiles_path="")
+        sp = SuperPixel.objects.create(
+            scene_id=self.scene, algo_id=self.algo, sp=Polygon.from_bbox((37, 55, 37.001, 55.001))
+        )
+        forest = LandClass.objects.create(name="Forest", color="#00ff00")
+        SegmentationEntry.objects.create(
+            scene_id=self.scene, super_pixel_id=sp, land_class_id=forest, user_id=self.user
+        )
+        finalize_superpixel_ingest(self.scene, self.algo)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_delete_confirmation_counts_and_permissions(self):
+        request = RequestFactory().get("/")
+        request.user = self.user
+        self.user.user_permissions.add(Permission.objects.get(codename="delete_scene"))
+        model_admin = site._registry[Scene]
+        objs = Scene.objects.filter(pk=self.scene.pk)
+        deleted, model_count, perms_needed, protected = model_admin.get_deleted_objects(objs, request)
+        self.assertEqual(deleted, [str(self.scene)])
+        self.assertEqual(model_count[SuperPixel._meta.verbose_name_plural], 1)
+        self.assertEqual(model_count[SegmentationEntry._meta.verbose_name_plural], 1)
+        self.assertEqual(
+            perms_needed,
+            {
+                SuperPixel._meta.verbose_name,
+                SegmentationEntry._meta.verbose_name,
+                MiscTile._meta.verbose_name,
+                SceneAlgo._meta.verbose_name,
+            },
+        )
+        self.assertEqual(protected, [])
+        request.user = User.objects.create_superuser(name="admin", email="admin@example.com", password="testpass")
+        self.assertEqual(model_admin.get_deleted_objects(objs, request)[2], set())
+
+    def test_delete_moves_tiles_to_trash_and_sweeps_them(self):
+        trash_root = os.path.join(self.tmp_dir.name, "trash")
+        with override_settings(SPMC_TRASH_ROOT=trash_root):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.scene.delete()
+            self.assertFalse(os.path.exists(self.tiles_path))
+            self.assertFalse(os.path.exists(os.path.join(self.tmp_dir.name, "topology", str(self.scene.pk))))
+            # Tiles and topology of the scene
+            self.assertEqual(len(os.listdir(trash_root)), 2)
+            self.assertEqual(SuperPixel.objects.count(), 0)
+            self.assertEqual(SuperPixelSimplified.objects.count(), 0)
+            self.assertEqual(SegmentationEntry.objects.count(), 0)
+            self.assertEqual(MiscTile.objects.count(), 0)
+            run_job(claim_job())
+            self.assertEqual(Job.objects.get().state, Job.DONE)
+            self.assertEqual(os.listdir(trash_root), [])
+
+
+class GarbageCollectorTests(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        root = self.tmp_dir.name
+        self.settings_override = override_settings(
+            MEDIA_ROOT=os.path.join(root, "media"),
+            SPMC_TILE_CACHE_ROOT=os.path.join(root, "cache"),
+            SPMC_STAGING_ROOT=os.path.join(root, "staging"),
+            SPMC_TRASH_ROOT=os.path.join(root, "trash"),
+        )
+        self.settings_override.enable()
+        project = Project.objects.create(name="Test Project")
+        self.scene = Scene.objects.create(proj_id=project, name="Test Scene")
+        self.scene.gen_uuid()
+        self.scene.save()
+        self.live = self.make_tiles(self.scene.uuid)
+        self.orphan = self.make_tiles("3f0e7a52-2b55-4e7a-9a43-1d1f3c1f0a11")
+        self.recent = self.make_tiles("5b2f1d7e-8c3a-4a4e-b6a2-7e9f0c2d4b33", age=0)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tmp_dir.cleanup()
+
+    def make_tiles(self, name, age=48 * 3600):
+        path = os.path.join(self.tmp_dir.name, "media", "tiles", name)
+        os.makedirs(os.path.join(path, "10", "1"))
+        with open(os.path.join(path, "10", "1", "1.png"), "wb") as f:
+            f.write(b"x" * 1024)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_dry_run_and_removal(self):
+        out = io.StringIO()
+        call_command("spmc_gc", "--dry-run", "--tmp-root", self.tmp_dir.name, stdout=out)
+        self.assertIn(self.orphan, out.getvalue())
+        self.assertNotIn(self.live, out.getvalue())
+        self.assertNotIn(self.recent, out.getvalue())
+        self.assertTrue(os.path.exists(self.orphan))
+        call_command("spmc_gc", "--tmp-root", self.tmp_dir.name, stdout=io.StringIO())
+        self.assertFalse(os.path.exists(self.orphan))
+        self.assertTrue(os.path.exists(self.live))
+        self.assertTrue(os.path.exists(self.recent))
+
+    def test_staged_files_of_unfinished_jobs_are_kept(self):
+        staged = {}
+        for name in ("superpixels", "raster", "orphan"):
+            path = os.path.join(self.tmp_dir.name, "staging", name)
+            os.makedirs(path)
+            with open(os.path.join(path, "file"), "wb") as f:
+                f.write(b"x")
+            os.utime(path, (0, 0))
+            staged[name] = os.path.join(path, "file")
+        job = enqueue(Job.SUPERPIXELS, self.scene, path=staged["superpixels"], raster=staged["raster"], algo_id=1)
+        Job.objects.filter(pk=job.pk).update(state=Job.FAILED)
+        call_command("spmc_gc", "--tmp-root", self.tmp_dir.name, stdout=io.StringIO())
+        self.assertTrue(os.path.exists(staged["superpixels"]))
+        self.assertTrue(os.path.exists(staged["raster"]))
+        self.assertFalse(os.path.exists(staged["orphan"]))
+
+
+class RasterSuperpixelTests(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.raster_path = os.path.join(self.tmp_dir.name, "scene.tif")
+        # Two fields of different colors side by side, 64x32 pixels of 10 m
+        band = [0 if x < 32 else 200 for _ in range(32) for x in range(64)]
+        GDALRaster(
+            {
+                "driver": "GTiff",
+                "name": self.raster_path,
+                "srid": 32637,
+                "width": 64,
+                "height": 32,
+                "origin": [500000, 6100000],
+                "scale": [10, -10],
+                "datatype": 1,
+                "bands": [{"data": [v + 10 for v in band]}, {"data": band}, {"data": band}],
+            }
+        )
+        project = Project.objects.create(name="Test Project")
+        self.scene = Scene.objects.create(proj_id=project, name="Test Scene", bbox=raster_bbox(self.raster_path, 4326))
+        self.algo = SuperPixelAlgo.objects.create(
+            name="Felzenszwalb", method=SuperPixelAlgo.FELZENSZWALB, params={"scale": 100, "block_size": 24}
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_zonal_stats_of_superpixels(self):
+        halves = []
+        for minx in (500000, 500320):
+            half = Polygon.from_bbox((minx, 6099680, minx + 320, 6100000))
+            half.srid = 32637
+            halves.append(
+                SuperPixel.objects.create(scene_id=self.scene, algo_id=self.algo, sp=half.transform(4326, True))
+            )
+        finalize_superpixel_ingest(self.scene, self.algo)
+        self.assertEqual(compute_stats(self.scene, self.algo, self.raster_path, self.tmp_dir.name), 2)
+        layer = StatsLayer.objects.get(scene_id=self.scene, misc_tile_id=None)
+        left, right = (SuperPixelStats.objects.get(layer_id=layer, super_pixel_id=sp) for sp in halves)
+        self.assertEqual((left.pixel_count, right.pixel_count), (1024, 1024))
+        b1_mean, b2_std = layer.columns.index("b1_mean"), layer.columns.index("b2_std")
+        self.assertAlmostEqual(left.features[b1_mean], 10)
+        self.assertAlmostEqual(right.features[b1_mean], 210)
+        self.assertAlmostEqual(right.features[b2_std], 0)
+
+    def test_neighbours_and_flood_fill(self):
+        cells = []
+        for minx in range(500000, 500640, 160):
+            cell = Polygon.from_bbox((minx, 6099680, minx + 160, 6100000))
+            cell.srid = 32637
+            cells.append(
+                SuperPixel.objects.create(scene_id=self.scene, algo_id=self.algo, sp=cell.transform(4326, True)).id
+            )
+        finalize_superpixel_ingest(self.scene, self.algo)
+        User.objects.create_user(name="testuser", email="testuser@example.com", password="testpass")
+        self.client.login(email="testuser@example.com", password="testpass")
+        url = reverse("api:superpixels-neighbours")
+        params = {"scene_id": self.scene.id, "algo_id": self.algo.id, "sp_id": cells[1]}
+        self.assertEqual(self.client.get(url, params).json()["ids"], [cells[0], cells[2]])
+        self.assertEqual(self.client.get(url, {**params, "tolerance": 1}).status_code, 404)
+
+        compute_stats(self.scene, self.algo, self.raster_path, self.tmp_dir.name)
+        # The fill stops at the border of the two fields
+        ids = self.client.get(url, {**params, "tolerance": 1}).json()["ids"]
+        self.assertEqual(sorted(ids), cells[:2])
+        ids = self.client.get(url, {**params, "tolerance": 1000, "limit": 3}).json()["ids"]
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(self.client.get(url, {**params, "limit": 0}).status_code, 400)
+
+    def test_segments_crossing_windows_are_not_cut(self):
+        # Both fields span several 24 pixel windows, every window sees the whole raster with the overlap
+        params = {"scale": 100, "sigma": 0, "block_size": 24, "overlap": 40}
+        polygons_path = segment_raster(self.raster_path, self.algo.method, params, self.tmp_dir.name, processes=2)
+        self.assertEqual(replace_superpixels(self.scene, self.algo, polygons_path), 2)
+        areas = [sp.sp.transform(32637, clone=True).area for sp in SuperPixel.objects.filter(scene_id=self.scene)]
+        self.assertEqual([round(area) for area in areas], [320 * 320, 320 * 320])
+
+    def test_generated_superpixels_cover_the_raster(self):
+        polygons_path = segment_raster(
+            self.raster_path, self.algo.method, self.algo.params, self.tmp_dir.name, processes=2
+        )
+        created = replace_superpixels(self.scene, self.algo, polygons_path)
+        self.assertGreaterEqual(created, 2)
+        area = sum(sp.sp.transform(32637, clone=True).area for sp in SuperPixel.objects.filter(scene_id=self.scene))
+        self.assertAlmostEqual(area, 640 * 320, delta=1)
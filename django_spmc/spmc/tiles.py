@@ -0,0 +1,338 @@
+"""
+Tile backends other than a folder of pre-rendered tiles served as media files:
+- Cloud-Optimized GeoTIFFs with XYZ tiles rendered on demand
+- MBTiles archives, i.e. a pre-rendered pyramid packed into a single SQLite file
+"""
+import hashlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import threading
+from functools import reduce
+
+from django.conf import settings
+from django.contrib.gis.gdal import GDALRaster
+from PIL import Image, ImageChops
+
+from .utils import run_gdal_command
+
+# Half of the web mercator world width
+ORIGIN_SHIFT = 20037508.342789244
+TILE_SIZE = 256
+COG_NAME = "cog.tif"
+INDEX_NAME = "index.json"
+# Mapping of TilingSettings.resampling to names used by GDALRaster.warp
+WARP_RESAMPLING = {
+    "near": "NearestNeighbour",
+    "bilinear": "Bilinear",
+    "cubic": "Cubic",
+    "cubicspline": "CubicSpline",
+    "lanczos": "Lanczos",
+    "average": "Average",
+    "mode": "Mode",
+}
+
+
+def tile_bounds(z, x, y):
+    """
+    Bounds of an XYZ tile in web mercator (EPSG:3857)
+    :return: minx, miny, maxx, maxy
+    """
+    size = 2 * ORIGIN_SHIFT / 2**z
+    minx = -ORIGIN_SHIFT + x * size
+    maxy = ORIGIN_SHIFT - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def build_cog(raster_path, uuid, tiling, progress=None):
+    """
+    Convert a raster into a web mercator Cloud-Optimized GeoTIFF with internal overviews. Every overview level is
+    also exposed as a small VRT, so tiles of low zoom levels are read from overviews instead of the full resolution
+    :return: output folder
+    """
+    output_dir = f"{settings.MEDIA_ROOT}/tiles/{uuid}"
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+    cog_path = os.path.join(output_dir, COG_NAME)
+    try:
+        run_gdal_command(
+            [
+                "gdalwarp",
+                "-t_srs",
+                "EPSG:3857",
+                "-r",
+                tiling.resampling,
+                "-multi",
+                "-wo",
+                f"NUM_THREADS={tiling.processes}",
+                "-of",
+                "COG",
+                "-co",
+                "COMPRESS=DEFLATE",
+                "-co",
+                "OVERVIEWS=AUTO",
+                "-co",
+                "BIGTIFF=IF_SAFER",
+                raster_path,
+                cog_path,
+            ],
+            progress=progress,
+        )
+        info = json.loads(run_gdal_command(["gdalinfo", "-json", cog_path]))
+        levels = [{"path": COG_NAME, "res": abs(GDALRaster(cog_path).scale.x)}]
+        for level in range(len(info["bands"][0].get("overviews", []))):
+            vrt_name = f"ovr_{level}.vrt"
+            vrt_path = os.path.join(output_dir, vrt_name)
+            run_gdal_command(
+                ["gdal_translate", "-q", "-of", "VRT", "-oo", f"OVERVIEW_LEVEL={level}", cog_path, vrt_path]
+            )
+            levels.append({"path": vrt_name, "res": abs(GDALRaster(vrt_path).scale.x)})
+    except Exception:
+        shutil.rmtree(output_dir)
+        raise
+    with open(os.path.join(output_dir, INDEX_NAME), "w") as f:
+        json.dump(levels, f)
+    return output_dir
+
+
+def _pick_level(tiles_path, resolution):
+    # The coarsest level which is still at least as detailed as the requested resolution
+    with open(os.path.join(tiles_path, INDEX_NAME)) as f:
+        levels = sorted(json.load(f), key=lambda level: level["res"])
+    suitable = [level for level in levels if level["res"] <= resolution]
+    level = suitable[-1] if suitable else levels[0]
+    return os.path.join(tiles_path, level["path"])
+
+
+def _encode_png(bands):
+    images = [Image.frombytes("L", (TILE_SIZE, TILE_SIZE), bytes(band)) for band in bands]
+    if len(images) >= 4:
+        image = Image.merge("RGBA", images[:4])
+    else:
+        rgb = images if len(images) == 3 else [images[0]] * 3
+        # Pixels outside of the raster (zeros in all bands) are transparent
+        alpha = reduce(ImageChops.lighter, images).point(lambda v: 255 if v else 0)
+        image = Image.merge("RGBA", [*rgb, alpha])
+    buf = io.BytesIO()
+    image.save(buf, "PNG")
+    return buf.getvalue()
+
+
+def _transparent_tile():
+    buf = io.BytesIO()
+    Image.new("RGBA", (TILE_SIZE, TILE_SIZE)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+# Served for tiles outside of the raster
+TRANSPARENT_TILE = _transparent_tile()
+
+
+def render_cog_tile(tiles_path, z, x, y, resampling="bilinear"):
+    """
+    Render an XYZ tile from a COG folder created by build_cog
+    :return: PNG bytes or None if the tile is outside the raster
+    """
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    resolution = (maxx - minx) / TILE_SIZE
+    source = GDALRaster(_pick_level(tiles_path, resolution))
+    sminx, sminy, smaxx, smaxy = source.extent
+    if sminx >= maxx or smaxx <= minx or sminy >= maxy or smaxy <= miny:
+        return None
+    tile = source.warp(
+        {
+            "driver": "MEM",
+            "name": "",
+            "width": TILE_SIZE,
+            "height": TILE_SIZE,
+            "srid": 3857,
+            "origin": [minx, maxy],
+            "scale": [resolution, -resolution],
+        },
+        resampling=WARP_RESAMPLING.get(resampling, "Bilinear"),
+    )
+    return _encode_png([band.data(as_memoryview=True) for band in tile.bands])
+
+
+MBTILES_SCHEMA = """
+CREATE TABLE metadata (name TEXT, value TEXT);
+CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+CREATE TABLE images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row);
+CREATE VIEW tiles AS
+    SELECT map.zoom_level, map.tile_column, map.tile_row, images.tile_data, images.tile_id
+    FROM map JOIN images ON images.tile_id = map.tile_id;
+"""
+
+
+def pack_mbtiles(tiles_dir, archive_path, tile_format, bounds, name=""):
+    """
+    Pack a folder of XYZ tiles created by gdal2tiles into a MBTiles archive. Identical tiles (e.g. empty ones) are
+    stored once, the md5 of the tile is used as its id and later as the ETag. The archive is written next to the
+    target and moved in place, so readers never see a partially written file
+    :param bounds: minx, miny, maxx, maxy in EPSG:4326
+    :return: archive path
+    """
+    tmp_path = f"{archive_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.executescript(MBTILES_SCHEMA)
+        zooms = []
+        for z_name in os.listdir(tiles_dir):
+            if not z_name.isdigit():
+                continue
+            z = int(z_name)
+            zooms.append(z)
+            for x_name in os.listdir(os.path.join(tiles_dir, z_name)):
+                x_dir = os.path.join(tiles_dir, z_name, x_name)
+                for y_name in os.listdir(x_dir):
+                    y, ext = os.path.splitext(y_name)
+                    if ext.lstrip(".") != tile_format:
+                        continue
+                    with open(os.path.join(x_dir, y_name), "rb") as f:
+                        data = f.read()
+                    tile_id = hashlib.md5(data).hexdigest()
+                    conn.execute("INSERT OR IGNORE INTO images VALUES (?, ?)", (tile_id, data))
+                    # MBTiles rows follow the TMS scheme, i.e. y axis points up
+                    conn.execute("INSERT INTO map VALUES (?, ?, ?, ?)", (z, int(x_name), 2**z - 1 - int(y), tile_id))
+        metadata = {
+            "name": name,
+            "format": tile_format,
+            "type": "overlay",
+            "bounds": ",".join(str(v) for v in bounds),
+            "minzoom": str(min(zooms, default=0)),
+            "maxzoom": str(max(zooms, default=0)),
+        }
+        conn.executemany("INSERT INTO metadata VALUES (?, ?)", metadata.items())
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, archive_path)
+    return archive_path
+
+
+class MBTilesReader:
+    """
+    Read tiles from MBTiles archives by key. Read-only connections are opened once per archive and thread and
+    reused across requests, so a connection is never shared by concurrent queries; a rebuilt archive (new mtime)
+    gets a new connection
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _connection(self, path):
+        mtime = os.stat(path).st_mtime_ns
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+        cached = connections.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        if cached is not None:
+            cached[1].close()
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        connections[path] = (mtime, conn)
+        return conn
+
+    def get(self, path, z, x, y):
+        """
+        :return: tuple of tile data and its md5 or None if the tile is missing
+        """
+        row = (
+            self._connection(path)
+            .execute(
+                "SELECT tile_data, tile_id FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (z, x, 2**z - 1 - y),
+            )
+            .fetchone()
+        )
+        return tuple(row) if row else None
+
+
+mbtiles_reader = MBTilesReader()
+
+
+class TileCache:
+    """
+    Size-bounded disk cache of rendered tiles. Least recently used tiles are evicted, the usage time is kept in
+    the file mtime, so the cache could be shared by several processes
+    """
+
+    # Eviction is due after the process has written this share of max_bytes
+    EVICT_FRACTION = 0.05
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._written = 0
+
+    def _path(self, uuid, z, x, y):
+        return os.path.join(self.root, uuid, str(z), str(x), f"{y}.png")
+
+    def get(self, uuid, z, x, y):
+        path = self._path(uuid, z, x, y)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return data
+
+    def put(self, uuid, z, x, y, data):
+        """
+        Store a tile. The cache size is not checked here, as walking the whole cache is too slow for a request
+        :return: True if an eviction is due (see evict), it is run by the EVICT_TILE_CACHE job
+        """
+        path = self._path(uuid, z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._written += len(data)
+        if self._written >= self.max_bytes * self.EVICT_FRACTION:
+            self._written = 0
+            return True
+        return False
+
+    def clear(self, uuid):
+        shutil.rmtree(os.path.join(self.root, uuid), ignore_errors=True)
+
+    def evict(self):
+        """
+        Remove least recently used tiles until the cache takes no more than 90% of max_bytes
+        :return: number of removed tiles
+        """
+        entries, total = [], 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        removed = 0
+        if total <= self.max_bytes:
+            return removed
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            removed += 1
+            total -= size
+            if total <= self.max_bytes * 0.9:
+                break
+        return removed
+
+
+tile_cache = TileCache(settings.SPMC_TILE_CACHE_ROOT, settings.SPMC_TILE_CACHE_MAX_BYTES)
@@ -0,0 +1,177 @@
+"""
+TopoJSON encoding of superpixels. Superpixels partition a scene, so almost every boundary is shared by two polygons.
+Boundaries are cut into arcs at junctions (points where more than two polygons meet), every arc is stored once and
+polygons reference arcs by index (~index for an arc used in the reverse direction). Coordinates are quantized to
+integers and delta-encoded as in the TopoJSON specification
+"""
+import json
+
+# Number of quantization steps along the larger side of the extent
+DEFAULT_QUANTIZATION = 10**6
+OBJECT_NAME = "superpixels"
+
+
+def _quantize_ring(ring, translate, scale):
+    points = []
+    for x, y in ring:
+        point = (round((x - translate[0]) / scale[0]), round((y - translate[1]) / scale[1]))
+        if not points or points[-1] != point:
+            points.append(point)
+    # Rings are stored without the closing point
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    return points
+
+
+def _find_junctions(rings):
+    """
+    Points with more (or less) than two distinct neighbours across all rings
+    """
+    neighbours = {}
+    for ring in rings:
+        n = len(ring)
+        for i, point in enumerate(ring):
+            neighbours.setdefault(point, set()).update((ring[i - 1], ring[(i + 1) % n]))
+    return {point for point, adjacent in neighbours.items() if len(adjacent) != 2}
+
+
+def _rotate_to_min(points):
+    start = points.index(min(points))
+    return points[start:] + points[:start]
+
+
+class _ArcIndex:
+    def __init__(self):
+        self.arcs = []
+        self._index = {}
+
+    def add(self, points):
+        """
+        :return: index of the arc, ~index if the same arc was already stored in the reverse direction
+        """
+        key = tuple(points)
+        if key in self._index:
+            return self._index[key]
+        reverse_key = key[::-1]
+        if reverse_key in self._index:
+            return ~self._index[reverse_key]
+        self._index[key] = len(self.arcs)
+        self.arcs.append(points)
+        return self._index[key]
+
+    def add_closed(self, ring):
+        """
+        Ring without junctions is a single closed arc, it is compared regardless of the start point and direction
+        """
+        forward = _rotate_to_min(ring)
+        key = tuple(forward + forward[:1])
+        if key in self._index:
+            return self._index[key]
+        backward = _rotate_to_min(ring[::-1])
+        reverse_key = tuple(backward + backward[:1])
+        if reverse_key in self._index:
+            return ~self._index[reverse_key]
+        return self.add(list(key))
+
+
+def _ring_arcs(ring, junctions, arc_index):
+    cut_at = [i for i, point in enumerate(ring) if point in junctions]
+    if not cut_at:
+        return [arc_index.add_closed(ring)]
+    # Start the ring at a junction, so every arc goes from one junction to the next one
+    first = cut_at[0]
+    ring = ring[first:] + ring[:first]
+    ring.append(ring[0])
+    arcs, start = [], 0
+    for i in range(1, len(ring)):
+        if ring[i] in junctions:
+            end = i + 1
+            arcs.append(arc_index.add(ring[start:end]))
+            start = i
+    return arcs
+
+
+def _delta_encode(points):
+    encoded, prev_x, prev_y = [], 0, 0
+    for x, y in points:
+        encoded.append([x - prev_x, y - prev_y])
+        prev_x, prev_y = x, y
+    return encoded
+
+
+def build_topology(polygons, quantization=DEFAULT_QUANTIZATION, extent=None):
+    """
+    Build TopoJSON topology of polygons
+    :param polygons: list of (id, rings) where rings are lists of (x, y) coordinates, exterior ring first. Any
+        iterable is read once if the extent is given, so polygons could be streamed from the database
+    :param quantization: number of quantization steps along the larger side of the extent
+    :param extent: xmin, ymin, xmax, ymax of the polygons, computed from the polygons if not provided
+    :return: TopoJSON dict with a single GeometryCollection "superpixels"
+    """
+    if extent is None:
+        xs = [x for _, rings in polygons for ring in rings for x, _ in ring]
+        ys = [y for _, rings in polygons for ring in rings for _, y in ring]
+        extent = (min(xs), min(ys), max(xs), max(ys)) if xs else None
+        del xs, ys
+    if extent is None:
+        translate, scale = [0, 0], [1, 1]
+    else:
+        xmin, ymin, xmax, ymax = extent
+        translate = [xmin, ymin]
+        step = max(xmax - xmin, ymax - ymin) / (quantization - 1) or 1
+        scale = [step, step]
+
+    # Only quantized (integer) rings are kept in memory
+    quantized = []
+    for sp_id, rings in polygons:
+        rings = [_quantize_ring(ring, translate, scale) for ring in rings]
+        # Rings collapsed by the quantization are dropped
+        quantized.append((sp_id, [ring for ring in rings if len(ring) > 2]))
+    junctions = _find_junctions(ring for _, rings in quantized for ring in rings)
+
+    arc_index = _ArcIndex()
+    geometries = []
+    for sp_id, rings in quantized:
+        if not rings:
+            continue
+        geometries.append(
+            {"type": "Polygon", "id": sp_id, "arcs": [_ring_arcs(ring, junctions, arc_index) for ring in rings]}
+        )
+    return {
+        "type": "Topology",
+        "transform": {"scale": scale, "translate": translate},
+        "objects": {OBJECT_NAME: {"type": "GeometryCollection", "geometries": geometries}},
+        "arcs": [_delta_encode(arc) for arc in arc_index.arcs],
+    }
+
+
+def decode_topology(topology):
+    """
+    Restore polygons from a topology created by build_topology
+    :return: dict of id -> list of rings with absolute coordinates
+    """
+    scale, translate = topology["transform"]["scale"], topology["transform"]["translate"]
+    arcs = []
+    for arc in topology["arcs"]:
+        x = y = 0
+        points = []
+        for dx, dy in arc:
+            x, y = x + dx, y + dy
+            points.append((x * scale[0] + translate[0], y * scale[1] + translate[1]))
+        arcs.append(points)
+    polygons = {}
+    for geometry in topology["objects"][OBJECT_NAME]["geometries"]:
+        rings = []
+        for ring_arcs in geometry["arcs"]:
+            ring = []
+            for index in ring_arcs:
+                points = arcs[index] if index >= 0 else arcs[~index][::-1]
+                # Consecutive arcs share their end points
+                ring.extend(points if not ring else points[1:])
+            rings.append(ring)
+        polygons[geometry["id"]] = rings
+    return polygons
+
+
+def dumps(topology):
+    return json.dumps(topology, separators=(",", ":"))
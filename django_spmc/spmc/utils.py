@@ -1,21 +1,492 @@
+import codecs
+import io
 import json
 import os
+import re
 import shutil
 import subprocess
 import uuid
+import zipfile
 
 from django.conf import settings
-from django.contrib.gis.gdal import GDALRaster
-from django.contrib.gis.geos import GEOSGeometry, Polygon
+from django.contrib.gis.gdal import (
+    CoordTransform,
+    DataSource,
+    GDALException,
+    GDALRaster,
+    SpatialReference,
+    SRSException,
+)
+from django.contrib.gis.geos import Polygon
 from django.core.exceptions import ValidationError
+from django.core.files import File
 from django.core.files.temp import NamedTemporaryFile
+from django.db import connection, transaction
+from django.db.models import F
 
+from . import topology
+from .models import SceneAlgo, SuperPixel, TilingSettings
 
-def handle_tiles_upload(f_obj, uuid):
-    # Process upload
-    tmp_file = NamedTemporaryFile()
-    for chunk in f_obj.chunks():
-        tmp_file.write(chunk)
+# Start of the features array of a FeatureCollection
+FEATURES_START_RE = re.compile(r'"features"\s*:\s*\[')
+CRS_KEY_RE = re.compile(r'"crs"\s*:\s*')
+# GDAL data type code of Byte bands
+GDAL_BYTE = 1
+# Recalculate the catalogue entry of a scene/algo pair from its superpixels. New entries start from version 0, the
+# version of existing ones is left to finalize_superpixel_ingest
+SCENE_ALGO_REFRESH_SQL = """
+INSERT INTO spmc_scenealgo (scene_id_id, algo_id_id, sp_count, bbox, area, version, updated_at)
+SELECT %(scene_id)s, %(algo_id)s, count(*), ST_SetSRID(ST_Envelope(ST_Extent(sp)::geometry), 4326),
+       COALESCE(sum(ST_Area(sp::geography)), 0), 0, now()
+FROM spmc_superpixel
+WHERE scene_id_id = %(scene_id)s AND algo_id_id = %(algo_id)s
+ON CONFLICT (scene_id_id, algo_id_id) DO UPDATE
+SET sp_count = EXCLUDED.sp_count, bbox = EXCLUDED.bbox, area = EXCLUDED.area, updated_at = EXCLUDED.updated_at
+"""
+# Fill the display geometry of a scene/algo pair with a single set-based statement
+SP_DISPLAY_SQL = """
+UPDATE spmc_superpixel SET sp_display = ST_Transform(sp, %(srid)s)
+WHERE scene_id_id = %(scene_id)s AND algo_id_id = %(algo_id)s AND sp_display IS NULL
+"""
+# Rebuild simplified geometries of a scene/algo pair. Snapping to a grid followed by removal of repeated and collinear
+# vertices keeps shared edges identical, polygons collapsed by snapping are skipped (full geometry is used instead)
+SP_SIMPLIFIED_SQL = """
+DELETE FROM spmc_superpixelsimplified s USING spmc_superpixel sp
+WHERE s.super_pixel_id_id = sp.id AND sp.scene_id_id = %(scene_id)s AND sp.algo_id_id = %(algo_id)s;
+INSERT INTO spmc_superpixelsimplified (super_pixel_id_id, resolution, geom)
+SELECT sp.id, r.resolution, simplified.geom
+FROM spmc_superpixel sp
+CROSS JOIN unnest(%(resolutions)s::float8[]) AS r(resolution)
+CROSS JOIN LATERAL (
+    SELECT ST_Simplify(ST_SnapToGrid(COALESCE(sp.sp_display, ST_Transform(sp.sp, 3857)), r.resolution), 0) AS geom
+) simplified
+WHERE sp.scene_id_id = %(scene_id)s AND sp.algo_id_id = %(algo_id)s
+  AND GeometryType(simplified.geom) = 'POLYGON' AND NOT ST_IsEmpty(simplified.geom)
+"""
+# Superpixels of a scene/algo pair in the display srid and their extent, as used by build_scene_topology
+SP_TOPOLOGY_EXTENT_SQL = """
+SELECT ST_XMin(extent), ST_YMin(extent), ST_XMax(extent), ST_YMax(extent)
+FROM (
+    SELECT ST_Extent(COALESCE(sp_display, ST_Transform(sp, 3857))) AS extent
+    FROM spmc_superpixel
+    WHERE scene_id_id = %(scene_id)s AND algo_id_id = %(algo_id)s AND sp IS NOT NULL
+) bounds
+"""
+SP_TOPOLOGY_SQL = """
+SELECT id, ST_AsGeoJSON(COALESCE(sp_display, ST_Transform(sp, 3857)))
+FROM spmc_superpixel
+WHERE scene_id_id = %(scene_id)s AND algo_id_id = %(algo_id)s AND sp IS NOT NULL
+ORDER BY id
+"""
+# Rebuild the adjacency graph of a scene/algo pair with a single spatial self-join (GiST index on sp). Superpixels
+# are adjacent if they share at least a segment of their borders (touching corners do not count) or overlap, every
+# pair is compared once and stored in both directions
+SP_ADJACENCY_SQL = """
+DELETE FROM spmc_superpixeladjacency WHERE scene_id_id = %(scene_id)s AND algo_id_id = %(algo_id)s;
+INSERT INTO spmc_superpixeladjacency (scene_id_id, algo_id_id, super_pixel_id_id, neighbour_id_id)
+SELECT %(scene_id)s, %(algo_id)s, pair.sp_id, pair.neighbour_id
+FROM spmc_superpixel a
+JOIN spmc_superpixel b
+    ON b.scene_id_id = a.scene_id_id AND b.algo_id_id = a.algo_id_id AND b.id > a.id AND b.sp && a.sp
+CROSS JOIN LATERAL (SELECT ST_Relate(a.sp, b.sp) AS matrix) relation
+CROSS JOIN LATERAL (VALUES (a.id, b.id), (b.id, a.id)) AS pair(sp_id, neighbour_id)
+WHERE a.scene_id_id = %(scene_id)s AND a.algo_id_id = %(algo_id)s
+  AND (ST_RelateMatch(relation.matrix, '****1****') OR ST_RelateMatch(relation.matrix, '2********'))
+"""
+# Superpixels of a scene/algo pair and rows referencing them in dependency order. Set-based deletes do not load
+# superpixel rows (and geometries) into Python as the ORM collector does
+SP_DELETE_SQL = [
+    """
+    DELETE FROM spmc_segmentationentry e USING spmc_superpixel sp
+    WHERE e.super_pixel_id_id = sp.id AND e.scene_id_id = %(scene_id)s
+      AND sp.scene_id_id = %(scene_id)s AND sp.algo_id_id = %(algo_id)s
+    """,
+    """
+    DELETE FROM spmc_superpixelsimplified s USING spmc_superpixel sp
+    WHERE s.super_pixel_id_id = sp.id AND sp.scene_id_id = %(scene_id)s AND sp.algo_id_id = %(algo_id)s
+    """,
+    """
+    DELETE FROM spmc_superpixelstats st USING spmc_statslayer l
+    WHERE st.layer_id_id = l.id AND l.scene_id_id = %(scene_id)s AND l.algo_id_id = %(algo_id)s
+    """,
+    "DELETE FROM spmc_superpixeladjacency WHERE scene_id_id = %(scene_id)s AND algo_id_id = %(algo_id)s",
+    "DELETE FROM spmc_superpixel WHERE scene_id_id = %(scene_id)s AND algo_id_id = %(algo_id)s",
+]
+# Superpixel files are read with the streaming GeoJSON reader, any other format is read with OGR. Uploads are single
+# files, so Shapefiles (useless without .shx and .dbf siblings) are accepted zipped only and read through /vsizip/
+GEOJSON_EXTENSIONS = [".json", ".geojson"]
+# Geometry types of OGR layers with superpixels (single part multipolygons are unwrapped at ingest)
+POLYGON_LAYER_TYPES = ["Polygon", "MultiPolygon", "Polygon25D", "MultiPolygon25D"]
+OGR_EXTENSIONS = [".gpkg", ".fgb", ".zip"]
+# Superpixels are loaded with COPY, geometries as hex EWKB
+SP_COPY_SQL = "COPY spmc_superpixel (scene_id_id, algo_id_id, sp) FROM STDIN"
+# Progress bar of GDAL command line utilities, i.e. "0...10...20...30...40...50...60...70...80...90...100 - done."
+GDAL_PROGRESS_RE = re.compile(rb"(\d{1,3})(?=\.\.\.|\s*-\s*done)")
+
+
+class GeoJSONFeatureReader:
+    """
+    Incremental reader of a GeoJSON FeatureCollection. The file is decoded chunk by chunk and features are yielded
+    one by one, so memory usage depends on the size of a single feature rather than on the size of the file.
+    The collection level "crs" member must precede "features" (as written by GDAL), without it the file is treated
+    as EPSG:4326
+    """
+
+    def __init__(self, file_upload, chunk_size=None):
+        self.file_upload = file_upload
+        self.chunk_size = chunk_size
+        self.crs = None
+        self.srid = 4326
+        self.bytes_read = 0
+
+    def _chunks(self):
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for chunk in self.file_upload.chunks(self.chunk_size):
+            self.bytes_read += len(chunk)
+            yield decoder.decode(chunk)
+        yield decoder.decode(b"", final=True)
+
+    def __iter__(self):
+        json_decoder = json.JSONDecoder()
+        chunks = self._chunks()
+        buffer = ""
+        # Read the header up to the features array
+        match = None
+        for chunk in chunks:
+            buffer += chunk
+            match = FEATURES_START_RE.search(buffer)
+            if match:
+                break
+        if match is None:
+            raise ValueError("GeoJSON file must be a FeatureCollection")
+        crs_match = CRS_KEY_RE.search(buffer, 0, match.start())
+        if crs_match:
+            self.crs, _ = json_decoder.raw_decode(buffer, crs_match.end())
+            self.srid = SpatialReference(self.crs.get("properties", {}).get("name")).srid or 4326
+        header_end = match.end()
+        buffer = buffer[header_end:]
+
+        # Decode features one by one, pulling more data only when a feature is incomplete
+        pos = 0
+        exhausted = False
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                # Features were already transformed with the srid of the header, a late crs can not be applied
+                if CRS_KEY_RE.search(buffer + "".join(chunks), pos + 1):
+                    raise ValidationError("crs must precede features")
+                return
+            try:
+                if pos == len(buffer):
+                    raise json.JSONDecodeError("Incomplete feature", buffer, pos)
+                feature, pos = json_decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+                buffer = buffer[pos:]
+                pos = 0
+                chunk = next(chunks, None)
+                if chunk is None:
+                    exhausted = True
+                else:
+                    buffer += chunk
+                continue
+            yield feature
+
+
+def _validated_polygons(polygons, bbox):
+    """
+    Check that polygons (already in the SuperPixel srid) are valid and intersect the scene bbox, which is prepared once
+    """
+    prepared_bbox = bbox.transform(SuperPixel.sp.field.srid, clone=True).prepared if bbox is not None else None
+    for geom in polygons:
+        if not geom.valid:
+            raise ValidationError(f"Invalid polygon: {geom.valid_reason}")
+        if prepared_bbox is not None and not prepared_bbox.intersects(geom):
+            raise ValidationError("Some of provided polygons are outside the scene bounding box")
+        yield geom
+
+
+def _geojson_polygons(reader, target_srid):
+    srid = transform = None
+    for feature in reader:
+        geometry = feature.get("geometry") or {}
+        if geometry.get("type") != "Polygon":
+            raise ValidationError("GeoJSON file must contain only Polygon features.")
+        # CRS is known only after the header was read, i.e. on the first feature
+        if srid is None:
+            srid = reader.srid
+            if srid != target_srid:
+                transform = CoordTransform(SpatialReference(srid), SpatialReference(target_srid))
+        geom = Polygon(*geometry["coordinates"], srid=srid)
+        if transform is not None:
+            geom.transform(transform)
+        yield geom
+
+
+def geojson_polygons(file_upload, bbox=None):
+    """
+    Parse superpixel polygons of a GeoJSON FeatureCollection and validate them in the same pass. Polygons are built
+    straight from coordinates and transformed into the SuperPixel srid with a single CoordTransform
+    :param bbox: scene bounding box, polygons are not checked against it if None
+    :return: generator of polygons in the SuperPixel srid
+    """
+    reader = GeoJSONFeatureReader(file_upload)
+    return _validated_polygons(_geojson_polygons(reader, SuperPixel.sp.field.srid), bbox)
+
+
+def _ogr_polygons(layer, target_srid):
+    if layer.srs is None:
+        raise ValidationError("Vector layer has no spatial reference system")
+    # The whole layer is reprojected with the same transformation
+    transform = None
+    if layer.srs.srid != target_srid:
+        transform = CoordTransform(layer.srs, SpatialReference(target_srid))
+    for feature in layer:
+        geom = feature.geom
+        # Some formats (e.g. GeoPackage written by GDAL) promote polygons to single part multipolygons
+        if geom.geom_name == "MULTIPOLYGON" and len(geom) == 1:
+            geom = geom[0]
+        if geom.geom_name != "POLYGON":
+            raise ValidationError("Vector file must contain only Polygon features.")
+        if transform is not None:
+            geom.transform(transform)
+        polygon = geom.geos
+        polygon.srid = target_srid
+        yield polygon
+
+
+def _ogr_layer(path):
+    """
+    The first layer of a vector dataset, zipped datasets are read through /vsizip/
+    """
+    if zipfile.is_zipfile(path):
+        path = f"/vsizip/{path}"
+    try:
+        data_source = DataSource(path)
+    except GDALException as e:
+        raise ValidationError(f"Could not read vector file: {e}")
+    if not data_source.layer_count:
+        raise ValidationError("Vector file does not contain any layers")
+    return data_source[0]
+
+
+def ogr_polygons(path, bbox=None):
+    """
+    Read superpixel polygons from the first layer of any vector dataset supported by GDAL/OGR (GeoPackage,
+    FlatGeobuf, zipped Shapefile...) and validate them in the same pass. Features are streamed one by one, so the
+    memory usage does not depend on the number of polygons
+    :param bbox: scene bounding box, polygons are not checked against it if None
+    :return: generator of polygons in the SuperPixel srid
+    """
+    return _validated_polygons(_ogr_polygons(_ogr_layer(path), SuperPixel.sp.field.srid), bbox)
+
+
+def _copy_superpixels(scene, algo, batch):
+    rows = "".join(f"{scene.pk}\t{algo.pk}\t{ewkb.hex()}\n" for ewkb in batch)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(SP_COPY_SQL, io.StringIO(rows))
+
+
+def ingest_superpixels(scene, algo, path, batch_size=None, progress=None):
+    """
+    Read, validate (against the scene bbox) and write superpixel polygons of a GeoJSON file or any other OGR vector
+    dataset into the database with COPY in fixed-size batches, so the memory usage does not depend on the file size
+    :param progress: optional callable receiving percent of the file processed (GeoJSON files only)
+    :return: number of created superpixels
+    """
+    batch_size = batch_size or settings.SPMC_INGEST_BATCH_SIZE
+    size = os.path.getsize(path)
+    batch = []
+    created = 0
+    with open(path, "rb") as f:
+        if os.path.splitext(path)[1].lower() in GEOJSON_EXTENSIONS:
+            polygons = geojson_polygons(File(f), scene.bbox)
+        else:
+            progress = None
+            polygons = ogr_polygons(path, scene.bbox)
+        for geom in polygons:
+            batch.append(bytes(geom.ewkb))
+            if len(batch) >= batch_size:
+                _copy_superpixels(scene, algo, batch)
+                created += len(batch)
+                batch = []
+                if progress is not None and size:
+                    progress(100 * f.tell() / size)
+    if batch:
+        _copy_superpixels(scene, algo, batch)
+        created += len(batch)
+    return created
+
+
+def refresh_scene_algo(scene, algo):
+    """
+    Update the catalogue entry of a scene/algo pair. The entry is kept (with sp_count 0) if there are no superpixels
+    left, so its version never repeats and keys of cached geometry could not be reused by a later ingest
+    """
+    params = {"scene_id": scene.pk, "algo_id": algo.pk}
+    with connection.cursor() as cursor:
+        cursor.execute(SCENE_ALGO_REFRESH_SQL, params)
+
+
+def fill_display_geometry(scene, algo):
+    """
+    Project superpixels of a scene/algo pair into the display srid once, so reads do not transform them
+    """
+    params = {"scene_id": scene.pk, "algo_id": algo.pk, "srid": SuperPixel.sp_display.field.srid}
+    with connection.cursor() as cursor:
+        cursor.execute(SP_DISPLAY_SQL, params)
+
+
+def build_simplified_geometries(scene, algo):
+    """
+    Precompute simplified geometries of a scene/algo pair for every resolution of SPMC_SIMPLIFY_RESOLUTIONS
+    """
+    params = {"scene_id": scene.pk, "algo_id": algo.pk, "resolutions": list(settings.SPMC_SIMPLIFY_RESOLUTIONS)}
+    with connection.cursor() as cursor:
+        cursor.execute(SP_SIMPLIFIED_SQL, params)
+
+
+def build_scene_topology(scene, algo):
+    """
+    Encode superpixels of a scene/algo pair as TopoJSON with shared arcs and write it to the topology file of the
+    current catalogue version. Polygons are streamed with a server-side cursor, the extent is queried first so every
+    polygon is quantized as soon as it is read. Files of other versions are removed once the transaction is committed
+    """
+    pair = SceneAlgo.objects.get(scene_id=scene, algo_id=algo)
+    params = {"scene_id": scene.pk, "algo_id": algo.pk}
+    with connection.cursor() as cursor:
+        cursor.execute(SP_TOPOLOGY_EXTENT_SQL, params)
+        extent = cursor.fetchone()
+    path = pair.topology_path
+    if extent[0] is not None:
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(SP_TOPOLOGY_SQL, params)
+            polygons = ((sp_id, json.loads(geometry)["coordinates"]) for sp_id, geometry in cursor)
+            document = topology.dumps(topology.build_topology(polygons, extent=extent))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Readers never see a partially written file
+        tmp_path = f"{path}.{uuid.uuid4()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(document)
+        os.replace(tmp_path, path)
+
+    def remove_previous():
+        prefix = f"{algo.pk}."
+        folder = os.path.dirname(path)
+        for name in os.listdir(folder) if os.path.isdir(folder) else []:
+            if name.startswith(prefix) and os.path.join(folder, name) != path:
+                os.remove(os.path.join(folder, name))
+
+    transaction.on_commit(remove_previous)
+
+
+def build_adjacency(scene, algo):
+    """
+    Rebuild the adjacency graph of superpixels of a scene/algo pair, see SuperPixelAdjacency
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(SP_ADJACENCY_SQL, {"scene_id": scene.pk, "algo_id": algo.pk})
+
+
+def finalize_superpixel_ingest(scene, algo):
+    """
+    Derived data which has to be rebuilt whenever superpixels of a scene/algo pair are replaced
+    """
+    fill_display_geometry(scene, algo)
+    build_simplified_geometries(scene, algo)
+    refresh_scene_algo(scene, algo)
+    # Cached geometry of the previous version is not used anymore, topology is written for the new version
+    SceneAlgo.objects.filter(scene_id=scene, algo_id=algo).update(version=F("version") + 1)
+    build_scene_topology(scene, algo)
+    build_adjacency(scene, algo)
+
+
+def delete_superpixels(scene, algo):
+    """
+    Delete superpixels of a scene/algo pair together with labels, simplified geometries, statistics and adjacency
+    """
+    with connection.cursor() as cursor:
+        for sql in SP_DELETE_SQL:
+            cursor.execute(sql, {"scene_id": scene.pk, "algo_id": algo.pk})
+
+
+def replace_superpixels(scene, algo, path, batch_size=None, progress=None):
+    """
+    Replace superpixels of a scene/algo pair with polygons of a file (see ingest_superpixels) and rebuild derived data.
+    Everything runs in a single transaction, so readers never see a half-replaced segmentation and a failed ingest
+    keeps the previous one
+    :return: number of created superpixels
+    """
+    with transaction.atomic():
+        delete_superpixels(scene, algo)
+        created = ingest_superpixels(scene, algo, path, batch_size=batch_size, progress=progress)
+        finalize_superpixel_ingest(scene, algo)
+    return created
+
+
+def run_gdal_command(cmd, progress=None, phases=1):
+    """
+    Run a GDAL command line utility and forward its "0...10...20...100 - done." output to the progress callback
+    :param cmd: command with arguments
+    :param progress: callable receiving overall percent of completion
+    :param phases: number of progress bars printed by the utility
+    :return: command output
+    """
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = b""
+    last_reported = None
+    while True:
+        chunk = process.stdout.read1(1024)
+        if not chunk:
+            break
+        output += chunk
+        if progress is None:
+            continue
+        values = [int(v) for v in GDAL_PROGRESS_RE.findall(output)]
+        if values:
+            done_phases = values.count(100)
+            current = 0 if values[-1] == 100 else values[-1]
+            percent = min(100 * done_phases + current, 100 * phases) / phases
+            if percent != last_reported:
+                progress(percent)
+                last_reported = percent
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, output)
+    return output
+
+
+def staged_path(f_obj):
+    """
+    Get a path of an uploaded file on disk. Uploads spooled by TemporaryFileUploadHandler are used in place, others
+    are written to a temporary file once (keeping the extension, drivers are chosen by it) and the file is reused on
+    subsequent calls
+    """
+    if hasattr(f_obj, "temporary_file_path"):
+        return f_obj.temporary_file_path()
+    if getattr(f_obj, "_staged_file", None) is None:
+        tmp_file = NamedTemporaryFile(suffix=os.path.splitext(f_obj.name)[1])
+        for chunk in f_obj.chunks():
+            tmp_file.write(chunk)
+        tmp_file.flush()
+        f_obj._staged_file = tmp_file  # Keep a reference, the file is removed once it is closed
+    return f_obj._staged_file.name
+
+
+def raster_bbox(path, srid=None):
+    """
+    Get a bounding box of a raster as a polygon in the given srid (in the raster srid if not provided)
+    """
+    rs = GDALRaster(path)
+    poly = Polygon.from_bbox(rs.extent)
+    poly.srid = rs.srid
+    if srid is not None:
+        poly.transform(srid)
+    return poly
+
+
+def handle_tiles_upload(raster_path, uuid, tiling=None, progress=None):
     # Prepare tiles folder
     # Define the output directory name folder based on the provided uuid
     output_dir = f"{settings.MEDIA_ROOT}/tiles/{uuid}"
@@ -31,9 +502,11 @@ def handle_tiles_upload(f_obj, uuid):
     # Run gdal2tiles.py as a subprocess, passing in the input and output paths
     err = None
     try:
-        subprocess.check_output(
-            ["gdal2tiles.py", "-z", "10-18", "-w", "none", "--xyz", "-r", "bilinear", tmp_file.name, output_dir]
-            # ["gdal2tiles.py", "-z", "1", "-w", "none", "-r", "bilinear", tmp_file.name, output_dir]
+        tiling = tiling or TilingSettings()
+        run_gdal_command(
+            ["gdal2tiles.py", *tiling.gdal2tiles_args(), "-w", "none", "--xyz", raster_path, output_dir],
+            progress=progress,
+            phases=2,  # base tiles and overview tiles
         )
     except subprocess.CalledProcessError:
         err = "Something wrong with the file provided"
@@ -42,76 +515,65 @@ def handle_tiles_upload(f_obj, uuid):
     if err is not None:
         shutil.rmtree(output_dir)
     # Get a bounding box ==============================================================================================
-    rs = GDALRaster(tmp_file.name)
+    rs = GDALRaster(raster_path)
     bbox = rs.extent
     srid = rs.srid
     # Return folder path
     return output_dir, bbox, srid, err
 
 
-def check_geojson(file_upload, bbox, im_file):
-    # If it is a new object, it does not have bbox yet, therefore, try to estimate bbox from raster
-    if bbox is None:
-        try:
-            tmp_file = NamedTemporaryFile()
-            for chunk in im_file.chunks():
-                tmp_file.write(chunk)
-
-            rs = GDALRaster(tmp_file.name)
-            bbox = rs.extent
-            srid = rs.srid
-            poly = Polygon.from_bbox(bbox)
-            poly.srid = srid
-            bbox = poly
-        except Exception as e:
-            raise ValidationError(f"Could not get bounding box from raster: {e}")
-    # Process upload
-    try:
-        json_str = file_upload.read().decode("utf-8")
-        geojson_data = json.loads(json_str)
-        # Ensure the geometry type is "Polygon"
-        for feature in geojson_data.get("features", []):
-            if feature.get("geometry", {}).get("type") != "Polygon":
-                raise ValidationError("GeoJSON file must contain only Polygon features.")
-            # Ensure the file can be read as a GeoDjango object
-            feature_str = feature.get("geometry")
-            feature_str.update({"crs": geojson_data.get("crs")})
-            tmp_geom = GEOSGeometry(json.dumps(feature_str))
-            tmp_geom.transform(bbox.srid)
-            # Check if each poly intersects with scene bbox
-            if not tmp_geom.intersects(bbox):
-                raise ValidationError("Some of provided polygons are outside the scene bounding box")
-    except Exception as e:
-        raise ValidationError(f"Error reading geojson file: {e}")
-    return True
+def new_staging_dir():
+    """
+    Create a folder in the staging area shared by the web and worker processes
+    """
+    path = os.path.join(settings.SPMC_STAGING_ROOT, str(uuid.uuid4()))
+    os.makedirs(path)
+    return path
+
+
+def check_superpixels(path):
+    """
+    Cheap checks of a staged superpixel file which do not read the whole file: it could be opened, has a spatial
+    reference system and polygon features. Polygons themselves are validated by the ingest job
+    """
+    if os.path.splitext(path)[1].lower() in GEOJSON_EXTENSIONS:
+        with open(path, "rb") as f:
+            reader = GeoJSONFeatureReader(File(f))
+            try:
+                # Unknown coordinate reference systems are rejected with the header rather than by the job
+                feature = next(iter(reader), None)
+            except (ValueError, GDALException, SRSException) as e:
+                raise ValidationError(f"Could not read GeoJSON file: {e}")
+        if feature is None:
+            raise ValidationError("Superpixel file does not contain any polygons")
+        if (feature.get("geometry") or {}).get("type") != "Polygon":
+            raise ValidationError("GeoJSON file must contain only Polygon features.")
+        return
+    layer = _ogr_layer(path)
+    if layer.srs is None:
+        raise ValidationError("Vector layer has no spatial reference system")
+    if layer.geom_type.name not in POLYGON_LAYER_TYPES:
+        raise ValidationError("Vector file must contain only Polygon features.")
+    if not layer.num_feat:
+        raise ValidationError("Superpixel file does not contain any polygons")
 
 
 def check_raster(file_upload):
     """
-    Read uploaded file to tmp location, then try to perform gdal2tiles with small zoom in order to check
-    for problems with raster
+    Check raster metadata: it should be readable by GDAL, georeferenced, and have Byte bands only (as required by
+    gdal2tiles). Only the file header is read, the file itself is staged on disk once and reused later
     :param file_upload:
     :return:
     """
-    # Process upload
-    tmp_file = NamedTemporaryFile()
-    for chunk in file_upload.chunks():
-        tmp_file.write(chunk)
-    # Define temporary output directory name folder based on the provided uuid
-    output_dir = f"/tmp/{uuid.uuid4()}"
-    # Check if output path exists, and create or recreate it
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    else:
-        shutil.rmtree(output_dir)
-        os.makedirs(output_dir)
-    # Try to generate tiles
     try:
-        GDALRaster(tmp_file.name)  # Just in case it could not be read
-        subprocess.check_output(["gdal2tiles.py", "-z", "1", "-w", "none", tmp_file.name, output_dir])
-        shutil.rmtree(output_dir)
-    except subprocess.CalledProcessError:
-        shutil.rmtree(output_dir)
+        rs = GDALRaster(staged_path(file_upload))
+    except Exception as e:
+        raise ValidationError(f"Could not read raster: {e}")
+    if rs.width == 0 or rs.height == 0 or not rs.bands:
+        raise ValidationError("Raster is empty")
+    if rs.srs is None:
+        raise ValidationError("Raster has no spatial reference system")
+    if any(band.datatype() != GDAL_BYTE for band in rs.bands):
         raise ValidationError(
             "Problem with raster. The raster should be of a Bytes type, check it. "
             + "Or simply convert the file into some RGB representation with gdal"
@@ -4,9 +4,14 @@ from django.contrib.auth.decorators import login_required
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import F, Window
 from django.db.models.functions import RowNumber
+from django.http import Http404, HttpResponse, HttpResponseNotModified
 from django.shortcuts import redirect, render
+from django.views.decorators.http import require_GET
 
-from .models import LandClassification, MiscTile, Project, Scene
+from .models import COG, MBTILES, Job, LandClassification, MiscTile, Project, Scene, TilingSettings
+from .tiles import TRANSPARENT_TILE, mbtiles_reader, render_cog_tile, tile_cache
+
+TILE_CONTENT_TYPES = {"png": "image/png", "webp": "image/webp"}
 
 
 def home(request):
@@ -49,15 +54,16 @@ def scene(request):
         return redirect("home")
     else:
         proj = Project.objects.get(id=request.session.get("proj_id"))
-        # Select scenes and corresponding unique algo_ids (i.e unique pairs of scene_id and related superpixel.algo_id)
+        # Scene/algo pairs come from the catalogue maintained at ingest time, every pair is a separate row
         scenes = (
-            Scene.objects.filter(superpixel__scene_id__proj_id=proj)
+            Scene.objects.filter(proj_id=proj, scenealgo__sp_count__gt=0)
             .annotate(
-                algo_id=F("superpixel__algo_id"),
-                algo_name=F("superpixel__algo_id__name"),
-                algo_descr=F("superpixel__algo_id__description"),
+                algo_id=F("scenealgo__algo_id"),
+                algo_name=F("scenealgo__algo_id__name"),
+                algo_descr=F("scenealgo__algo_id__description"),
+                sp_count=F("scenealgo__sp_count"),
             )
-            .distinct()
+            .order_by("id", "algo_id")
         )
     context = {
         "proj": proj,
@@ -126,3 +132,46 @@ def classification(request):
         "misc_tiles": misc_tiles,
     }
     return render(request, "pages/classification.html", context=context)
+
+
+@require_GET
+@login_required
+def tile(request, uuid, z, x, y, ext):
+    """
+    Serve an XYZ tile of a scene (or misc tile) stored as a single-file backend:
+    - COG: the tile is rendered on demand and kept in a disk cache
+    - MBTiles: the tile is read from the archive by key. Archive tiles never change under the same URL (tile_url is
+      versioned by the archive mtime), so they are served with a strong ETag and cached by browsers forever
+    """
+    target = Scene.objects.filter(uuid=uuid).first() or MiscTile.objects.filter(uuid=uuid).first()
+    if target is None or not target.tiles_path or ext != target.tile_format or x >= 2**z or y >= 2**z:
+        raise Http404("Tile not found")
+    content_type = TILE_CONTENT_TYPES.get(ext, "application/octet-stream")
+    if target.tiles_backend == MBTILES:
+        found = mbtiles_reader.get(target.tiles_path, z, x, y)
+        if found is None:
+            raise Http404("Tile not found")
+        data, tile_id = found
+        etag = f'"{tile_id}"'
+        if etag in request.headers.get("If-None-Match", ""):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(data, content_type=content_type)
+        response["ETag"] = etag
+        response["Cache-Control"] = "private, max-age=31536000, immutable"
+        return response
+    if target.tiles_backend != COG:
+        raise Http404("Tile not found")
+    data = tile_cache.get(uuid, z, x, y)
+    if data is None:
+        tiling = TilingSettings.for_target(target)
+        if not tiling.min_zoom <= z <= tiling.max_zoom:
+            raise Http404("Tile not found")
+        data = render_cog_tile(target.tiles_path, z, x, y, resampling=tiling.resampling) or TRANSPARENT_TILE
+        if tile_cache.put(uuid, z, x, y, data):
+            # The cache is trimmed by the worker, a single pending job is enough
+            if not Job.objects.filter(kind=Job.EVICT_TILE_CACHE, state=Job.PENDING).exists():
+                Job.objects.create(kind=Job.EVICT_TILE_CACHE)
+    response = HttpResponse(data, content_type=content_type)
+    response["Cache-Control"] = "private, max-age=3600"
+    return response
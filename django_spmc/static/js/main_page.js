@@ -1,14 +1,17 @@
 import 'ol/ol.css';
 import Map from 'ol/Map';
-import { Tile as TileLayer, Vector as VectorLayer } from 'ol/layer';
+import { Tile as TileLayer, Vector as VectorLayer, VectorTile as VectorTileLayer } from 'ol/layer';
 import { Fill, Stroke, Style } from 'ol/style';
 import View from 'ol/View';
 import OSM from 'ol/source/OSM';
 import BingMaps from 'ol/source/BingMaps';
 import XYZ from 'ol/source/XYZ';
 import Vector from 'ol/source/Vector';
+import VectorTile from 'ol/source/VectorTile';
 import * as d3 from 'd3';
 import GeoJSON from 'ol/format/GeoJSON';
+import TopoJSON from 'ol/format/TopoJSON';
+import MVT from 'ol/format/MVT';
 import Select from 'ol/interaction/Select';
 import { click } from 'ol/events/condition';
 import { getCenter } from 'ol/extent';
@@ -32,23 +35,6 @@ function hexToRgba(hex, alpha) {
   return [r, g, b, alpha];
 }
 
-// List of geojson's to geojson
-function list2geojson(list) {
-  return {
-    type: 'FeatureCollection',
-    srid: 3857,
-    features: list.map((segment) => ({
-      type: 'Feature',
-      geometry: JSON.parse(segment.features),
-      properties: {
-        id: segment.id,
-        land_class_id: segment.land_class_id,
-        color: segment.color,
-      },
-    })),
-  };
-}
-
 /**
  * Prepare miscellaneous layers =====================================================================================
  */
@@ -87,7 +73,7 @@ const map_sentinel = new Map({
     new TileLayer({
       name: 'SentinelRGB',
       source: new XYZ({
-        url: 'http://localhost:3000/media/tiles/ea0ce40b-f2dc-4d6f-aa0e-537943905f51/{z}/{x}/{y}.png',
+        url: tile_source,
       }),
     }),
   ].concat(misc_layers),
@@ -221,6 +207,50 @@ selectInteraction.on('select', function (event) {
   map_sat.getView().setCenter(cntr);
 });
 
+/**
+ * Selection growing: neighbours of the selected superpixel, or a flood fill over neighbours with similar band means.
+ * Grown selection is labelled as a whole with the next class key press (a single save_sp request)
+ */
+const FILL_TOLERANCE = 10;
+
+function grow_selection(tolerance) {
+  const selected = selectInteraction.getFeatures();
+  if (selected.getLength() === 0) {
+    return null;
+  }
+  const params = new URLSearchParams({
+    scene_id: scene_id,
+    algo_id: algo_id,
+    sp_id: selected.item(selected.getLength() - 1).get('id'),
+  });
+  if (tolerance !== undefined) {
+    params.set('tolerance', tolerance);
+  }
+  return d3
+    .json('/api/superpixels/neighbours/?' + params.toString())
+    .then(function (result) {
+      result.ids.forEach(function (id) {
+        const feature = vectorSource.getFeatureById(id);
+        if (feature && selected.getArray().indexOf(feature) < 0) {
+          selected.push(feature);
+        }
+      });
+    })
+    .catch((error) => console.error('Error:', error));
+}
+
+window.grow_selection = grow_selection;
+
+// [shift+g] adds neighbours of the selected superpixel, [shift+f] flood fills from it
+document.addEventListener('keydown', function (event) {
+  if (event.shiftKey && event.code === 'KeyG') {
+    grow_selection();
+  }
+  if (event.shiftKey && event.code === 'KeyF') {
+    grow_selection(FILL_TOLERANCE);
+  }
+});
+
 /**
  * Class assignment handlers =========================================================================================
  */
@@ -234,10 +264,11 @@ function send_update(obj) {
     body: JSON.stringify({ upd: obj }),
   })
     .then((response) => response.json())
-    // TODO ad handling of responses
     .then((result) => {
-      console.log('Server response:', result);
-      // Handle the response from the server
+      // Entries are validated one by one, so some of them could be rejected
+      if (result.rejected && result.rejected.length > 0) {
+        console.warn('Rejected updates:', result.rejected);
+      }
     })
     .catch((error) => {
       console.error('Error:', error);
@@ -319,50 +350,149 @@ document.addEventListener('keydown', function (event) {
 /**
  * Add vector map =====================================================================================================
  */
-// Make a request to the server
-d3.json('/api/superpixels/get_sp/', {
-  method: 'POST',
-  headers: { 'Content-Type': 'application/json', 'X-CSRFToken': csrf_token },
-  body: JSON.stringify({
-    srid: 3857,
-    scene_id: scene_id,
-    algo_id: algo_id,
+const SP_PAGE_SIZE = 5000;
+const format = new GeoJSON();
+const vectorSource = new Vector();
+const vectorLayer = new VectorLayer({
+  name: 'Vector',
+  source: vectorSource,
+  style: function (feature, resolution) {
+    return new Style({
+      stroke: new Stroke({
+        color: feature.get('color'),
+        width: 1,
+      }),
+      fill: new Fill({
+        // Set feature fill as transparent if color property is null or use a property color
+        color: feature.get('color')
+          ? hexToRgba(feature.get('color'), 0.5)
+          : [0, 0, 0, 0],
+      }),
+    });
+  },
+});
+
+// Superpixels of the viewport as vector tiles, shown while the whole scene is loaded into the vector layer
+const tileLayer = new VectorTileLayer({
+  name: 'VectorTiles',
+  source: new VectorTile({
+    format: new MVT(),
+    url: '/api/superpixels/tiles/' + scene_id + '/' + algo_id + '/{z}/{x}/{y}.mvt',
   }),
-}).then(function (data) {
-  // Construct geojson
-  let geojson = list2geojson(data);
-  // Create a new layer to display the GeoJSON data
-  const vectorLayer = new VectorLayer({
-    name: 'Vector',
-    source: new Vector({
-      features: new GeoJSON().readFeatures(geojson),
-    }),
-    style: function (feature, resolution) {
-      return new Style({
-        stroke: new Stroke({
-          color: feature.get('color'),
-          width: 1,
-        }),
-        fill: new Fill({
-          // Set feature fill as transparent if color property is null or use a property color
-          color: feature.get('color')
-            ? hexToRgba(feature.get('color'), 0.5)
-            : [0, 0, 0, 0],
-        }),
-      });
-    },
+  style: vectorLayer.getStyle(),
+});
+
+// Request a page of superpixels, server responds with a ready to use FeatureCollection
+function fetch_sp(params) {
+  return d3.json('/api/superpixels/get_sp/', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json', 'X-CSRFToken': csrf_token },
+    body: JSON.stringify(
+      Object.assign({ srid: 3857, scene_id: scene_id, algo_id: algo_id }, params),
+    ),
   });
+}
 
-  // Add the vector layer to the map
-  map_sat.addLayer(vectorLayer);
-  map_sentinel.addLayer(vectorLayer);
+// Set land class and color from the "labels" member of responses: {id: [land_class_id, color]}
+function apply_labels(features, labels) {
+  features.forEach(function (feature) {
+    const label = labels[feature.getId()];
+    feature.setProperties({
+      id: feature.getId(),
+      land_class_id: label ? label[0] : null,
+      color: label ? label[1] : null,
+    });
+  });
+}
 
-  // Add the select interaction to the map
-  map_sentinel.addInteraction(selectInteraction);
+// Add features which are not on the map yet (viewport pages overlap with the rest of the scene)
+function add_sp(geojson) {
+  const features = format
+    .readFeatures(geojson)
+    .filter((feature) => !vectorSource.getFeatureById(feature.getId()));
+  apply_labels(features, geojson.labels);
+  vectorSource.addFeatures(features);
+}
 
-  // Prepare distance matrix
-  prepareDistanceMatrix(vectorLayer, distance_matrix, polygons_ids);
-});
+// Load all pages of a request one after another
+async function load_sp(params) {
+  let cursor = null;
+  do {
+    const geojson = await fetch_sp(
+      Object.assign({ limit: SP_PAGE_SIZE, cursor: cursor }, params),
+    );
+    add_sp(geojson);
+    cursor = geojson.next_cursor;
+  } while (cursor !== null && cursor !== undefined);
+}
+
+// Whole scene as TopoJSON (shared boundaries are sent once), labels of the user come as a separate member
+function load_topojson() {
+  return fetch_sp({ format: 'topojson' }).then(function (topology) {
+    const features = new TopoJSON({ dataProjection: 'EPSG:3857' }).readFeatures(topology);
+    apply_labels(features, topology.labels);
+    vectorSource.addFeatures(features);
+  });
+}
+
+// Add the vector layer to the map, vector tiles are displayed until it is loaded
+map_sat.addLayer(vectorLayer);
+map_sentinel.addLayer(vectorLayer);
+map_sentinel.addLayer(tileLayer);
+
+// Labels changed by other tabs or sessions are polled by the scene label revision
+const LABELS_POLL_INTERVAL = 10000;
+let label_revision = null;
+
+function fetch_changes(since) {
+  const params = new URLSearchParams({ scene_id: scene_id, algo_id: algo_id });
+  if (since !== null) {
+    params.set('since', since);
+  }
+  return d3.json('/api/superpixels/changes/?' + params.toString());
+}
+
+function poll_changes() {
+  fetch_changes(label_revision)
+    .then(function (result) {
+      result.changes.forEach(function ([id, land_class_id, color]) {
+        const feature = vectorSource.getFeatureById(id);
+        if (feature) {
+          feature.setProperties({ land_class_id: land_class_id, color: color });
+        }
+      });
+      label_revision = result.revision;
+    })
+    .catch((error) => console.error('Error:', error));
+}
+
+// The revision is taken before the scene is loaded, so changes made during loading are not lost.
+// If the topology is not built, the visible area is loaded in pages first and then the whole scene at once, so the
+// geometry cached by the server is used
+fetch_changes(null)
+  .then(function (result) {
+    label_revision = result.revision;
+    return load_topojson();
+  })
+  .catch(() =>
+    load_sp({ bbox: map_sentinel.getView().calculateExtent(map_sentinel.getSize()) })
+      .then(() => fetch_sp({}))
+      .then(add_sp),
+  )
+  .then(function () {
+    // The whole scene is on the vector layer now
+    map_sentinel.removeLayer(tileLayer);
+
+    // Add the select interaction to the map
+    map_sentinel.addInteraction(selectInteraction);
+
+    // Prepare distance matrix
+    prepareDistanceMatrix(vectorLayer, distance_matrix, polygons_ids);
+
+    if (label_revision !== null) {
+      setInterval(poll_changes, LABELS_POLL_INTERVAL);
+    }
+  });
 
 /**
  * Distance handling ==================================================================================================